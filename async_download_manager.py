@@ -0,0 +1,285 @@
+import os
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from download_manager import (
+    DownloadManager, RangeNotSupportedError, _DownloadControl, _hash_file_prefix,
+    MAX_CHUNK_SIZE, SEGMENT_RETRIES, STATE_SAVE_INTERVAL
+)
+
+# Connections the shared HTTP client keeps open across all downloads and segments
+DEFAULT_POOL_SIZE = 32
+# Threads that write, hash and copy files, so disk work never stalls the event loop
+DISK_WORKERS = 4
+# Longest single sleep while throttled, so cancelling takes effect quickly
+_WAIT_STEP = 0.25
+
+def _import_aiohttp():
+    # aiohttp is optional: only this engine needs it
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError("AsyncDownloadManager requires the aiohttp package (pip install aiohttp).")
+    return aiohttp
+
+async def _sleep(control, seconds):
+    while seconds > 0 and not control.cancelled:
+        await asyncio.sleep(min(seconds, _WAIT_STEP))
+        seconds -= _WAIT_STEP
+
+def _write_chunk(f, chunk, sha256):
+    f.write(chunk)
+    sha256.update(chunk)
+
+def _open_at(filepath, offset):
+    f = open(filepath, 'r+b')
+    f.seek(offset)
+    return f
+
+def _write_segment_chunk(f, chunk, segment, offset, hasher):
+    # Same order as DownloadManager._segment_worker(): write, count, then hash
+    f.write(chunk)
+    f.flush()
+    segment['downloaded'] = offset + len(chunk) - segment['start']
+    hasher.feed(offset, chunk)
+
+class _LoopEvent(threading.Event):
+    """A threading.Event that coroutines on an event loop can also await."""
+
+    def __init__(self, loop):
+        super().__init__()
+        self._loop = loop
+        # Futures of the coroutines waiting for set(); only touched on the loop
+        self._waiters = set()
+
+    def set(self):
+        super().set()
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+
+    async def wait_async(self):
+        while not self.is_set():
+            waiter = self._loop.create_future()
+            self._waiters.add(waiter)
+            # set() may have run before the waiter was added; its _wake() then ran already
+            if self.is_set():
+                self._waiters.discard(waiter)
+                return
+            await waiter
+
+class _AsyncDownloadControl(_DownloadControl):
+    """A _DownloadControl whose pause a coroutine can await instead of polling."""
+
+    def __init__(self, loop):
+        super().__init__()
+        self.running = _LoopEvent(loop)
+        self.running.set()
+
+class AsyncDownloadManager(DownloadManager):
+    """A DownloadManager that runs every transfer on one asyncio event loop.
+
+    It has the same public API, queue, limits, store and downloads.json format as
+    DownloadManager. All requests go through one aiohttp session, so connections
+    to a mirror are kept alive and reused across segments, resumes and files, and
+    a running download is a task instead of a set of threads, so the thread count
+    stays at a handful however many downloads run. File writes, hashing and
+    copies run on DISK_WORKERS threads, so a slow disk never stalls the loop.
+    """
+
+    def __init__(self, config_dir=".", downloads_dir="downloads", *args, pool_size=DEFAULT_POOL_SIZE, **kwargs):
+        self._aiohttp = _import_aiohttp()
+        self._pool_size = pool_size
+        self._session = None
+        # Started before the base class, which may already schedule queued downloads
+        self._disk_executor = ThreadPoolExecutor(max_workers=DISK_WORKERS, thread_name_prefix="download-disk")
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, name="download-loop")
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+        super().__init__(config_dir, downloads_dir, *args, **kwargs)
+
+    def close(self):
+        """Writes pending changes, then stops the event loop and closes the HTTP client."""
+        super().close()
+        if self._loop.is_running():
+            if self._session is not None:
+                asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result(timeout=5)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        self._disk_executor.shutdown(wait=False)
+
+    def _new_control(self):
+        return _AsyncDownloadControl(self._loop)
+
+    def _on_disk(self, func, *args):
+        """Runs blocking file work on the disk threads; returns an awaitable of its result."""
+        return self._loop.run_in_executor(self._disk_executor, func, *args)
+
+    def _launch(self, url, segments):
+        asyncio.run_coroutine_threadsafe(self._run_slot_async(url, segments), self._loop)
+
+    def _get_session(self):
+        # Created on the loop thread, on first use
+        if self._session is None:
+            aiohttp = self._aiohttp
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._pool_size, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(sock_connect=30, sock_read=30)
+            )
+        return self._session
+
+    async def _throttle_async(self, bucket, amount, control):
+        delay = max(self._global_bucket.reserve(amount), bucket.reserve(amount))
+        if delay > 0:
+            await _sleep(control, delay)
+
+    async def _run_slot_async(self, url, segments):
+        try:
+            await self._run_download_async(url, segments)
+        finally:
+            self._release_slot(url)
+
+    async def _probe_range_support_async(self, url):
+        """Returns (final_url, total_size) if the server supports byte ranges, else (url, 0)."""
+        async with self._get_session().head(url, allow_redirects=True) as response:
+            if response.status != 200 or response.headers.get('Accept-Ranges', '').lower() != 'bytes':
+                return url, 0
+            return str(response.url), int(response.headers.get('Content-Length', 0))
+
+    async def _run_download_async(self, url, segments):
+        if await self._on_disk(self._complete_from_store, url):
+            return
+        try:
+            previous_size = await self._on_disk(self._resumable_size, url)
+            if segments > 1 or previous_size:
+                source_url, total_size = await self._probe_range_support_async(url)
+            else:
+                source_url, total_size = url, 0
+            # Preallocates the file of a segmented download
+            await self._on_disk(self._prepare_segments, url, segments, previous_size, total_size)
+        except Exception as e:
+            self._fail(url, e)
+            return
+        if self.downloads[url].get('segments'):
+            await self._segmented_downloader_async(url, source_url)
+        else:
+            await self._downloader_async(url)
+
+    async def _segment_worker_async(self, source_url, filepath, segment, control, bucket, hasher, abort, errors):
+        """Async counterpart of DownloadManager._segment_worker()."""
+        last_error = None
+        for attempt in range(SEGMENT_RETRIES):
+            offset = segment['start'] + segment['downloaded']
+            if offset > segment['end']:
+                return
+            try:
+                headers = {'Range': f"bytes={offset}-{segment['end']}"}
+                async with self._get_session().get(source_url, headers=headers) as response:
+                    if response.status != 206:
+                        raise RangeNotSupportedError(f"Server answered a range request with HTTP {response.status}.")
+                    # Opening, writing and closing (which flushes) all happen on disk threads
+                    f = await self._on_disk(_open_at, filepath, offset)
+                    try:
+                        while True:
+                            # Returns whatever has arrived, up to MAX_CHUNK_SIZE
+                            chunk = await response.content.read(MAX_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            await control.running.wait_async()
+                            if abort.is_set() or control.cancelled:
+                                return
+                            chunk = chunk[:segment['end'] + 1 - offset]
+                            if chunk:
+                                await self._on_disk(_write_segment_chunk, f, chunk, segment, offset, hasher)
+                                offset += len(chunk)
+                                await self._throttle_async(bucket, len(chunk), control)
+                    finally:
+                        await self._on_disk(f.close)
+                if offset > segment['end']:
+                    return
+                last_error = "Connection closed before the segment was complete."
+            except RangeNotSupportedError as e:
+                errors.append(e)
+                abort.set()
+                return
+            except (self._aiohttp.ClientError, asyncio.TimeoutError) as e:
+                last_error = e
+            except OSError as e:
+                errors.append(e)
+                abort.set()
+                return
+        errors.append(last_error)
+        abort.set()
+
+    async def _segmented_downloader_async(self, url, source_url):
+        abort = threading.Event()
+        errors = []
+        filepath, control, bucket, hasher, pending = self._start_segments(url)
+        running = {asyncio.ensure_future(self._segment_worker_async(source_url, filepath, segment, control, bucket, hasher, abort, errors))
+                   for segment in pending}
+        # Persist the per-segment progress regularly, so an interrupted download can resume
+        while running:
+            _, running = await asyncio.wait(running, timeout=STATE_SAVE_INTERVAL)
+            self._save_downloads()
+        # Hashing the rest and storing the file both read or move the whole file
+        digest = await self._on_disk(hasher.hexdigest) if not (errors or control.cancelled) else None
+        if await self._on_disk(self._finish_segmented, url, filepath, control, errors, digest):
+            await self._downloader_async(url)
+
+    async def _downloader_async(self, url):
+        try:
+            with self.lock:
+                filepath = os.path.join(self.downloads_dir, self.downloads[url]['filename'])
+                control = self.controls[url]
+                bucket = self._buckets[url]
+            downloaded_size = await self._on_disk(self._resume_offset, filepath)
+            headers = {'Range': f'bytes={downloaded_size}-'} if downloaded_size else {}
+
+            response = await self._get_session().get(url, headers=headers)
+            if response.status == 416 and downloaded_size:
+                # Resumed at or past the end: the file is either whole already or not this file
+                response.release()
+                if await self._on_disk(self._finish_if_whole, url, filepath, control, response.headers.get('Content-Range', '')):
+                    return
+                downloaded_size = 0
+                response = await self._get_session().get(url)
+            async with response:
+                # An error page must never be written, hashed and stored as the file
+                response.raise_for_status()
+                resuming = response.status == 206
+                if not resuming:
+                    downloaded_size = 0
+                # A resumed prefix is read back once, on a disk thread
+                sha256 = await self._on_disk(_hash_file_prefix, filepath, downloaded_size) if resuming else hashlib.sha256()
+                total_size = int(response.headers.get('Content-Length', 0)) + downloaded_size
+                counter = {"downloaded": downloaded_size}
+                with self.lock:
+                    self.downloads[url]['total_size'] = total_size
+                    self.downloads[url]['downloaded_size'] = downloaded_size
+                    self._counters[url] = [counter]
+
+                f = await self._on_disk(open, filepath, 'ab' if resuming else 'wb')
+                try:
+                    while True:
+                        chunk = await response.content.read(MAX_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        await control.running.wait_async()
+                        if control.cancelled:
+                            break
+                        await self._on_disk(_write_chunk, f, chunk, sha256)
+                        counter['downloaded'] += len(chunk)
+                        await self._throttle_async(bucket, len(chunk), control)
+                finally:
+                    await self._on_disk(f.close)
+
+            await self._on_disk(self._finish_single, url, filepath, control, sha256.hexdigest())
+
+        except Exception as e:
+            self._fail(url, e)
@@ -1,17 +1,96 @@
 import json
 import os
+import threading
 
 CONFIG_FILE = "config.json"
 
+# The Hyper-V host the manager runs on, managed without remoting
+LOCAL_HOST = "localhost"
+
+# Serializes read-modify-write updates of the config file, e.g. from parallel VM clones
+_config_lock = threading.Lock()
+
 def load_config():
     if os.path.exists(CONFIG_FILE):
         with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
             return json.load(f)
     return {
         "local_image_paths": [],
-        "download_folder": "./downloads"
+        "download_folder": "./downloads",
+        "vhd_parents": {},
+        # Seconds between two VM metrics samples
+        "metrics_interval": 5
     }
 
 def save_config(config):
     with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
         json.dump(config, f, indent=4, ensure_ascii=False)
+
+def _vhd_key(path):
+    # Windows paths are case-insensitive; one spelling per disk
+    return os.path.normcase(os.path.abspath(path))
+
+def record_vhd_parent(child_path, parent_path):
+    """Remembers that child_path is a differencing disk of parent_path."""
+    with _config_lock:
+        config = load_config()
+        config.setdefault("vhd_parents", {})[_vhd_key(child_path)] = _vhd_key(parent_path)
+        save_config(config)
+
+def prune_vhd_parents():
+    """Forgets the recorded differencing disks that no longer exist; returns how many."""
+    with _config_lock:
+        config = load_config()
+        parents = config.get("vhd_parents", {})
+        pruned = {_vhd_key(child): _vhd_key(parent) for child, parent in parents.items() if os.path.exists(child)}
+        removed = len(parents) - len(pruned)
+        if pruned != parents:
+            config["vhd_parents"] = pruned
+            save_config(config)
+        return removed
+
+def get_vhd_chain(path, config=None):
+    """Returns [path, parent, grandparent, ...] as far as the chain was recorded."""
+    parents = (config or load_config()).get("vhd_parents", {})
+    chain = [_vhd_key(path)]
+    while chain[-1] in parents and parents[chain[-1]] not in chain:
+        chain.append(parents[chain[-1]])
+    return chain
+
+def get_vhd_children(parent_path, config=None):
+    """Returns the recorded differencing disks whose parent is parent_path and that still exist."""
+    parent_path = _vhd_key(parent_path)
+    parents = (config or load_config()).get("vhd_parents", {})
+    return [child for child, parent in parents.items() if parent == parent_path and os.path.exists(child)]
+
+
+def get_hosts(config=None):
+    """Returns the registered Hyper-V hosts as {"name", "computer_name"} dicts.
+
+    computer_name is what remoting connects to and defaults to the name. Without
+    any registered host, the list holds only LOCAL_HOST.
+    """
+    hosts = (config or load_config()).get("hosts") or [{"name": LOCAL_HOST}]
+    return [dict(host, computer_name=host.get("computer_name") or host["name"]) for host in hosts]
+
+def get_host(name, config=None):
+    """Returns the registry entry of a host, or None for an unknown name."""
+    for host in get_hosts(config):
+        if host["name"] == name:
+            return host
+    return None
+
+def add_host(name, computer_name=None):
+    """Registers a Hyper-V host, or updates the computer name of a registered one."""
+    with _config_lock:
+        config = load_config()
+        hosts = [host for host in get_hosts(config) if host["name"] != name]
+        hosts.append({"name": name, "computer_name": computer_name or name})
+        config["hosts"] = hosts
+        save_config(config)
+
+def remove_host(name):
+    with _config_lock:
+        config = load_config()
+        config["hosts"] = [host for host in get_hosts(config) if host["name"] != name]
+        save_config(config)
@@ -1,19 +1,214 @@
 import os
 import json
+import heapq
+import atexit
+import shutil
+import hashlib
 import threading
 import time
 import requests
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+
+# Downloads running at the same time; further downloads wait in the queue as 'pending'
+DEFAULT_MAX_CONCURRENT = 2
+# Number of byte ranges fetched in parallel when the server supports range requests
+DEFAULT_SEGMENTS = 4
+# Files smaller than this are downloaded with a single connection
+MIN_SEGMENTED_SIZE = 8 * 1024 * 1024
+# Reads start small and grow while the connection keeps up, so fast links need few
+# iterations per GB while pause and cancel still react within about CHUNK_TARGET_SECONDS
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+CHUNK_TARGET_SECONDS = 0.25
+# Attempts per segment; a retry continues where the broken connection stopped
+SEGMENT_RETRIES = 3
+# Seconds between saves of the segment state while a segmented download runs
+STATE_SAVE_INTERVAL = 2
+# Changes made within this many seconds are written to downloads.json together
+SAVE_DELAY = 1.0
+# Finished files are kept once per content, as downloads_dir/store/<sha256>
+STORE_DIR_NAME = "store"
+HASH_BLOCK_SIZE = 1024 * 1024
+
+class RangeNotSupportedError(Exception):
+    """Raised when a server answers a range request with the whole file."""
+
+def _iter_adaptive_chunks(response):
+    """Yields the body of a streamed response in chunks sized to the connection speed."""
+    chunk_size = MIN_CHUNK_SIZE
+    while True:
+        started = time.monotonic()
+        try:
+            chunk = response.raw.read(chunk_size, decode_content=True)
+        except Urllib3HTTPError as e:
+            # Same exception type iter_content() would raise, so callers can retry on it
+            raise requests.ConnectionError(e)
+        if not chunk:
+            return
+        yield chunk
+        # Includes writing and rate limiting the chunk, so throttled downloads keep small chunks
+        elapsed = time.monotonic() - started
+        if len(chunk) == chunk_size and elapsed < CHUNK_TARGET_SECONDS / 2:
+            chunk_size = min(chunk_size * 2, MAX_CHUNK_SIZE)
+        elif elapsed > CHUNK_TARGET_SECONDS:
+            chunk_size = max(chunk_size // 2, MIN_CHUNK_SIZE)
+
+def _hash_file_prefix(path, length):
+    """Returns a sha256 object fed with the first length bytes of a file."""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while length > 0:
+            block = f.read(min(HASH_BLOCK_SIZE, length))
+            if not block:
+                break
+            sha256.update(block)
+            length -= len(block)
+    return sha256
+
+class _SegmentedHash:
+    """SHA-256 of a file whose segments are written in parallel.
+
+    Chunks that continue the hashed prefix are hashed straight from memory.
+    Data that other segments wrote further ahead is read back (usually from the
+    OS cache) as soon as the prefix reaches it, so the digest is ready when the
+    last segment is.
+    """
+
+    def __init__(self, filepath, segments):
+        self.filepath = filepath
+        self.segments = sorted(segments, key=lambda segment: segment['start'])
+        self.position = 0
+        self._sha256 = hashlib.sha256()
+        self._lock = threading.Lock()
+        self._file = None
+
+    def feed(self, offset, chunk):
+        """Called by a segment worker after chunk was written and counted at offset."""
+        # A worker that finds the hash busy moves on; its data is read back later
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if offset == self.position:
+                self._sha256.update(chunk)
+                self.position += len(chunk)
+            self._catch_up()
+        finally:
+            self._lock.release()
+
+    def _catch_up(self):
+        for segment in self.segments:
+            if not segment['start'] <= self.position <= segment['end']:
+                continue
+            written_end = segment['start'] + segment['downloaded']
+            if written_end <= self.position:
+                return
+            if self._file is None:
+                self._file = open(self.filepath, 'rb')
+            self._file.seek(self.position)
+            while self.position < written_end:
+                block = self._file.read(min(HASH_BLOCK_SIZE, written_end - self.position))
+                if not block:
+                    return
+                self._sha256.update(block)
+                self.position += len(block)
+
+    def hexdigest(self):
+        """Returns the digest of the whole file; call after all segments are done."""
+        with self._lock:
+            self._catch_up()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            return self._sha256.hexdigest()
+
+class _DownloadControl:
+    """Pause and cancel signals that workers check without taking the manager's lock."""
+
+    def __init__(self):
+        self.running = threading.Event()
+        self.running.set()
+        self.cancelled = False
+        self._cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancelled = True
+        self._cancel_event.set()
+        self.running.set()  # A paused worker has to wake up to notice
+
+    def sleep(self, seconds):
+        """Sleeps like time.sleep(), but returns early when the download is cancelled."""
+        self._cancel_event.wait(seconds)
+
+class _TokenBucket:
+    """A token bucket rate limiter in bytes per second; rate None means unlimited.
+
+    reserve() books the bytes right away and returns how long the caller has to
+    wait for them, so a chunk larger than the bucket still gets through.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate
+            self._tokens = 0.0
+            self._updated = time.monotonic()
+
+    def reserve(self, amount):
+        with self._lock:
+            if not self.rate:
+                return 0.0
+            now = time.monotonic()
+            # Idle time builds up a burst of at most one second of traffic
+            self._tokens = min(self._tokens + (now - self._updated) * self.rate, self.rate)
+            self._updated = now
+            self._tokens -= amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
 
 class DownloadManager:
-    def __init__(self, config_dir=".", downloads_dir="downloads"):
+    """Downloads files in the background, at most max_concurrent at a time.
+
+    rate_limit caps the total bandwidth of all downloads in bytes per second.
+    """
+
+    def __init__(self, config_dir=".", downloads_dir="downloads", max_concurrent=DEFAULT_MAX_CONCURRENT, rate_limit=None):
         self.config_dir = config_dir
         self.downloads_dir = downloads_dir
         os.makedirs(self.downloads_dir, exist_ok=True)
         self.downloads_file = os.path.join(self.config_dir, "downloads.json")
-        self.lock = threading.Lock()
+        # Reentrant, because delete_download cancels while holding it
+        self.lock = threading.RLock()
+        # Serializes moving content into the store, which happens without self.lock
+        self._store_lock = threading.Lock()
         self.downloads = self._load_downloads()
         self.threads = {}
-        self.pause_events = {}
+        self.controls = {}
+        # url -> progress counters of the running workers, see _snapshot()
+        self._counters = {}
+        self.max_concurrent = max_concurrent
+        self._global_bucket = _TokenBucket(rate_limit)
+        self._buckets = {}
+        # Heap of (-priority, queued_at, url); entries whose download is no longer pending are skipped
+        self._queue = []
+        self._active = set()
+        for url, d in self.downloads.items():
+            if d.get('status') == 'pending':
+                self.controls[url] = self._new_control()
+                self._enqueue(url)
+        # downloads.json is written behind by a single thread, see _save_downloads()
+        self._save_requested = threading.Event()
+        self._closing = threading.Event()
+        self._write_lock = threading.Lock()
+        self._persister = threading.Thread(target=self._persist_loop, name="downloads-persister")
+        self._persister.daemon = True
+        self._persister.start()
+        atexit.register(self.close)
+        # Downloads that were still queued when the app closed start again
+        self._schedule()
 
     def _load_downloads(self):
         if os.path.exists(self.downloads_file):
@@ -25,58 +220,331 @@ class DownloadManager:
                         if d.get('status') in ['downloading', 'paused']:
                             d['status'] = 'stopped'
                     return data
-            except (json.JSONDecodeError, IOError):
+            except (json.JSONDecodeError, IOError) as e:
+                # Keep the unreadable file for inspection instead of overwriting it on the next save
+                print(f"Error loading {self.downloads_file}: {e}")
+                try:
+                    os.replace(self.downloads_file, self.downloads_file + ".corrupt")
+                except OSError:
+                    pass
                 return {}
         return {}
 
     def _save_downloads(self):
-        with self.lock:
-            with open(self.downloads_file, "w", encoding="utf-8") as f:
-                json.dump(self.downloads, f, indent=4)
+        """Schedules a write of downloads.json; returns at once.
+
+        Requests made within SAVE_DELAY are coalesced into one write, which happens
+        on the persister thread without holding self.lock.
+        """
+        self._save_requested.set()
+
+    def _persist_loop(self):
+        while not self._closing.is_set():
+            self._save_requested.wait()
+            # Give further changes a moment to pile up; close() cuts the wait short
+            self._closing.wait(SAVE_DELAY)
+            self._save_requested.clear()
+            self._write_downloads()
+
+    def _write_downloads(self):
+        # Snapshot under the write lock too, so an older snapshot can never overwrite a newer one
+        with self._write_lock:
+            with self.lock:
+                snapshot = {url: self._snapshot(url, d) for url, d in self.downloads.items()}
+            temp_file = self.downloads_file + ".tmp"
+            try:
+                with open(temp_file, "w", encoding="utf-8") as f:
+                    json.dump(snapshot, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                # Atomic on Windows and POSIX: readers see either the old or the new file
+                os.replace(temp_file, self.downloads_file)
+            except OSError as e:
+                print(f"Error saving {self.downloads_file}: {e}")
+
+    def flush(self):
+        """Writes pending changes to downloads.json now."""
+        if self._save_requested.is_set():
+            self._save_requested.clear()
+            self._write_downloads()
+
+    def close(self):
+        """Stops the persister thread and writes pending changes."""
+        if not self._closing.is_set():
+            self._closing.set()
+            self._save_requested.set()  # wakes the persister for its last write
+            self._persister.join()
+        self.flush()
+
+    def _snapshot(self, url, download):
+        """Returns a copy of a download entry with its workers' current progress (call with self.lock held)."""
+        snapshot = dict(download)
+        if download.get('segments'):
+            snapshot['segments'] = [dict(segment) for segment in download['segments']]
+        counters = self._counters.get(url)
+        if counters:
+            snapshot['downloaded_size'] = sum(counter['downloaded'] for counter in counters)
+            if snapshot['total_size'] > 0:
+                snapshot['progress'] = (snapshot['downloaded_size'] / snapshot['total_size']) * 100
+        return snapshot
 
     def get_all_downloads(self):
         with self.lock:
-            return self.downloads.copy()
+            return {url: self._snapshot(url, d) for url, d in self.downloads.items()}
 
     def get_download_status(self, url):
         with self.lock:
-            return self.downloads.get(url)
+            download = self.downloads.get(url)
+            return self._snapshot(url, download) if download is not None else None
+
+    def start_download(self, url, filename, segments=DEFAULT_SEGMENTS, priority=0, rate_limit=None, sha256=None):
+        """Queues a download; it starts as soon as a download slot is free.
 
-    def start_download(self, url, filename):
+        Downloads with a higher priority start first, equal priorities in the order
+        they were queued. rate_limit caps this download in bytes per second, on top
+        of the manager's global limit. Large files are fetched as `segments` parallel
+        byte ranges when the server supports them; segments=1 always uses a single
+        connection. With a known sha256 the file is verified, and it is not
+        downloaded at all if the store already holds that content.
+        """
         with self.lock:
-            if url in self.threads and self.threads[url].is_alive():
+            if url in self._active:
                 return False, "Download already in progress."
+            previous = self.downloads.get(url) or {}
+            if previous.get('status') == 'pending':
+                return False, "Download already queued."
+            filepath = os.path.join(self.downloads_dir, filename)
+            if previous.get('status') == 'completed' and previous.get('filename') == filename and self._is_shared(filepath):
+                # Verified and linked into the store; downloading it again could only rewrite the stored content
+                return False, "Already downloaded."
 
             self.downloads[url] = {
                 "filename": filename,
-                "status": "downloading",
+                "status": "pending",
                 "progress": 0,
                 "total_size": 0,
                 "downloaded_size": 0,
                 "error_message": None,
-                "cancel_flag": False
+                "cancel_flag": False,
+                "segments": None,
+                "connections": segments,
+                "priority": priority,
+                "rate_limit": rate_limit,
+                "queued_at": time.time(),
+                "sha256": sha256.lower() if sha256 else None
             }
-            self.pause_events[url] = threading.Event()
+            # An interrupted segmented download of the same file continues where its segments stopped
+            if previous.get('segments') and previous.get('filename') == filename and os.path.exists(filepath):
+                self.downloads[url].update(
+                    total_size=previous['total_size'],
+                    downloaded_size=previous['downloaded_size'],
+                    progress=previous['progress'],
+                    segments=previous['segments']
+                )
+            self.controls[url] = self._new_control()
+            self._enqueue(url)
 
-        thread = threading.Thread(target=self._downloader, args=(url,))
+        self._schedule()
+        self._save_downloads()
+        return True, "Download queued."
+
+    def start_image_download(self, image, filename=None, **kwargs):
+        """Queues the download of an online_images_repository.json entry.
+
+        The entry's optional "sha256" field is used to verify the file.
+        """
+        url = image.get("download_url")
+        filename = filename or os.path.basename(requests.utils.urlparse(url).path) or image.get("name")
+        return self.start_download(url, filename, sha256=image.get("sha256"), **kwargs)
+
+    def _store_path(self, sha256):
+        return os.path.join(self.downloads_dir, STORE_DIR_NAME, sha256)
+
+    @staticmethod
+    def _is_shared(filepath):
+        """Whether filepath is a hard link, e.g. into the store."""
+        try:
+            return os.stat(filepath).st_nlink > 1
+        except OSError:
+            return False
+
+    def _detach_from_store(self, filepath):
+        """Removes filepath if it is a hard link, so writing to it can never change stored content."""
+        if self._is_shared(filepath):
+            os.remove(filepath)
+
+    def _resume_offset(self, filepath):
+        """Returns the size a single-connection download of filepath resumes from; 0 to start over."""
+        self._detach_from_store(filepath)
+        return os.path.getsize(filepath) if os.path.exists(filepath) else 0
+
+    def _finish_if_whole(self, url, filepath, control, content_range):
+        """Handles an HTTP 416 answer to a resume, which has no content to trust.
+
+        If filepath already has the full size from the Content-Range header (and the
+        expected SHA-256, when known) the download is finished and True returned.
+        Otherwise the file is removed, so the download can start over.
+        """
+        try:
+            total_size = int(content_range.rsplit('/', 1)[1])
+        except (IndexError, ValueError):
+            total_size = -1
+        whole = os.path.getsize(filepath) == total_size
+        digest = _hash_file_prefix(filepath, total_size).hexdigest() if whole else None
+        with self.lock:
+            expected = self.downloads[url].get('sha256')
+            whole = whole and (not expected or digest == expected)
+            if whole:
+                self.downloads[url]['total_size'] = total_size
+                self._counters[url] = [{"downloaded": total_size}]
+        if not whole:
+            os.remove(filepath)
+            return False
+        self._finish_single(url, filepath, control, digest)
+        return True
+
+    def _link_to(self, source, filepath):
+        """Points filepath at the content of source with a hard link; returns False where the file system has none."""
+        # Linked under a temporary name first, so filepath is never missing or half written
+        temp_path = filepath + ".link"
+        try:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            os.link(source, temp_path)
+        except OSError as e:
+            # FAT/exFAT, network shares, or a store on another volume
+            print(f"Warning: Cannot hard link {filepath} to the download store: {e}")
+            return False
+        os.replace(temp_path, filepath)
+        return True
+
+    def _store_file(self, filepath, digest):
+        """Moves a finished file's content into the store and links it back.
+
+        Returns whether filepath shares its content with the store. Without hard
+        links the file stays where it is and is not stored, so its content is
+        never kept twice. Call it without holding self.lock.
+        """
+        store_path = self._store_path(digest)
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        with self._store_lock:
+            if os.path.exists(store_path):
+                # Same content as an earlier download, e.g. from another mirror: keep one copy
+                return self._link_to(store_path, filepath)
+            try:
+                os.link(filepath, store_path)
+            except OSError as e:
+                print(f"Warning: Cannot hard link {filepath} into the download store: {e}")
+                return False
+            return True
+
+    def _complete(self, url, filepath, digest):
+        """Verifies a finished file and moves its content into the store.
+
+        The file work happens without self.lock, which is only taken to record the
+        outcome, so a large file never blocks the GUI or the other workers.
+        """
+        with self.lock:
+            download = self.downloads.get(url)
+            if download is None:
+                # Deleted while it finished
+                return
+            expected = download.get('sha256')
+        if expected and digest != expected:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            with self.lock:
+                # A corrupt file is useless for resuming too, the next start begins from scratch
+                download['status'] = 'error'
+                download['error_message'] = f"SHA-256 mismatch: expected {expected}, got {digest}."
+                download['segments'] = None
+            return
+        try:
+            linked = self._store_file(filepath, digest)
+        except OSError as e:
+            with self.lock:
+                download.update(status='error', error_message=str(e))
+            return
+        with self.lock:
+            # linked False: the file system has no hard links, the file is not shared with the store
+            download.update(status='completed', progress=100, segments=None, sha256=digest, linked=linked)
+
+    def _enqueue(self, url):
+        download = self.downloads[url]
+        heapq.heappush(self._queue, (-download.get('priority', 0), download.get('queued_at', 0), url))
+
+    def _schedule(self):
+        """Starts queued downloads while there are free slots."""
+        with self.lock:
+            while len(self._active) < self.max_concurrent and self._queue:
+                _, _, url = heapq.heappop(self._queue)
+                download = self.downloads.get(url)
+                if download is None or download['status'] != 'pending' or url in self._active:
+                    continue
+                download['status'] = 'downloading'
+                self._active.add(url)
+                self._buckets[url] = _TokenBucket(download.get('rate_limit'))
+                self._launch(url, download.get('connections', DEFAULT_SEGMENTS))
+                self._save_downloads()
+
+    def _new_control(self):
+        """Pause and cancel signals for one download; engines other than threads override this."""
+        return _DownloadControl()
+
+    def _launch(self, url, segments):
+        """Runs a download that got a slot; engines other than threads override this."""
+        thread = threading.Thread(target=self._run_slot, args=(url, segments))
         thread.daemon = True
         self.threads[url] = thread
         thread.start()
-        self._save_downloads()
-        return True, "Download started."
+
+    def _release_slot(self, url):
+        with self.lock:
+            self._active.discard(url)
+            self._buckets.pop(url, None)
+        self._schedule()
+
+    def _run_slot(self, url, segments):
+        try:
+            self._run_download(url, segments)
+        finally:
+            self._release_slot(url)
+
+    def set_max_concurrent(self, max_concurrent):
+        """Changes the number of download slots; extra queued downloads start at once."""
+        with self.lock:
+            self.max_concurrent = max_concurrent
+        self._schedule()
+
+    def set_rate_limit(self, rate_limit, url=None):
+        """Sets the global limit, or the limit of one download, in bytes per second (None = unlimited)."""
+        with self.lock:
+            if url is None:
+                self._global_bucket.set_rate(rate_limit)
+                return
+            if url in self.downloads:
+                self.downloads[url]['rate_limit'] = rate_limit
+                if url in self._buckets:
+                    self._buckets[url].set_rate(rate_limit)
+                self._save_downloads()
+
+    def _throttle(self, bucket, amount, control):
+        delay = max(self._global_bucket.reserve(amount), bucket.reserve(amount))
+        if delay > 0:
+            control.sleep(delay)
 
     def pause_download(self, url):
         with self.lock:
-            if url in self.pause_events:
-                self.pause_events[url].set() # Set event to cause wait()
-                if self.downloads[url]['status'] == 'downloading':
-                    self.downloads[url]['status'] = 'paused'
-                    self._save_downloads()
+            # Queued downloads are not paused, they can be cancelled instead
+            if url in self.controls and self.downloads[url]['status'] == 'downloading':
+                self.controls[url].running.clear() # Workers block until resumed
+                self.downloads[url]['status'] = 'paused'
+                self._save_downloads()
 
     def resume_download(self, url):
         with self.lock:
-            if url in self.pause_events:
-                self.pause_events[url].clear() # Clear event to allow loop to continue
+            if url in self.controls:
+                self.controls[url].running.set()
                 if self.downloads[url]['status'] == 'paused':
                     self.downloads[url]['status'] = 'downloading'
                     self._save_downloads()
@@ -85,9 +553,12 @@ class DownloadManager:
         with self.lock:
             if url in self.downloads:
                 self.downloads[url]['cancel_flag'] = True
-                # If paused, unpause it so it can check the cancel flag and exit
-                if url in self.pause_events:
-                    self.pause_events[url].clear()
+                if url in self.controls:
+                    self.controls[url].cancel()
+                # A queued download never started, so nobody else marks it stopped
+                if self.downloads[url]['status'] == 'pending':
+                    self.downloads[url]['status'] = 'stopped'
+                    self._save_downloads()
 
     def delete_download(self, url):
         with self.lock:
@@ -99,65 +570,297 @@ class DownloadManager:
                         os.remove(filepath)
                     except OSError as e:
                         print(f"Error deleting file {filepath}: {e}")
+                # Drop the stored content once no other download links to it
+                sha256 = self.downloads[url].get('sha256')
+                if self.downloads[url]['status'] == 'completed' and sha256:
+                    store_path = self._store_path(sha256)
+                    try:
+                        if os.stat(store_path).st_nlink == 1:
+                            os.remove(store_path)
+                    except OSError:
+                        pass
                 del self.downloads[url]
                 if url in self.threads:
                     del self.threads[url]
-                if url in self.pause_events:
-                    del self.pause_events[url]
+                if url in self.controls:
+                    del self.controls[url]
+                self._counters.pop(url, None)
                 self._save_downloads()
 
+    def _settle_progress(self, url):
+        """Copies the workers' counters into the download entry and drops them (call with self.lock held)."""
+        counters = self._counters.pop(url, None)
+        download = self.downloads.get(url)
+        if counters and download is not None:
+            download['downloaded_size'] = sum(counter['downloaded'] for counter in counters)
+            if download['total_size'] > 0:
+                download['progress'] = (download['downloaded_size'] / download['total_size']) * 100
+
+    def _probe_range_support(self, url):
+        """Returns (final_url, total_size) if the server supports byte ranges, else (url, 0)."""
+        response = requests.head(url, allow_redirects=True, timeout=30)
+        response.close()
+        if response.status_code != 200 or response.headers.get('accept-ranges', '').lower() != 'bytes':
+            return url, 0
+        # Segments go straight to the mirror the URL redirects to
+        return response.url, int(response.headers.get('content-length', 0))
+
+    def _plan_segments(self, url, total_size, segments):
+        filepath = os.path.join(self.downloads_dir, self.downloads[url]['filename'])
+        # Truncating a file that is linked into the store would empty the stored copy too
+        self._detach_from_store(filepath)
+        # Preallocate the file, so every segment can write at its own offset
+        with open(filepath, 'wb') as f:
+            f.truncate(total_size)
+        segment_size = -(-total_size // segments)
+        with self.lock:
+            self.downloads[url].update(
+                total_size=total_size,
+                downloaded_size=0,
+                progress=0,
+                segments=[{"start": start, "end": min(start + segment_size, total_size) - 1, "downloaded": 0}
+                          for start in range(0, total_size, segment_size)]
+            )
+        self._save_downloads()
+
+    def _fail(self, url, error):
+        with self.lock:
+            self._settle_progress(url)
+            self.downloads[url]['status'] = 'error'
+            self.downloads[url]['error_message'] = str(error)
+            self._save_downloads()
+
+    def _complete_from_store(self, url):
+        """Finishes the download without any transfer if the store already has its content."""
+        with self.lock:
+            download = self.downloads[url]
+            sha256 = download.get('sha256')
+            filepath = os.path.join(self.downloads_dir, download['filename'])
+        if not sha256 or not os.path.exists(self._store_path(sha256)):
+            return False
+        # The content was downloaded before, possibly from another mirror
+        store_path = self._store_path(sha256)
+        try:
+            # Checked before it is handed out: a damaged object would spread to every later download
+            if _hash_file_prefix(store_path, os.path.getsize(store_path)).hexdigest() != sha256:
+                print(f"Warning: Dropping {store_path} from the download store, its content does not match its SHA-256")
+                os.remove(store_path)
+                return False
+        except OSError:
+            return False
+        try:
+            linked = self._link_to(store_path, filepath)
+            if not linked:
+                # Still cheaper than downloading it again, but the content is now kept twice
+                shutil.copyfile(store_path, filepath)
+            size = os.path.getsize(store_path)
+            outcome = dict(status='completed', progress=100, total_size=size, downloaded_size=size, segments=None, linked=linked)
+        except OSError as e:
+            outcome = dict(status='error', error_message=str(e))
+        with self.lock:
+            download.update(outcome)
+        self._save_downloads()
+        return True
+
+    def _resumable_size(self, url):
+        """Returns the size recorded by the saved segments of an interrupted download, or 0."""
+        with self.lock:
+            return self.downloads[url]['total_size'] if self.downloads[url].get('segments') else 0
+
+    def _prepare_segments(self, url, segments, previous_size, total_size):
+        """Keeps, drops or creates the segment plan once the server's answer to the probe is known."""
+        if previous_size and total_size != previous_size:
+            # The file changed on the server, the saved segments are useless
+            with self.lock:
+                self.downloads[url].update(segments=None, downloaded_size=0, progress=0)
+                filepath = os.path.join(self.downloads_dir, self.downloads[url]['filename'])
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+            previous_size = 0
+        if not previous_size and segments > 1 and total_size >= MIN_SEGMENTED_SIZE:
+            self._plan_segments(url, total_size, segments)
+
+    def _run_download(self, url, segments):
+        if self._complete_from_store(url):
+            return
+        try:
+            previous_size = self._resumable_size(url)
+            source_url, total_size = self._probe_range_support(url) if segments > 1 or previous_size else (url, 0)
+            self._prepare_segments(url, segments, previous_size, total_size)
+        except Exception as e:
+            self._fail(url, e)
+            return
+        if self.downloads[url].get('segments'):
+            self._segmented_downloader(url, source_url)
+        else:
+            self._downloader(url)
+
+    def _segment_worker(self, source_url, filepath, segment, control, bucket, hasher, abort, errors):
+        """Fetches the rest of one segment into its place in the preallocated file.
+
+        The segment dict doubles as the worker's progress counter: only this worker
+        writes segment['downloaded'], readers just sample it.
+        """
+        last_error = None
+        for attempt in range(SEGMENT_RETRIES):
+            offset = segment['start'] + segment['downloaded']
+            if offset > segment['end']:
+                return
+            try:
+                headers = {'Range': f"bytes={offset}-{segment['end']}"}
+                with requests.get(source_url, headers=headers, stream=True, timeout=30) as response:
+                    if response.status_code != 206:
+                        raise RangeNotSupportedError(f"Server answered a range request with HTTP {response.status_code}.")
+                    with open(filepath, 'r+b') as f:
+                        f.seek(offset)
+                        for chunk in _iter_adaptive_chunks(response):
+                            control.running.wait()
+                            if abort.is_set() or control.cancelled:
+                                return
+                            # Never write past the segment, even if the server sends more
+                            chunk = chunk[:segment['end'] + 1 - offset]
+                            if chunk:
+                                f.write(chunk)
+                                # Flushed before it is counted, so the hasher can read it back
+                                f.flush()
+                                segment['downloaded'] = offset + len(chunk) - segment['start']
+                                hasher.feed(offset, chunk)
+                                offset += len(chunk)
+                                self._throttle(bucket, len(chunk), control)
+                if offset > segment['end']:
+                    return
+                last_error = "Connection closed before the segment was complete."
+            except RangeNotSupportedError as e:
+                errors.append(e)
+                abort.set()
+                return
+            except requests.RequestException as e:
+                last_error = e
+            except OSError as e:
+                errors.append(e)
+                abort.set()
+                return
+        errors.append(last_error)
+        abort.set()
+
+    def _start_segments(self, url):
+        """Returns (filepath, control, bucket, hasher, unfinished segments) for a segmented download."""
+        with self.lock:
+            download = self.downloads[url]
+            filepath = os.path.join(self.downloads_dir, download['filename'])
+            self._counters[url] = download['segments']
+            pending = [segment for segment in download['segments']
+                       if segment['start'] + segment['downloaded'] <= segment['end']]
+            return filepath, self.controls[url], self._buckets[url], _SegmentedHash(filepath, download['segments']), pending
+
+    def _segmented_downloader(self, url, source_url):
+        abort = threading.Event()
+        errors = []
+        filepath, control, bucket, hasher, pending = self._start_segments(url)
+        threads = [threading.Thread(target=self._segment_worker, args=(source_url, filepath, segment, control, bucket, hasher, abort, errors))
+                   for segment in pending]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # Persist the per-segment progress regularly, so an interrupted download can resume
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(STATE_SAVE_INTERVAL)
+                self._save_downloads()
+
+        digest = hasher.hexdigest() if not (errors or control.cancelled) else None
+        if self._finish_segmented(url, filepath, control, errors, digest):
+            self._downloader(url)
+
+    def _finish_segmented(self, url, filepath, control, errors, digest):
+        """Records the outcome of a segmented download; returns True to retry it with one connection."""
+        fall_back = False
+        complete = False
+        with self.lock:
+            self._settle_progress(url)
+            download = self.downloads[url]
+            if control.cancelled:
+                download['status'] = 'stopped'
+                download['segments'] = None
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+            elif any(isinstance(e, RangeNotSupportedError) for e in errors):
+                # Start over with a single connection; the partial file cannot be trusted
+                fall_back = True
+                download.update(segments=None, downloaded_size=0, progress=0)
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+            elif errors:
+                # The segments are kept, so starting the download again resumes it
+                download['status'] = 'error'
+                download['error_message'] = str(errors[0])
+            else:
+                complete = True
+        if complete:
+            self._complete(url, filepath, digest)
+        self._save_downloads()
+        return fall_back
+
     def _downloader(self, url):
         try:
-            filepath = os.path.join(self.downloads_dir, self.downloads[url]['filename'])
-            downloaded_size = 0
-            headers = {}
-            if os.path.exists(filepath):
-                downloaded_size = os.path.getsize(filepath)
-                headers['Range'] = f'bytes={downloaded_size}-'
+            with self.lock:
+                filepath = os.path.join(self.downloads_dir, self.downloads[url]['filename'])
+                control = self.controls[url]
+                bucket = self._buckets[url]
+            downloaded_size = self._resume_offset(filepath)
+            headers = {'Range': f'bytes={downloaded_size}-'} if downloaded_size else {}
 
             response = requests.get(url, headers=headers, stream=True, timeout=30)
+            if response.status_code == 416 and downloaded_size:
+                # Resumed at or past the end: the file is either whole already or not this file
+                response.close()
+                if self._finish_if_whole(url, filepath, control, response.headers.get('content-range', '')):
+                    return
+                downloaded_size = 0
+                response = requests.get(url, stream=True, timeout=30)
+            if not response.ok:
+                # An error page must never be written, hashed and stored as the file
+                response.close()
+                response.raise_for_status()
             resuming = response.status_code == 206
             if not resuming:
                 downloaded_size = 0
+            # Hashed as the chunks arrive; only a resumed prefix is read back once
+            sha256 = _hash_file_prefix(filepath, downloaded_size) if resuming else hashlib.sha256()
 
             total_size = int(response.headers.get('content-length', 0)) + downloaded_size
-            
+            # Only this thread writes the counter; readers sample it through _snapshot()
+            counter = {"downloaded": downloaded_size}
             with self.lock:
                 self.downloads[url]['total_size'] = total_size
                 self.downloads[url]['downloaded_size'] = downloaded_size
+                self._counters[url] = [counter]
 
             mode = 'ab' if resuming else 'wb'
-            with open(filepath, mode) as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if self.downloads[url].get('cancel_flag'):
+            with response, open(filepath, mode) as f:
+                for chunk in _iter_adaptive_chunks(response):
+                    control.running.wait()
+                    if control.cancelled:
                         break
-                    
-                    if url in self.pause_events and self.pause_events[url].is_set():
-                        self.pause_events[url].wait()
-
-                    if chunk:
-                        f.write(chunk)
-                        downloaded_size += len(chunk)
-                        with self.lock:
-                            self.downloads[url]['downloaded_size'] = downloaded_size
-                            if total_size > 0:
-                                self.downloads[url]['progress'] = (downloaded_size / total_size) * 100
+                    f.write(chunk)
+                    sha256.update(chunk)
+                    counter['downloaded'] += len(chunk)
+                    self._throttle(bucket, len(chunk), control)
             
-            with self.lock:
-                if self.downloads[url].get('cancel_flag'):
-                    self.downloads[url]['status'] = 'stopped'
-                    # Clean up the partial file
-                    f.close()
-                    if os.path.exists(filepath):
-                        os.remove(filepath)
-                    # We don't save here, delete_download will handle it
-                else:
-                    self.downloads[url]['status'] = 'completed'
-                    self.downloads[url]['progress'] = 100
-                self._save_downloads()
+            self._finish_single(url, filepath, control, sha256.hexdigest())
 
         except Exception as e:
-            with self.lock:
-                self.downloads[url]['status'] = 'error'
-                self.downloads[url]['error_message'] = str(e)
-                self._save_downloads()
\ No newline at end of file
+            self._fail(url, e)
+
+    def _finish_single(self, url, filepath, control, digest):
+        with self.lock:
+            self._settle_progress(url)
+            cancelled = control.cancelled
+            if cancelled:
+                self.downloads[url]['status'] = 'stopped'
+                # Clean up the partial file
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+        if not cancelled:
+            self._complete(url, filepath, digest)
+        self._save_downloads()
@@ -0,0 +1,271 @@
+import atexit
+import hashlib
+import hmac
+import json
+import os
+import re
+import threading
+import time
+from powershell_host import PowerShellHost, PowerShellHostError
+
+# Seconds a guest session may stay unused before it is closed
+IDLE_TIMEOUT = 300
+# VMs one command runs in at the same time (Invoke-Command -ThrottleLimit)
+THROTTLE_LIMIT = 32
+
+# Runs a command in several VMs through the PowerShell Direct sessions kept in
+# $global:GuestSessions, opening the missing ones. Every line the guests write is
+# sent back as soon as it arrives, as one {"vm", "kind", "text"} JSON object:
+# kind "out" for an output line, then "ok" or "error" once per VM, or "failed"
+# when no session could be opened.
+_GUEST_SCRIPT = r"""
+$ErrorActionPreference = 'Stop'
+if ($null -eq $global:GuestSessions) { $global:GuestSessions = @{} }
+function Send-GuestRecord($vm, $kind, $text) {
+    ConvertTo-Json -Compress -InputObject @{ vm = [string]$vm; kind = [string]$kind; text = [string]$text }
+}
+@@EVICT@@
+$user = @@USER@@
+$credentialId = @@CREDENTIAL_ID@@
+$sessions = @()
+$missing = @()
+foreach ($vm in @(@@VMS@@)) {
+    $key = "$vm|$user"
+    $entry = $global:GuestSessions[$key]
+    if ($entry -and $entry.CredentialId -ne $credentialId) {
+        # Opened with another password: never let a different credential ride on it
+        Remove-PSSession $entry.Session -ErrorAction SilentlyContinue
+        $global:GuestSessions.Remove($key)
+        $entry = $null
+    }
+    if ($entry) {
+        $entry.LastUsed = Get-Date
+        $sessions += $entry.Session
+    } else {
+        $missing += $vm
+    }
+}
+if ($missing.Count -gt 0) {
+    $opened = @{}
+    $openErrors = @()
+    try {
+        $cred = New-Object System.Management.Automation.PSCredential($user, (@@PASSWORD@@ | ConvertTo-SecureString -AsPlainText -Force))
+        # One call logs on to every missing VM at the same time
+        foreach ($session in @(New-PSSession -VMName $missing -Credential $cred -ErrorAction SilentlyContinue -ErrorVariable openErrors)) {
+            $opened[$session.VMName] = $session
+        }
+    } catch {
+        $openErrors = @($_)
+    }
+    foreach ($vm in $missing) {
+        $session = $opened[$vm]
+        if (-not $session) {
+            $reason = @($openErrors | Where-Object { "$($_.TargetObject)" -eq $vm }) + @($openErrors) | Select-Object -First 1
+            Send-GuestRecord $vm 'failed' $(if ($reason) { $reason.Exception.Message } else { 'No session could be opened' })
+            continue
+        }
+        try {
+            # Lets the guest tag its output lines with the VM name
+            Invoke-Command -Session $session -ScriptBlock { param($name) $global:GuestVMName = $name } -ArgumentList $vm
+        } catch {
+            Remove-PSSession $session -ErrorAction SilentlyContinue
+            Send-GuestRecord $vm 'failed' $_.Exception.Message
+            continue
+        }
+        $global:GuestSessions["$vm|$user"] = @{ Session = $session; CredentialId = $credentialId; LastUsed = Get-Date }
+        $sessions += $session
+    }
+}
+if ($sessions.Count -gt 0) {
+    Invoke-Command -Session $sessions -ThrottleLimit @@THROTTLE@@ -ErrorAction Continue -ArgumentList @@COMMAND@@ -ScriptBlock {
+        param($command)
+        $ErrorActionPreference = 'Stop'
+        try {
+            & ([ScriptBlock]::Create($command)) | Out-String -Stream -Width 4096 | ForEach-Object { "$global:GuestVMName`tout`t$_" }
+            "$global:GuestVMName`tok`t"
+        } catch {
+            "$global:GuestVMName`terror`t$($_.Exception.Message)"
+        }
+    } | ForEach-Object {
+        $vm, $kind, $text = ([string]$_).Split("`t", 3)
+        Send-GuestRecord $vm $kind $text
+    }
+}
+"""
+
+# Closes the sessions that broke or stayed unused for longer than the idle timeout
+_EVICT_SCRIPT = r"""
+if ($null -ne $global:GuestSessions) {
+    foreach ($key in @($global:GuestSessions.Keys)) {
+        $entry = $global:GuestSessions[$key]
+        if ($entry.Session.State -ne 'Opened' -or ((Get-Date) - $entry.LastUsed).TotalSeconds -gt @@IDLE@@) {
+            Remove-PSSession $entry.Session -ErrorAction SilentlyContinue
+            $global:GuestSessions.Remove($key)
+        }
+    }
+}
+"""
+
+
+def _ps_quote(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _fill(template, **values):
+    # One pass, so a value that happens to contain "@@NAME@@" is left alone
+    return re.sub(r"@@(\w+)@@", lambda match: values[match.group(1)], template)
+
+
+class GuestSessionPool:
+    """Reusable PowerShell Direct sessions into the VMs of one Hyper-V host.
+
+    Sessions are opened with New-PSSession -VMName on first use, all missing VMs
+    of a command at once, and kept, keyed by (VM name, user name), in a PowerShell
+    host of their own, so later commands skip both the PowerShell start-up and the
+    guest logon. A session is only reused with the password it was opened with;
+    another password closes it and logs on again. A background thread closes
+    sessions that stayed unused for idle_timeout seconds. computer_name is the
+    Hyper-V host (see PowerShellHost); None is the local one. Cancelling a command
+    kills the host and with it every open session.
+    """
+
+    def __init__(self, computer_name=None, idle_timeout=IDLE_TIMEOUT, throttle_limit=THROTTLE_LIMIT):
+        self.computer_name = computer_name
+        self.idle_timeout = idle_timeout
+        self.throttle_limit = throttle_limit
+        self._host = PowerShellHost(computer_name=computer_name)
+        self._lock = threading.Lock()
+        # (vm_name, user) -> time.monotonic() of the last command, mirroring the open sessions
+        self._last_used = {}
+        self._closed = threading.Event()
+        self._reaper = None
+        # Keys the credential fingerprints, so the host never sees a plain hash of a password
+        self._secret = os.urandom(32)
+
+    def sessions(self):
+        """Returns the (vm_name, user) keys of the sessions believed to be open."""
+        with self._lock:
+            return list(self._last_used)
+
+    def _credential_id(self, username, password):
+        return hmac.new(self._secret, f"{username}\0{password}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def run(self, vm_names, username, password, command, on_output=None, timeout=None, cancel_token=None):
+        """Runs command in every VM at the same time; returns {vm_name: (success, output)}.
+
+        Output lines are passed to on_output(vm_name, line) as they arrive; without
+        on_output they are collected and returned as each VM's output. A failed VM
+        has the error message as its output. timeout is the longest wait for the
+        next line. Raises PowerShellHostError if the host fails, times out or is cancelled.
+        """
+        vm_names = list(dict.fromkeys(vm_names))
+        if not vm_names:
+            return {}
+        outcome = {}
+        opened = set()
+        failed = set()
+        lines = {vm_name: [] for vm_name in vm_names}
+
+        def handle(text):
+            try:
+                record = json.loads(text)
+            except ValueError:
+                return
+            vm_name = record.get("vm")
+            if vm_name not in lines:
+                return
+            kind = record.get("kind")
+            if kind == "out":
+                if on_output is not None:
+                    on_output(vm_name, record.get("text", ""))
+                else:
+                    lines[vm_name].append(record.get("text", ""))
+            elif kind in ("ok", "error", "failed"):
+                outcome[vm_name] = (kind == "ok", record.get("text", ""))
+                (failed if kind == "failed" else opened).add(vm_name)
+
+        script = _fill(_GUEST_SCRIPT,
+                       EVICT=_fill(_EVICT_SCRIPT, IDLE=str(self.idle_timeout)),
+                       USER=_ps_quote(username),
+                       CREDENTIAL_ID=_ps_quote(self._credential_id(username, password)),
+                       PASSWORD=_ps_quote(password),
+                       VMS=", ".join(_ps_quote(vm_name) for vm_name in vm_names),
+                       THROTTLE=str(self.throttle_limit),
+                       COMMAND=_ps_quote(command))
+        started = time.monotonic()
+        try:
+            _, _, stderr = self._host.run(script, timeout=timeout, cancel_token=cancel_token, on_output=handle)
+        except PowerShellHostError:
+            # The host is gone, and with it every session
+            with self._lock:
+                self._last_used.clear()
+            raise
+        with self._lock:
+            for vm_name in opened:
+                self._last_used[(vm_name, username)] = started
+            # A failed logon also closed the session the VM had with another password
+            for vm_name in failed:
+                self._last_used.pop((vm_name, username), None)
+        self._start_reaper()
+        results = {}
+        for vm_name in vm_names:
+            success, message = outcome.get(vm_name, (False, stderr.strip() or "No result returned"))
+            results[vm_name] = (True, "\n".join(lines[vm_name])) if success else (False, message)
+        return results
+
+    def evict_idle(self):
+        """Closes the sessions that stayed unused for longer than idle_timeout."""
+        deadline = time.monotonic() - self.idle_timeout
+        with self._lock:
+            if self._closed.is_set() or not any(last_used < deadline for last_used in self._last_used.values()):
+                return
+        try:
+            # Streamed like the commands, so it runs in the runspace that holds the sessions
+            self._host.run(_fill(_EVICT_SCRIPT, IDLE=str(self.idle_timeout)), timeout=60, on_output=lambda text: None)
+        except PowerShellHostError:
+            with self._lock:
+                self._last_used.clear()
+            return
+        with self._lock:
+            for key in [key for key, last_used in self._last_used.items() if last_used < deadline]:
+                del self._last_used[key]
+
+    def _start_reaper(self):
+        with self._lock:
+            if self._reaper is not None or not self._last_used:
+                return
+            self._reaper = threading.Thread(target=self._reap, name="guest-session-reaper")
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    def _reap(self):
+        while not self._closed.wait(max(1.0, self.idle_timeout / 2)):
+            self.evict_idle()
+
+    def close(self):
+        """Closes every session by stopping the host."""
+        self._closed.set()
+        with self._lock:
+            self._last_used.clear()
+        self._host.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_guest_pool(computer_name=None):
+    """Returns the guest session pool of a Hyper-V host, creating it on first use."""
+    with _pools_lock:
+        pool = _pools.get(computer_name)
+        if pool is None:
+            pool = _pools[computer_name] = GuestSessionPool(computer_name)
+            atexit.register(pool.close)
+        return pool
+
+
+def close_guest_pool(computer_name=None):
+    with _pools_lock:
+        pool = _pools.pop(computer_name, None)
+    if pool is not None:
+        pool.close()
@@ -4,79 +4,468 @@ import os
 import webbrowser
 import time
 import json
+import functools
 from powershell_utils import (
     get_vms_data, start_vm, shutdown_vm, stop_vm, delete_vm, connect_vm,
     check_hyperv_status, install_hyperv, get_vswitches, 
     remove_vswitch, get_network_adapters, create_vswitch, 
-    get_nat_networks, get_nat_rules, add_nat_rule, remove_nat_rule, 
-    get_online_images, get_local_images, create_new_vm,
+    get_nat_networks, get_nat_rules, add_nat_rule, 
+    get_online_images, create_new_vm,
     set_vswitch_ip, create_nat_network, get_vswitch_ip_addresses,
     get_vm_network_adapters, connect_vm_to_switch, disconnect_vm_from_switch,
-    get_vm_network_adapter_status, invoke_command_in_vm
+    get_vm_network_adapter_status, invoke_command_in_vms, poll_vm_inventory,
+    run_parallel, run_query, run_bulk_on_hosts, iter_host_results, invalidate_cache, get_host_names,
+    start_vms, shutdown_vms, stop_vms, delete_vms, create_vms_from_template,
+    get_network_state, apply_network_changes
 )
+from config import load_config, get_vhd_chain, get_vhd_children, LOCAL_HOST
+from vm_metrics import MetricsSampler, DEFAULT_INTERVAL as DEFAULT_METRICS_INTERVAL
 from download_manager import DownloadManager
+from vm_watcher import VMStateWatcher
+from table_sync import sync_table, patch_table, append_table_rows, get_selected_keys
+from task_dispatcher import TaskDispatcher, TASK_DONE_EVENT
+from image_index import ImageScanner, format_size
+from network_state import (
+    load_network_spec, save_network_spec, plan_network, network_spec_from_state, format_change,
+    NatRuleIndex, read_nat_rules, write_nat_rules, load_nat_index, plan_nat_import, plan_nat_removal
+)
+
+# Seconds a background query may run before it is abandoned
+QUERY_TIMEOUT = 60
+# Enabling the Hyper-V feature can take far longer than a query
+INSTALL_TIMEOUT = 1800
+# Maximum number of PowerShell batches used by bulk VM actions
+BULK_VM_CONCURRENCY = 3
+# Posted by the VMStateWatcher when VMs change state
+VM_CHANGES_EVENT = "-VM_ROWS_CHANGED-"
+# Posted by the MetricsSampler after every sample
+VM_METRICS_EVENT = "-VM_METRICS-"
+# Samples shown in the CPU column of the VM table
+CPU_TREND_WIDTH = 12
+# VM table rows are keyed by (host, VM name): the same name may exist on several hosts
+VM_TABLE_KEY = (0, 1)
+# NAT rule rows are keyed by (protocol, external port), as NAT keeps them unique
+NAT_RULE_TABLE_KEY = (0, 1)
+# Posted by the ImageScanner for every batch of local images it finds
+LOCAL_IMAGES_EVENT = "-LOCAL_IMAGES_FOUND-"
 
 # --- UI Helper Functions ---
 
-def refresh_vm_table(window):
-    if not window or window.was_closed(): return
-    state_map = {
-        2: "正在运行", 3: "已关闭", 4: "正在运行", 5: "正在暂停", 6: "正在保存",
-        8: "已暂停", 9: "已保存", 10: "正在停止", 11: "正在重置"
-    }
-    vms = get_vms_data()
-    vm_data = []
-    if vms:
-        for vm in vms:
-            net_status = "未知"
-            adapters_status = get_vm_network_adapter_status(vm.get('Name'))
-            if not adapters_status:
-                net_status = "无网卡"
-            else:
-                is_connected = any(ad.get('SwitchName') for ad in adapters_status)
-                has_error = any(ad.get('Status') != 'Ok' for ad in adapters_status)
-                if has_error:
-                    net_status = "状态异常"
-                elif is_connected:
-                    net_status = "已连接"
-                else:
-                    net_status = "未连接"
-            state_code = vm.get('State', 0)
-            state_text = state_map.get(state_code, f"未知({state_code})")
-            os_text = vm.get('GuestOS') or "未知"
-            vm_data.append([
-                vm.get('Name', 'N/A'), state_text, net_status, os_text,
-                ", ".join(vm.get('IPAddresses') if isinstance(vm.get('IPAddresses'), list) else [])
-            ])
-    window["-VM_TABLE-"].update(values=vm_data)
-    for key in ["-START_VM-", "-SHUTDOWN_VM-", "-STOP_VM-", "-DELETE_VM-", "-CONNECT_VM-", "-CONFIG_VM_NET-", "-EXEC_COMMAND-"]:
-        window[key].update(disabled=True)
-
-def refresh_vswitch_table(window):
+def get_network_status_text(adapters_status):
+    if not adapters_status:
+        return "无网卡"
+    is_connected = any(ad.switch_name for ad in adapters_status)
+    has_error = any(ad.status != 'Ok' for ad in adapters_status)
+    if has_error:
+        return "状态异常"
+    if is_connected:
+        return "已连接"
+    return "未连接"
+
+VM_STATE_MAP = {
+    2: "正在运行", 3: "已关闭", 4: "正在运行", 5: "正在暂停", 6: "正在保存",
+    8: "已暂停", 9: "已保存", 10: "正在停止", 11: "正在重置"
+}
+
+def build_vm_row(vm, cpu_trend=""):
+    net_status = get_network_status_text(vm.adapters)
+    state_text = VM_STATE_MAP.get(vm.state, f"未知({vm.state})")
+    os_text = vm.guest_os or "未知"
+    return [vm.host or LOCAL_HOST, vm.name or 'N/A', state_text, net_status, os_text, ", ".join(vm.ip_addresses), cpu_trend]
+
+def build_vm_rows(table, vms):
+    # The CPU column is filled by the metrics sampler; keep what it last showed
+    cpu_trends = {(row[0], row[1]): row[6] for row in table.Values or []}
+    return [build_vm_row(vm, cpu_trends.get((vm.host or LOCAL_HOST, vm.name), "")) for vm in vms]
+
+def show_vm_metrics(window, sampler, latest):
+    """Updates the CPU column of the VM table from the newest metrics sample of a host."""
+    table = window["-VM_TABLE-"]
+    rows = [list(row) for row in table.Values or []]
+    for row in rows:
+        key = (row[0], row[1])
+        if key in latest:
+            trend = sampler.sparkline(row[1], "cpu", width=CPU_TREND_WIDTH, maximum=100, host=row[0])
+            row[6] = f"{trend} {latest[key]['cpu']:.0f}%"
+    sync_table(table, rows, key_column=VM_TABLE_KEY)
+
+def is_view_active(window, view_name):
+    return window.metadata.get("view") == view_name
+
+def task_succeeded(task):
+    """Reports a task that raised; returns False for failed and cancelled tasks."""
+    if task.cancelled:
+        return False
+    if task.error:
+        sg.popup_error(f"{task.description}失败: {task.error}")
+        return False
+    return True
+
+def update_task_status(window, dispatcher, tick=0):
+    """Shows the running background tasks in the status bar."""
+    tasks = dispatcher.running_tasks()
+    if tasks:
+        text = f"正在{tasks[0].description}..."
+        progress = tasks[0].progress
+        if progress is not None and progress.percent >= 0:
+            text += f" {progress.percent}%"
+            count = progress.percent
+        else:
+            # Without progress records the bar just keeps moving while the task runs
+            count = tick % 20 * 5
+        if len(tasks) > 1:
+            text += f" (共 {len(tasks)} 个任务)"
+        window["-TASK_STATUS-"].update(text)
+        window["-TASK_PROGRESS-"].update(current_count=count, visible=True)
+        window["-TASK_CANCEL-"].update(visible=True)
+    else:
+        window["-TASK_STATUS-"].update("就绪")
+        window["-TASK_PROGRESS-"].update(current_count=0, visible=False)
+        window["-TASK_CANCEL-"].update(visible=False)
+
+def start_local_image_scan(window, scanner, scan_path):
+    # Several folders can be scanned at once, separated by ";"
+    roots = [path.strip() for path in scan_path.split(";") if path.strip()]
+    if not roots:
+        sg.popup_error("请先选择要扫描的文件夹。")
+        return
+    window["-LOCAL_IMG_TABLE-"].update(values=[])
+    window["-SCAN_STATUS-"].update("正在扫描...")
+    scanner.start(roots)
+
+# Shown for the disk_type reported by read_image_metadata()
+DISK_TYPE_NAMES = {"fixed": "固定大小", "dynamic": "动态扩展", "differencing": "差异磁盘"}
+
+def describe_image(image):
+    """Summarizes the header metadata of a local image for the image table."""
+    if image.get("label"):
+        return f"卷标: {image['label']}"
+    if image.get("virtual_size"):
+        disk_type = DISK_TYPE_NAMES.get(image.get("disk_type"), "虚拟硬盘")
+        return f"{disk_type}, 容量 {format_size(image['virtual_size'])}"
+    return ""
+
+def show_local_images(window, scanner, result):
+    """Appends a batch of images found by the ImageScanner to the local image table."""
+    if result["scan"] != scanner.scan_id or not is_view_active(window, "IMAGES"):
+        return
+    table = window["-LOCAL_IMG_TABLE-"]
+    append_table_rows(table, [[image["name"], describe_image(image), image["path"], format_size(image["size"])] for image in result["images"]])
+    if not result["done"]:
+        window["-SCAN_STATUS-"].update(f"正在扫描... 已找到 {len(table.Values)} 个镜像")
+    elif result["error"]:
+        window["-SCAN_STATUS-"].update(f"扫描失败: {result['error']}")
+    else:
+        window["-SCAN_STATUS-"].update(f"扫描完成，共找到 {result['count']} 个镜像")
+
+def show_host_status(window, host, reachable):
+    """Lists the hosts whose VMs could not be loaded below the VM table."""
+    unreachable = window.metadata.setdefault("unreachable_hosts", set())
+    if reachable:
+        unreachable.discard(host)
+    else:
+        unreachable.add(host)
+    if is_view_active(window, "VMS"):
+        text = f"无法连接主机: {', '.join(sorted(unreachable))}，显示的是上次加载的数据" if unreachable else ""
+        window["-HOST_STATUS-"].update(text)
+
+def show_vm_inventory(window, host, vms, watcher=None):
+    """Replaces the rows of one host in the VM table, leaving the other hosts' rows alone."""
+    table = window["-VM_TABLE-"]
+    vm_data = build_vm_rows(table, vms)
+    names = {vm.name for vm in vms}
+    removed = [(row[0], row[1]) for row in table.Values or [] if row[0] == host and row[1] not in names]
+    # Only rows that changed are redrawn and the selection is kept
+    patch_table(table, vm_data, removed, key_column=VM_TABLE_KEY)
+    update_vm_buttons(window, get_selected_keys(table, key_column=VM_TABLE_KEY))
+    if watcher:
+        watcher.reset(vms, host)
+
+def refresh_vm_table(window, dispatcher, watcher=None, hosts=(LOCAL_HOST,), use_snapshot=False):
+    """Loads the VM table; use_snapshot=True shows the watcher's last inventory of a host instead of querying it."""
     if not window or window.was_closed(): return
-    switches = get_vswitches()
-    nats = get_nat_networks()
-    nat_names = [n['Name'] for n in nats] if nats else []
-    ip_addresses = get_vswitch_ip_addresses()
+    def load(host):
+        snapshot = watcher.snapshot(host) if watcher and use_snapshot else None
+        if snapshot is not None:
+            show_vm_inventory(window, host, snapshot, watcher)
+            return
+        def on_done(task):
+            if not task_succeeded(task) or not is_view_active(window, "VMS"):
+                return
+            success, vms = task.result
+            show_host_status(window, host, success)
+            if success:
+                show_vm_inventory(window, host, vms, watcher)
+        dispatcher.submit(f"加载虚拟机列表 ({host})", poll_vm_inventory, use_cache=True, host=host, on_done=on_done)
+    # One round-trip per host for all its VMs and their adapters; every host fills in its rows
+    # as soon as it answers, so a slow host does not hold up the table
+    for host in hosts:
+        load(host)
+
+def apply_vm_changes(window, changes):
+    """Patches the rows of VMs reported by the VMStateWatcher and keeps the current selection."""
+    table = window["-VM_TABLE-"]
+    changed_rows = build_vm_rows(table, changes["changed"].values())
+    patch_table(table, changed_rows, changes["removed"], key_column=VM_TABLE_KEY)
+    show_host_status(window, changes["host"], True)
+    update_vm_buttons(window, get_selected_keys(table, key_column=VM_TABLE_KEY))
+
+def load_vswitch_rows():
+    # The three queries are independent, so the view loads in the time of the slowest one
+    results = run_parallel({
+        "switches": get_vswitches,
+        "nats": get_nat_networks,
+        "ip_addresses": get_vswitch_ip_addresses,
+    })
+    switches = results["switches"]
+    nats = results["nats"]
+    nat_names = [n.name for n in nats]
+    ip_addresses = results["ip_addresses"]
     vswitch_data = []
     if switches:
         for switch in switches:
             details = ""
-            switch_name = switch.get('Name', 'N/A')
-            if switch.get('SwitchType') == 'Internal':
+            switch_name = switch.name or 'N/A'
+            if switch.switch_type == 'Internal':
                 nat_status = "NAT: 已启用" if switch_name in nat_names else "NAT: 未启用"
                 gateway = ip_addresses.get(switch_name, "未设置")
                 details = f"{nat_status}, 网关: {gateway}"
             else:
                 details = "不适用"
-            vswitch_data.append([switch_name, switch.get('SwitchType', 'N/A'), details, switch.get('Notes', '')])
-    window["-VSWITCH_TABLE-"].update(values=vswitch_data)
-    window["-DELETE_VSWITCH-"].update(disabled=True)
-    window['-NAT_CONTAINER-'].update(sg.Column([[]]))
+            vswitch_data.append([switch_name, switch.switch_type or 'N/A', details, switch.notes])
+    return vswitch_data
+
+def refresh_vswitch_table(window, dispatcher):
+    if not window or window.was_closed(): return
+    def on_done(task):
+        if not task_succeeded(task) or not is_view_active(window, "NETWORK"):
+            return
+        sync_table(window["-VSWITCH_TABLE-"], task.result)
+        # The NAT panel stays open as long as its switch is still selected
+        if not get_selected_keys(window["-VSWITCH_TABLE-"]):
+            window["-DELETE_VSWITCH-"].update(disabled=True)
+            window['-NAT_CONTAINER-'].update(sg.Column([[]]))
+    dispatcher.submit("加载虚拟交换机", load_vswitch_rows, on_done=on_done)
+
+def nat_rule_rows(rules):
+    return [[r.protocol, r.external_port, r.internal_ip, r.internal_port] for r in rules]
+
+def show_nat_panel(window, switch_name, is_nat_enabled, nat_rules=()):
+    # The index backs filtering, conflict checks and deletes without another query
+    index = NatRuleIndex(nat_rules)
+    window.metadata["nat_index"] = index
+    nat_panel_layout = [[sg.Frame("NAT 网络详情", [
+        [sg.Text(f"交换机 '{switch_name}' 的NAT状态: {'已启用' if is_nat_enabled else '未启用'}")],
+        [sg.Button("创建NAT网络", key="-CREATE_NAT-", disabled=is_nat_enabled), sg.Button("添加端口转发", key="-ADD_NAT_RULE-", disabled=not is_nat_enabled),
+         sg.Button("导入规则", key="-IMPORT_NAT_RULES-", disabled=not is_nat_enabled), sg.Button("导出规则", key="-EXPORT_NAT_RULES-", disabled=not is_nat_enabled)],
+        [sg.Text("按内部IP筛选:"), sg.Input(key="-NAT_FILTER_IP-", size=(16, 1), enable_events=True), sg.Text(f"共 {len(index)} 条规则", key="-NAT_RULE_COUNT-")],
+        [sg.Table(values=nat_rule_rows(index), headings=["协议", "外部端口", "内部IP", "内部端口"], key="-NAT_RULES_TABLE-", auto_size_columns=False, justification='left', expand_x=True,
+                  select_mode=sg.TABLE_SELECT_MODE_EXTENDED)],
+        [sg.Button("删除所选规则", key="-DELETE_NAT_RULE-", disabled=not is_nat_enabled)]
+    ], expand_x=True, vertical_alignment='top')]]
+    window['-NAT_CONTAINER-'].update(sg.Column(nat_panel_layout))
+
+def filter_nat_rules(window, internal_ip):
+    """Shows the rules that forward to internal_ip, or all of them when it is empty."""
+    index = window.metadata.get("nat_index") or NatRuleIndex()
+    rules = index.for_internal_ip(internal_ip.strip()) if internal_ip.strip() else list(index)
+    sync_table(window["-NAT_RULES_TABLE-"], nat_rule_rows(rules), key_column=NAT_RULE_TABLE_KEY)
+    window["-NAT_RULE_COUNT-"].update(f"共 {len(index)} 条规则" if len(rules) == len(index) else f"{len(rules)} / {len(index)} 条规则")
+
+def load_nat_panel(window, dispatcher, switch_name):
+    def on_done(task):
+        # Ignore rules that arrive after the user moved on to another switch
+        if task_succeeded(task) and is_view_active(window, "NETWORK") and switch_name in get_selected_keys(window["-VSWITCH_TABLE-"]):
+            show_nat_panel(window, switch_name, True, task.result)
+    dispatcher.submit("加载端口转发规则", get_nat_rules, switch_name, on_done=on_done)
+
+def _report_nat_changes(window, dispatcher, nat_name, changes, results):
+    failures = [f"{format_change(change)}: {message}" for change, (ok, message) in zip(changes, results) if not ok]
+    if failures:
+        sg.popup_error(f"部分更改失败 ({len(failures)}/{len(results)}):\n" + "\n".join(failures))
+    if is_view_active(window, "NETWORK"):
+        load_nat_panel(window, dispatcher, nat_name)
+
+def delete_nat_rules(window, dispatcher, nat_name, keys):
+    """Removes the port mappings of the selected (protocol, external port) keys in one script."""
+    changes = plan_nat_removal(nat_name, window.metadata.get("nat_index") or NatRuleIndex(), keys)
+    if not changes:
+        return
+    def on_done(task):
+        if task_succeeded(task):
+            _report_nat_changes(window, dispatcher, nat_name, changes, task.result)
+    dispatcher.submit(f"删除 {len(changes)} 条端口转发规则", apply_network_changes, changes, on_done=on_done)
+
+_NAT_RULE_FILE_TYPES = (("端口转发规则", "*.csv *.json"),)
+
+def import_nat_rule_file(window, dispatcher, nat_name, path):
+    """Adds the port mappings of a CSV or JSON file to a NAT, asking what to do with conflicting ones."""
+    try:
+        rules = read_nat_rules(path)
+    except (OSError, ValueError) as e:
+        sg.popup_error(f"无法读取规则文件: {e}")
+        return
+
+    def on_loaded(task):
+        if not task_succeeded(task):
+            return
+        success, index = task.result
+        if not success:
+            sg.popup_error(f"读取端口转发规则失败: {index}")
+            return
+        changes, conflicts = plan_nat_import(nat_name, index, rules)
+        if conflicts:
+            listing = "\n".join(f"{rule.protocol} {rule.external_port}: {existing.internal_ip}:{existing.internal_port} -> {rule.internal_ip}:{rule.internal_port}"
+                                for rule, existing in conflicts)
+            answer = sg.popup_scrolled(listing, title=f"{len(conflicts)} 条规则与现有规则冲突，是否覆盖？(选择“否”将跳过这些规则)", yes_no=True, size=(90, 20))
+            if answer is None:
+                return
+            if answer == "Yes":
+                changes, _ = plan_nat_import(nat_name, index, rules, replace=True)
+        if not changes:
+            sg.popup("文件中的规则均已存在，无需导入。")
+            return
+        if sg.popup_yes_no(f"将向 NAT '{nat_name}' 应用 {len(changes)} 项更改，是否继续？", title="确认导入") != "Yes":
+            return
+        def on_applied(task):
+            if task_succeeded(task):
+                _report_nat_changes(window, dispatcher, nat_name, changes, task.result)
+        dispatcher.submit(f"导入 {len(changes)} 项端口转发更改", apply_network_changes, changes, on_done=on_applied)
+    dispatcher.submit("读取端口转发规则", load_nat_index, nat_name, on_done=on_loaded)
+
+def export_nat_rule_file(dispatcher, nat_name, path):
+    def on_done(task):
+        if not task_succeeded(task):
+            return
+        success, index = task.result
+        if not success:
+            sg.popup_error(f"读取端口转发规则失败: {index}")
+            return
+        try:
+            write_nat_rules(index, path)
+        except OSError as e:
+            sg.popup_error(f"保存失败: {e}")
+            return
+        sg.popup(f"已导出 {len(index)} 条规则到 {path}")
+    dispatcher.submit("读取端口转发规则", load_nat_index, nat_name, on_done=on_done)
+
+_NETWORK_SPEC_FILE_TYPES = (("网络配置文件", "*.yaml *.yml *.json"),)
+
+def apply_network_spec(window, dispatcher, path):
+    """Plans the changes a network spec file needs, asks for confirmation and applies them in one script."""
+    try:
+        spec = load_network_spec(path)
+    except (OSError, ValueError, ImportError) as e:
+        sg.popup_error(f"无法读取网络配置文件: {e}")
+        return
+
+    def on_planned(task):
+        if not task_succeeded(task):
+            return
+        success, changes = task.result
+        if not success:
+            sg.popup_error(f"无法规划网络更改: {changes}")
+            return
+        if not changes:
+            sg.popup("网络配置已与配置文件一致，无需更改。")
+            return
+        plan = "\n".join(format_change(change) for change in changes)
+        if sg.popup_scrolled(plan, title=f"将应用 {len(changes)} 项更改，是否继续？", yes_no=True, size=(90, 20)) != "Yes":
+            return
+
+        def on_applied(task):
+            if task_succeeded(task):
+                failures = [f"{format_change(change)}: {message}" for change, (ok, message) in zip(changes, task.result) if not ok]
+                if failures:
+                    sg.popup_error(f"部分更改失败 ({len(failures)}/{len(task.result)}):\n" + "\n".join(failures))
+                else:
+                    sg.popup(f"已应用 {len(task.result)} 项更改。")
+            if is_view_active(window, "NETWORK"):
+                refresh_vswitch_table(window, dispatcher)
+        dispatcher.submit(f"应用 {len(changes)} 项网络更改", apply_network_changes, changes, on_done=on_applied)
+    dispatcher.submit("读取网络配置", plan_network, spec, on_done=on_planned)
+
+def export_network_spec(dispatcher, path):
+    def on_done(task):
+        if not task_succeeded(task):
+            return
+        success, state = task.result
+        if not success:
+            sg.popup_error(f"读取网络配置失败: {state}")
+            return
+        try:
+            save_network_spec(network_spec_from_state(state), path)
+        except (OSError, ImportError) as e:
+            sg.popup_error(f"保存失败: {e}")
+            return
+        sg.popup(f"网络配置已导出到 {path}")
+    dispatcher.submit("读取网络配置", get_network_state, on_done=on_done)
+
+def update_vm_buttons(window, selected_vms):
+    # Lifecycle actions and commands work on any number of VMs, the others need exactly one
+    for key in ["-START_VM-", "-SHUTDOWN_VM-", "-STOP_VM-", "-DELETE_VM-", "-EXEC_COMMAND-"]:
+        window[key].update(disabled=not selected_vms)
+    for key in ["-CONNECT_VM-", "-CONFIG_VM_NET-"]:
+        window[key].update(disabled=len(selected_vms) != 1)
+
+def run_bulk_vm_action(window, dispatcher, watcher, action, action_name, selected_vms):
+    """Runs a bulk VM helper on the selected (host, VM name) pairs, all hosts in parallel."""
+    def on_done(task):
+        if task_succeeded(task):
+            results = task.result
+            failures = [f"{host}/{name}: {message}" for (host, name), (success, message) in results.items() if not success]
+            if failures:
+                sg.popup_error(f"{action_name}失败 ({len(failures)}/{len(results)}):\n" + "\n".join(failures))
+        if is_view_active(window, "VMS"):
+            refresh_vm_table(window, dispatcher, watcher, list(dict.fromkeys(host for host, _ in selected_vms)))
+        # State transitions (e.g. "正在停止" -> "已关闭") are picked up by the watcher
+        watcher.poll_now()
+    dispatcher.submit(f"{action_name} {len(selected_vms)} 台虚拟机", run_bulk_on_hosts, action, selected_vms, max_concurrency=BULK_VM_CONCURRENCY, on_done=on_done)
+
+def check_hyperv(window, dispatcher):
+    def on_done(task):
+        if task_succeeded(task) and is_view_active(window, "SYSTEM"):
+            is_enabled = task.result == "Enabled"
+            window["-STATUS_TEXT-"].update(f"Hyper-V 状态: {task.result}")
+            window["-INSTALL_HYPERV-"].update(visible=not is_enabled)
+            window["-INSTALL_WARN-"].update(visible=not is_enabled)
+    dispatcher.submit("检查 Hyper-V 状态", check_hyperv_status, on_done=on_done)
+
+def run_hyperv_install(window, dispatcher):
+    # Enable-WindowsOptionalFeature runs for a long time; the window stays usable and it can be cancelled
+    def on_done(task):
+        show_install_progress(window)
+        window.metadata.pop("install_task", None)
+        if is_view_active(window, "SYSTEM"):
+            window["-INSTALL_HYPERV-"].update(disabled=False)
+            window["-INSTALL_PROGRESS-"].update(current_count=0, visible=False)
+        if task_succeeded(task):
+            success, output = task.result
+            if success:
+                sg.popup("Hyper-V 已启用，重启计算机后生效。")
+            else:
+                sg.popup_error(f"安装失败: {output}")
+    # Streamed, so its progress and output show up while it runs
+    task = dispatcher.submit("安装 Hyper-V", install_hyperv, on_done=on_done, timeout=INSTALL_TIMEOUT, stream=True)
+    window.metadata["install_task"] = task
+
+def show_install_progress(window):
+    """Shows the progress and output of a running Hyper-V installation in the system view."""
+    task = window.metadata.get("install_task")
+    if task is None or not is_view_active(window, "SYSTEM"):
+        return
+    progress = task.progress
+    if progress is not None and progress.percent >= 0:
+        window["-INSTALL_PROGRESS-"].update(current_count=progress.percent, visible=True)
+    window["-INSTALL_STATUS-"].update(f"{progress.activity}: {progress.status}" if progress else "")
+    log = "\n".join(task.log)
+    # Rewriting an unchanged log on every tick would keep resetting its scroll position
+    if log and log != window.metadata.get("install_log"):
+        window.metadata["install_log"] = log
+        window["-INSTALL_LOG-"].update(log, visible=True)
 
 # --- Modal Window Functions ---
 def create_vswitch_window():
-    adapter_list = get_network_adapters()
     type_mapping = {"外部": "External", "内部": "Internal", "专用": "Private"}
     reverse_type_mapping = {v: k for k, v in type_mapping.items()}
     descriptions = {
@@ -87,15 +476,36 @@ def create_vswitch_window():
     layout = [
         [sg.Text("交换机名称:"), sg.Input(key="-NAME-")],
         [sg.Text("交换机类型:"), sg.Combo(list(type_mapping.keys()), default_value=reverse_type_mapping["Internal"], key="-TYPE-", readonly=True, enable_events=True)],
-        [sg.Text("物理网卡:", visible=False, key="-ADAPTER_LABEL-"), sg.Combo(adapter_list, key="-ADAPTER-", visible=False, readonly=True)],
+        [sg.Text("物理网卡:", visible=False, key="-ADAPTER_LABEL-"), sg.Combo([], key="-ADAPTER-", visible=False, readonly=True)],
         [sg.Frame('说明', [[sg.Text(descriptions["Internal"], key="-DESC-", size=(50, 4))]])],
+        [sg.Text("", key="-BUSY-", text_color="grey")],
         [sg.Button("创建", key="-SUBMIT-"), sg.Button("取消")]
     ]
     window = sg.Window("创建虚拟交换机", layout, modal=True, finalize=True)
+    tasks = TaskDispatcher(window, timeout=QUERY_TIMEOUT)
+    # Load the adapter list in the background; the combo is filled in once it arrives
+    adapters_task = tasks.submit("加载物理网卡", get_network_adapters)
+    create_task = None
+    created = False
     while True:
         event, values = window.read()
         if event in (sg.WIN_CLOSED, "取消"):
             break
+        if event == TASK_DONE_EVENT:
+            task = values[event]
+            tasks.dispatch(task)
+            if task is adapters_task and not task.error:
+                window["-ADAPTER-"].update(values=task.result)
+            if task is create_task:
+                create_task = None
+                window["-BUSY-"].update("")
+                window["-SUBMIT-"].update(disabled=False)
+                success, output = task.result if not task.error else (False, task.error)
+                if success:
+                    sg.popup("交换机创建成功！")
+                    created = True
+                    break
+                sg.popup_error(f"创建失败: {output}")
         if event == "-TYPE-":
             selected_type_chinese = values["-TYPE-"]
             switch_type_english = type_mapping[selected_type_chinese]
@@ -103,7 +513,7 @@ def create_vswitch_window():
             window["-ADAPTER_LABEL-"].update(visible=is_external)
             window["-ADAPTER-"].update(visible=is_external)
             window["-DESC-"].update(descriptions[switch_type_english])
-        if event == "-SUBMIT-":
+        if event == "-SUBMIT-" and not create_task:
             name = values["-NAME-"]
             selected_type_chinese = values["-TYPE-"]
             switch_type_english = type_mapping[selected_type_chinese]
@@ -114,29 +524,121 @@ def create_vswitch_window():
             if switch_type_english == "External" and not adapter:
                 sg.popup_error("外部交换机必须选择一个物理网卡！")
                 continue
-            success, output = create_vswitch(name, switch_type_english, adapter)
-            if success:
-                sg.popup("交换机创建成功！")
-                break
-            else:
-                sg.popup_error(f"创建失败: {output}")
+            create_task = tasks.submit("创建交换机", create_vswitch, name, switch_type_english, adapter)
+            window["-BUSY-"].update("正在创建交换机，请稍候...")
+            window["-SUBMIT-"].update(disabled=True)
+    tasks.shutdown()
+    window.close()
+    return created
+
+def create_from_template_window(template_path):
+    chain = get_vhd_chain(template_path)
+    children = get_vhd_children(template_path)
+    layout = [
+        [sg.Text("模板:"), sg.Text(template_path)],
+        [sg.Text("父磁盘链:"), sg.Text(" <- ".join(os.path.basename(path) for path in chain))],
+        [sg.Text(f"已有 {len(children)} 个差异磁盘基于此模板", text_color="grey")],
+        [sg.Text("虚拟机名称", size=(15, 1)), sg.Input(key="-NAME-")],
+        [sg.Text("数量", size=(15, 1)), sg.Spin(list(range(1, 51)), initial_value=1, key="-COUNT-", size=(5, 1)),
+         sg.Text("?", tooltip="数量大于 1 时，虚拟机依次命名为 名称-01、名称-02 ...")],
+        [sg.Text("存储位置", size=(15, 1)), sg.Input(os.path.join(os.path.expanduser("~"), "Hyper-V"), key="-VM_PATH-"), sg.FolderBrowse("浏览")],
+        [sg.Text("内存 (MB)", size=(15, 1)), sg.Slider(range=(1024, 16384), default_value=2048, resolution=1024, orientation='h', size=(30, 20), key="-VM_MEM-")],
+        [sg.Text("CPU核心数", size=(15, 1)), sg.Slider(range=(1, 8), default_value=2, orientation='h', size=(30, 20), key="-VM_CPU-")],
+        [sg.Text("虚拟交换机", size=(15, 1)), sg.Combo([], key="-VM_VSWITCH-", readonly=True, size=(30, 1))],
+        [sg.Checkbox("启用安全启动", key="-SECURE_BOOT-", default=True)],
+        [sg.Checkbox("完整复制 (不依赖模板)", key="-FULL_CLONE-"),
+         sg.Text("?", tooltip="默认创建基于模板的差异磁盘，几秒内即可完成，但模板文件之后不能修改或删除。\n完整复制会复制整个模板文件，耗时较长，但新虚拟机不再依赖模板。")],
+        [sg.Text("", key="-BUSY-", text_color="grey")],
+        [sg.ProgressBar(100, orientation='h', size=(40, 12), key="-PROGRESS-", visible=False)],
+        [sg.Button("创建", key="-SUBMIT-"), sg.Button("取消")]
+    ]
+    window = sg.Window("从模板创建虚拟机", layout, modal=True, finalize=True)
+    tasks = TaskDispatcher(window, timeout=QUERY_TIMEOUT)
+    switches_task = tasks.submit("加载虚拟交换机", get_vswitches)
+    create_task = None
+    created = False
+    while True:
+        # Polls while creating, to show the copy progress
+        event, values = window.read(timeout=200 if create_task else None)
+        if event in (sg.WIN_CLOSED, "取消"):
+            break
+        if event == sg.TIMEOUT_EVENT and create_task and create_task.progress is not None:
+            progress = create_task.progress
+            if progress.percent >= 0:
+                window["-PROGRESS-"].update(current_count=progress.percent, visible=True)
+            window["-BUSY-"].update(f"{progress.activity}: {progress.status}")
+        if event == TASK_DONE_EVENT:
+            task = values[event]
+            tasks.dispatch(task)
+            if task is switches_task and not task.error:
+                switch_names = [switch.name for switch in task.result]
+                window["-VM_VSWITCH-"].update(values=switch_names, value=switch_names[0] if switch_names else "")
+            if task is create_task:
+                create_task = None
+                window["-BUSY-"].update("")
+                window["-PROGRESS-"].update(current_count=0, visible=False)
+                window["-SUBMIT-"].update(disabled=False)
+                if task.error:
+                    sg.popup_error(f"创建失败: {task.error}")
+                    continue
+                failures = [f"{name}: {message}" for name, (success, message) in task.result.items() if not success]
+                created = len(failures) < len(task.result)
+                if failures:
+                    sg.popup_error(f"创建失败 ({len(failures)}/{len(task.result)}):\n" + "\n".join(failures))
+                else:
+                    sg.popup(f"已创建 {len(task.result)} 台虚拟机。")
+                    break
+        if event == "-SUBMIT-" and not create_task:
+            name = values["-NAME-"].strip()
+            count = int(values["-COUNT-"])
+            if not name:
+                sg.popup_error("虚拟机名称不能为空！")
+                continue
+            if not values["-VM_VSWITCH-"]:
+                sg.popup_error("请选择一个虚拟交换机！")
+                continue
+            names = [name] if count == 1 else [f"{name}-{i:02d}" for i in range(1, count + 1)]
+            create_task = tasks.submit(f"从模板创建 {len(names)} 台虚拟机", create_vms_from_template, names, template_path,
+                                       int(values["-VM_MEM-"]), int(values["-VM_CPU-"]), values["-VM_PATH-"], values["-VM_VSWITCH-"],
+                                       full_clone=values["-FULL_CLONE-"], enable_secure_boot=values["-SECURE_BOOT-"],
+                                       max_concurrency=BULK_VM_CONCURRENCY, stream=True)
+            window["-BUSY-"].update("完整复制需要复制整个模板文件，请稍候..." if values["-FULL_CLONE-"] else "正在创建虚拟机，请稍候...")
+            window["-SUBMIT-"].update(disabled=True)
+    tasks.shutdown()
     window.close()
+    return created
 
-def create_add_nat_rule_window(nat_name):
+def create_add_nat_rule_window(nat_name, index=None):
     layout = [
         [sg.Text("协议:"), sg.Combo(["TCP", "UDP"], default_value="TCP", key="-PROTO-", readonly=True)],
         [sg.Text("外部端口:"), sg.Input(key="-EXT_PORT-")],
         [sg.Text("内部IP地址:"), sg.Input(key="-INT_IP-")],
         [sg.Text("内部端口:"), sg.Input(key="-INT_PORT-")],
+        [sg.Text("", key="-BUSY-", text_color="grey")],
         [sg.Button("添加"), sg.Button("取消")]
     ]
     window = sg.Window("添加端口转发规则", layout, modal=True, finalize=True)
+    tasks = TaskDispatcher(window, timeout=QUERY_TIMEOUT)
+    add_task = None
     rule_added = False
     while True:
         event, values = window.read()
         if event in (sg.WIN_CLOSED, "取消"):
             break
-        if event == "添加":
+        if event == TASK_DONE_EVENT:
+            task = values[event]
+            tasks.dispatch(task)
+            add_task = None
+            window["-BUSY-"].update("")
+            window["添加"].update(disabled=False)
+            success, output = task.result if not task.error else (False, task.error)
+            if success:
+                sg.popup("规则添加成功！")
+                rule_added = True
+                break
+            else:
+                sg.popup_error(f"添加失败: {output}")
+        if event == "添加" and not add_task:
             if not all([values["-EXT_PORT-"], values["-INT_IP-"], values["-INT_PORT-"]]):
                 sg.popup_error("所有字段都不能为空！")
                 continue
@@ -146,104 +648,188 @@ def create_add_nat_rule_window(nat_name):
             except ValueError:
                 sg.popup_error("端口号必须是数字！")
                 continue
-            success, output = add_nat_rule(
+            existing = index.get(values["-PROTO-"], ext_port) if index is not None else None
+            if existing is not None:
+                sg.popup_error(f"{existing.protocol} 外部端口 {ext_port} 已转发到 {existing.internal_ip}:{existing.internal_port}")
+                continue
+            add_task = tasks.submit(
+                "添加端口转发", add_nat_rule,
                 nat_name=nat_name,
                 protocol=values["-PROTO-"],
                 external_port=ext_port,
                 internal_ip=values["-INT_IP-"],
                 internal_port=int_port
             )
-            if success:
-                sg.popup("规则添加成功！")
-                rule_added = True
-                break
-            else:
-                sg.popup_error(f"添加失败: {output}")
+            window["-BUSY-"].update("正在添加规则，请稍候...")
+            window["添加"].update(disabled=True)
+    tasks.shutdown()
     window.close()
     return rule_added
 
-def create_vm_network_window(vm_name):
-    adapters = get_vm_network_adapters(vm_name)
-    switches = get_vswitches()
-    switch_names = [s['Name'] for s in switches]
-    if not adapters:
-        sg.popup_error(f"虚拟机 '{vm_name}' 没有找到网络适配器。")
-        return
-    adapter_name = adapters[0].get('Name')
-    current_switch = adapters[0].get('SwitchName') or "未连接"
+def create_vm_network_window(vm_name, host=LOCAL_HOST):
     layout = [
         [sg.Text(f"正在为虚拟机 '{vm_name}' 配置网络")],
-        [sg.Text(f"网卡: {adapter_name}")],
-        [sg.Text(f"当前连接: {current_switch}")],
+        [sg.Text("网卡: 正在加载...", key="-ADAPTER_NAME-")],
+        [sg.Text("当前连接: 正在加载...", key="-CURRENT_SWITCH-")],
         [sg.HSep()],
-        [sg.Text("选择要连接的交换机:"), sg.Combo(switch_names, key="-SWITCH_TO_CONNECT-", readonly=True)],
-        [sg.Button("连接"), sg.Button("断开连接"), sg.Button("关闭")]
+        [sg.Text("选择要连接的交换机:"), sg.Combo([], key="-SWITCH_TO_CONNECT-", readonly=True, size=(30, 1))],
+        [sg.Text("", key="-BUSY-", text_color="grey")],
+        [sg.Button("连接", disabled=True), sg.Button("断开连接", disabled=True), sg.Button("关闭")]
     ]
     window = sg.Window("设置虚拟机网络", layout, modal=True, finalize=True)
+    tasks = TaskDispatcher(window, timeout=QUERY_TIMEOUT)
+    # The window opens at once and is filled in when both queries are back
+    load_task = tasks.submit("加载网络信息", run_parallel, {
+        "adapters": (get_vm_network_adapters, vm_name),
+        "switches": get_vswitches,
+    }, host=host)
+    action_task = None
+    adapter_name = None
+    current_switch = "未连接"
     while True:
         event, values = window.read()
         if event in (sg.WIN_CLOSED, "关闭"):
             break
+        if event == TASK_DONE_EVENT:
+            task = values[event]
+            tasks.dispatch(task)
+            if task is load_task:
+                adapters = task.result["adapters"] if not task.error else []
+                if not adapters:
+                    sg.popup_error(f"虚拟机 '{vm_name}' 没有找到网络适配器。")
+                    break
+                adapter_name = adapters[0].name
+                current_switch = adapters[0].switch_name or "未连接"
+                window["-ADAPTER_NAME-"].update(f"网卡: {adapter_name}")
+                window["-CURRENT_SWITCH-"].update(f"当前连接: {current_switch}")
+                window["-SWITCH_TO_CONNECT-"].update(values=[s.name for s in task.result["switches"]])
+                window["连接"].update(disabled=False)
+                window["断开连接"].update(disabled=False)
+            if task is action_task:
+                action_task = None
+                window["-BUSY-"].update("")
+                success, output = task.result if not task.error else (False, task.error)
+                if success:
+                    sg.popup(success_message)
+                    break
+                sg.popup_error(f"{failure_message}: {output}")
+        if action_task or not adapter_name:
+            continue
         if event == "连接":
             selected_switch = values["-SWITCH_TO_CONNECT-"]
             if not selected_switch:
                 sg.popup_error("请先选择一个交换机。")
                 continue
-            success, output = connect_vm_to_switch(vm_name, adapter_name, selected_switch)
-            if success:
-                sg.popup("连接成功！")
-                break
-            else:
-                sg.popup_error(f"连接失败: {output}")
+            action_task = tasks.submit("连接交换机", connect_vm_to_switch, vm_name, adapter_name, selected_switch, host=host)
+            success_message, failure_message = "连接成功！", "连接失败"
+            window["-BUSY-"].update("正在连接，请稍候...")
         if event == "断开连接":
             if current_switch == "未连接":
                 sg.popup("该网卡尚未连接到任何交换机。")
             else:
-                success, output = disconnect_vm_from_switch(vm_name, adapter_name)
-                if success:
-                    sg.popup("已断开连接。")
-                    break
-                else:
-                    sg.popup_error(f"操作失败: {output}")
+                action_task = tasks.submit("断开连接", disconnect_vm_from_switch, vm_name, adapter_name, host=host)
+                success_message, failure_message = "已断开连接。", "操作失败"
+                window["-BUSY-"].update("正在断开连接，请稍候...")
+    tasks.shutdown()
     window.close()
 
-def create_remote_command_window(vm_name):
+def run_command_in_vms(selected_vms, username, password, command, on_output):
+    """Runs a command in (host, VM name) pairs, all hosts in parallel.
+
+    Output lines go to on_output(host, vm_name, line) as they arrive.
+    Returns {(host, vm_name): (success, output or error)}.
+    """
+    names_by_host = {}
+    for host, vm_name in selected_vms:
+        names_by_host.setdefault(host, []).append(vm_name)
+    queries = {}
+    for host, names in names_by_host.items():
+        stream = functools.partial(on_output, host)
+        queries[host] = (functools.partial(invoke_command_in_vms, on_output=stream), names, username, password, command)
+    results = {}
+    for host, host_results in iter_host_results(queries):
+        results.update(((host, vm_name), result) for vm_name, result in host_results.items())
+    return results
+
+def create_remote_command_window(selected_vms):
+    multiple = len(selected_vms) > 1
+    hosts = {host for host, _ in selected_vms}
+    if multiple:
+        title = f"在 {len(selected_vms)} 台虚拟机中执行命令"
+    else:
+        title = f"在虚拟机 '{selected_vms[0][1]}' 中执行命令"
     layout = [
-        [sg.Text(f"在虚拟机 '{vm_name}' 中执行命令", font=("Any 16"))],
-        [sg.Text("此功能使用PowerShell Direct...", font=("Any 9"))],
+        [sg.Text(title, font=("Any 16"))],
+        [sg.Text("此功能使用PowerShell Direct，会话在空闲5分钟内可复用...", font=("Any 9"))],
         [sg.HSep()],
         [sg.Text("用户名", size=(10,1)), sg.Input(key="-USERNAME-")],
         [sg.Text("密码", size=(10,1)), sg.Input(key="-PASSWORD-", password_char='*')],
         [sg.HSep()],
         [sg.Text("输入要执行的PowerShell命令:")],
         [sg.Multiline(key="-COMMAND-", size=(80, 10), expand_x=True)],
-        [sg.Button("执行", key="-SUBMIT-", expand_x=True)],
+        [sg.Button("执行", key="-SUBMIT-", expand_x=True), sg.Button("取消执行", key="-CANCEL-", visible=False)],
         [sg.HSep()],
         [sg.Text("输出结果:")],
-        [sg.Multiline("", key="-OUTPUT-", size=(80, 15), disabled=True, expand_x=True, expand_y=True)]
+        [sg.Multiline("", key="-OUTPUT-", size=(80, 15), disabled=True, autoscroll=True, expand_x=True, expand_y=True)]
     ]
     window = sg.Window("远程执行命令", layout, modal=True, resizable=True, finalize=True)
+    # Commands in the guest have no time limit, they can only be cancelled
+    tasks = TaskDispatcher(window)
+    command_task = None
+
+    def label(host, vm_name):
+        return f"{host}/{vm_name}" if len(hosts) > 1 else vm_name
+
+    def on_output(host, vm_name, line):
+        # Called on the worker thread as each line arrives
+        if multiple:
+            line = f"[{label(host, vm_name)}] {line}"
+        try:
+            window.write_event_value("-COMMAND_OUTPUT-", line)
+        except Exception:
+            # The window was closed while the command was running
+            pass
+
     while True:
         event, values = window.read()
         if event in (sg.WIN_CLOSED, "关闭"):
             break
-        if event == "-SUBMIT-":
+        if event == "-CANCEL-" and command_task:
+            command_task.cancel()
+        if event == "-COMMAND_OUTPUT-":
+            window["-OUTPUT-"].update(values[event] + "\n", append=True)
+        if event == TASK_DONE_EVENT:
+            task = values[event]
+            tasks.dispatch(task)
+            command_task = None
+            window["-SUBMIT-"].update(disabled=False)
+            window["-CANCEL-"].update(visible=False)
+            if task.cancelled:
+                window["-OUTPUT-"].update("已取消执行。\n", append=True)
+                continue
+            if task.error:
+                window["-OUTPUT-"].update(f"执行PowerShell命令失败:\n{task.error}\n", append=True)
+                continue
+            results = task.result
+            failures = [f"{label(host, vm_name)}: {message}" for (host, vm_name), (success, message) in results.items() if not success]
+            if not failures:
+                window["-OUTPUT-"].update("执行完成。\n", append=True)
+            elif multiple:
+                window["-OUTPUT-"].update(f"执行失败 ({len(failures)}/{len(results)}):\n" + "\n".join(failures) + "\n", append=True)
+            else:
+                window["-OUTPUT-"].update(f"在虚拟机中执行命令失败:\n{results[selected_vms[0]][1]}\n", append=True)
+        if event == "-SUBMIT-" and not command_task:
             username = values["-USERNAME-"]
             password = values["-PASSWORD-"]
             command = values["-COMMAND-"]
             if not all([username, password, command]):
                 sg.popup_error("用户名、密码和命令均不能为空！")
                 continue
-            window["-OUTPUT-"].update("正在执行，请稍候...")
-            window.refresh()
-            success, result = invoke_command_in_vm(vm_name, username, password, command)
-            if success:
-                if result.get('success'):
-                    window["-OUTPUT-"].update(result.get('output', '执行成功，但没有输出。'))
-                else:
-                    window["-OUTPUT-"].update(f"在虚拟机中执行命令失败:\n{result.get('error')}")
-            else:
-                window["-OUTPUT-"].update(f"执行PowerShell命令失败:\n{result.get('error')}")
+            window["-OUTPUT-"].update("")
+            window["-SUBMIT-"].update(disabled=True)
+            window["-CANCEL-"].update(visible=True)
+            command_task = tasks.submit("执行命令", run_command_in_vms, selected_vms, username, password, command, on_output)
+    tasks.shutdown()
     window.close()
 
 # --- Layout Definitions ---
@@ -277,11 +863,13 @@ def build_online_images_layout():
 def get_vm_list_layout():
     return [[sg.Text("虚拟机列表", font=("Any 20"))],
             [sg.Button("刷新", key="-REFRESH_VMS-"), sg.Button("连接", key="-CONNECT_VM-", disabled=True), sg.Button("启动", key="-START_VM-", disabled=True), sg.Button("设置网络", key="-CONFIG_VM_NET-", disabled=True), sg.Button("执行命令", key="-EXEC_COMMAND-", disabled=True), sg.Button("关机", key="-SHUTDOWN_VM-", disabled=True), sg.Button("强制停止", key="-STOP_VM-", disabled=True), sg.Button("删除", key="-DELETE_VM-", disabled=True, button_color=("white", "red"))],
-            [sg.Table(values=[], headings=["名称", "状态", "网络状态", "操作系统", "IP地址"], key="-VM_TABLE-", auto_size_columns=False, col_widths=[25, 15, 15, 30, 30], justification='left', enable_events=True, num_rows=20, expand_x=True, expand_y=True)]]
+            [sg.Table(values=[], headings=["主机", "名称", "状态", "网络状态", "操作系统", "IP地址", "CPU"], key="-VM_TABLE-", auto_size_columns=False, col_widths=[12, 20, 10, 10, 22, 22, 18], justification='left', enable_events=True, select_mode=sg.TABLE_SELECT_MODE_EXTENDED, num_rows=20, expand_x=True, expand_y=True)],
+            [sg.Text("", key="-HOST_STATUS-", text_color="orange")]]
 
 def get_network_layout():
     return [[sg.Text("网络管理", font=("Any 20"))],
-            [sg.Button("刷新", key="-REFRESH_VSWITCHES-"), sg.Button("创建交换机", key="-CREATE_VSWITCH-"), sg.Button("删除所选交换机", key="-DELETE_VSWITCH-", disabled=True, button_color=("white", "red"))],
+            [sg.Button("刷新", key="-REFRESH_VSWITCHES-"), sg.Button("创建交换机", key="-CREATE_VSWITCH-"), sg.Button("删除所选交换机", key="-DELETE_VSWITCH-", disabled=True, button_color=("white", "red")),
+             sg.Button("应用网络配置文件", key="-APPLY_NETWORK_SPEC-"), sg.Button("导出网络配置", key="-EXPORT_NETWORK_SPEC-")],
             [sg.Column([[sg.Table(values=[], headings=["名称", "类型", "详情", "备注"], key="-VSWITCH_TABLE-", auto_size_columns=False, col_widths=[30, 15, 40, 25], justification='left', enable_events=True, num_rows=12, expand_x=True, expand_y=True)]]),
              sg.Column([], key='-NAT_CONTAINER-', vertical_alignment='top')]]
 
@@ -309,13 +897,14 @@ def get_images_layout():
     local_images_layout = [[sg.Text("选择包含镜像文件的文件夹:")],
                            [sg.Input(key="-SCAN_PATH-", expand_x=True), sg.FolderBrowse("选择文件夹", target="-SCAN_PATH-")],
                            [sg.Button("开始扫描", key="-SCAN_LOCAL-", expand_x=True)],
+                           [sg.Text("", key="-SCAN_STATUS-", expand_x=True)],
                            [sg.HorizontalSeparator()],
-                           [sg.Table(values=[], headings=["文件名", "路径", "大小"], key="-LOCAL_IMG_TABLE-", auto_size_columns=False, col_widths=[20, 50, 15], justification='left', enable_events=True, num_rows=11, expand_x=True)],
+                           [sg.Table(values=[], headings=["文件名", "详情", "路径", "大小"], key="-LOCAL_IMG_TABLE-", auto_size_columns=False, col_widths=[20, 25, 40, 12], justification='left', enable_events=True, num_rows=11, expand_x=True)],
                            [sg.Button("使用选中镜像创建虚拟机", key="-CREATE_FROM_LOCAL-", disabled=True, expand_x=True)]]
     return [[sg.TabGroup([[sg.Tab("在线镜像市场", online_images_tab_content, expand_x=True, expand_y=True)],[sg.Tab("本地镜像", local_images_layout, expand_x=True, expand_y=True)]], key="-IMAGE_TABS-", expand_x=True, expand_y=True)]]
 
 def get_system_check_layout():
-    return [[sg.Text("系统状态检查", font=("Any 20"))],[sg.Button("检查Hyper-V状态", key="-CHECK_HYPERV-")],[sg.Text("点击上方按钮检查Hyper-V状态...", key="-STATUS_TEXT-", size=(60, 3))],[sg.Button("一键安装 Hyper-V", key="-INSTALL_HYPERV-", visible=False, button_color=("white", "green"))],[sg.Text("警告：安装过程需要管理员权限...", key="-INSTALL_WARN-", visible=False, text_color="orange")]]
+    return [[sg.Text("系统状态检查", font=("Any 20"))],[sg.Button("检查Hyper-V状态", key="-CHECK_HYPERV-")],[sg.Text("点击上方按钮检查Hyper-V状态...", key="-STATUS_TEXT-", size=(60, 3))],[sg.Button("一键安装 Hyper-V", key="-INSTALL_HYPERV-", visible=False, button_color=("white", "green"))],[sg.Text("警告：安装过程需要管理员权限...", key="-INSTALL_WARN-", visible=False, text_color="orange")],[sg.ProgressBar(100, orientation='h', size=(40, 12), key="-INSTALL_PROGRESS-", visible=False)],[sg.Text("", key="-INSTALL_STATUS-", size=(60, 1), text_color="grey")],[sg.Multiline("", key="-INSTALL_LOG-", size=(80, 12), disabled=True, autoscroll=True, visible=False)]]
 
 # --- Main Window --- 
 def main():
@@ -331,8 +920,14 @@ def main():
 
     content_container = sg.Column([[]], key='-CONTENT_CONTAINER-', expand_x=True, expand_y=True)
 
-    layout = [[nav_column, sg.VerticalSeparator(), content_container]]
+    status_bar = [sg.Text("就绪", key="-TASK_STATUS-", expand_x=True),
+                  sg.ProgressBar(100, orientation='h', size=(20, 12), key="-TASK_PROGRESS-", visible=False),
+                  sg.Button("取消", key="-TASK_CANCEL-", visible=False)]
+
+    layout = [[nav_column, sg.VerticalSeparator(), content_container], [sg.HorizontalSeparator()], status_bar]
     window = sg.Window("Hyper-V 统一管理器", layout, resizable=True, finalize=True, size=(950, 700))
+    # Background tasks check the active view before touching its elements
+    window.metadata = {"view": "VMS"}
 
     layout_generators = {
         "VMS": get_vm_list_layout,
@@ -342,33 +937,123 @@ def main():
         "SYSTEM": get_system_check_layout
     }
 
-    active_view_key = "-VIEW_VMS-"
-    window['-CONTENT_CONTAINER-'].update(sg.Column(layout_generators["VMS"](), key=active_view_key, expand_x=True, expand_y=True))
+    window['-CONTENT_CONTAINER-'].update(sg.Column(layout_generators["VMS"](), key="-VIEW_VMS-", expand_x=True, expand_y=True))
     window.refresh()
-    refresh_vm_table(window)
+    # Every PowerShell call of the event loop runs on the dispatcher, so the window never blocks
+    # Every registered Hyper-V host is shown in the one VM table
+    hosts = get_host_names()
+    # A worker per host on top of the usual ones, so loading the VMs of a slow host never queues the others
+    dispatcher = TaskDispatcher(window, max_workers=4 + len(hosts), timeout=QUERY_TIMEOUT)
+    # Keeps the VM table live while the VM view is shown
+    vm_watcher = VMStateWatcher(window, VM_CHANGES_EVENT, hosts=hosts)
+    refresh_vm_table(window, dispatcher, vm_watcher, hosts)
+    vm_watcher.start()
+    # CPU/memory/disk/network history of every VM, kept while the manager runs
+    metrics_sampler = MetricsSampler(window, VM_METRICS_EVENT, interval=load_config().get("metrics_interval", DEFAULT_METRICS_INTERVAL), hosts=hosts)
+    metrics_sampler.start()
+    # Streams local images into the table while the scan runs
+    image_scanner = ImageScanner(window, LOCAL_IMAGES_EVENT)
 
-    selected_vm_name = None
+    selected_vms = []
     selected_vswitch_name = None
     wizard_step = 1
+    tick = 0
 
     while True:
-        event, values = window.read()
+        # Poll while tasks run, so the progress bar keeps moving
+        event, values = window.read(timeout=100 if dispatcher.busy else None)
         if event == sg.WIN_CLOSED:
             break
 
+        if event == TASK_DONE_EVENT:
+            dispatcher.dispatch(values[event])
+        if event == "-TASK_CANCEL-":
+            dispatcher.cancel_all()
+
         if event.startswith("-NAV_"):
             view_name = event.replace("-NAV_", "")
             new_view_key = f"-VIEW_{view_name}"
             
+            vm_watcher.stop()
+            image_scanner.stop()
             window['-CONTENT_CONTAINER-'].update(sg.Column(layout_generators[view_name](), key=new_view_key, expand_x=True, expand_y=True))
             window.refresh()
-            active_view_key = new_view_key
+            window.metadata["view"] = view_name
+            # The new view's elements start empty
+            window.metadata.pop("install_log", None)
             
-            if view_name == "VMS": refresh_vm_table(window)
-            if view_name == "NETWORK": refresh_vswitch_table(window)
+            if view_name == "VMS":
+                # The watcher catches up on anything that changed while the view was hidden
+                refresh_vm_table(window, dispatcher, vm_watcher, hosts, use_snapshot=True)
+                vm_watcher.start()
+            if view_name == "NETWORK": refresh_vswitch_table(window, dispatcher)
+
+        if event == VM_CHANGES_EVENT and is_view_active(window, "VMS"):
+            apply_vm_changes(window, values[event])
+        if event == VM_METRICS_EVENT and is_view_active(window, "VMS"):
+            show_vm_metrics(window, metrics_sampler, values[event])
 
-        if event == "-REFRESH_VMS-": refresh_vm_table(window)
-        if event == "-REFRESH_VSWITCHES-": refresh_vswitch_table(window)
+        # Navigation is served from the query cache; the refresh buttons force a reload
+        if event == "-REFRESH_VMS-":
+            invalidate_cache("vm_inventory")
+            refresh_vm_table(window, dispatcher, vm_watcher, hosts)
+        if is_view_active(window, "VMS"):
+            selected_vms = get_selected_keys(window["-VM_TABLE-"], key_column=VM_TABLE_KEY)
+        if event == "-VM_TABLE-":
+            update_vm_buttons(window, selected_vms)
+        if event == "-CONNECT_VM-" and len(selected_vms) == 1:
+            host, vm_name = selected_vms[0]
+            success, output = run_query(connect_vm, vm_name, host=host)
+            if not success:
+                sg.popup_error(output)
+        if event == "-CONFIG_VM_NET-" and len(selected_vms) == 1:
+            host, vm_name = selected_vms[0]
+            create_vm_network_window(vm_name, host)
+            refresh_vm_table(window, dispatcher, vm_watcher, [host])
+        if event == "-EXEC_COMMAND-" and selected_vms:
+            create_remote_command_window(selected_vms)
+        if event == "-START_VM-" and selected_vms:
+            run_bulk_vm_action(window, dispatcher, vm_watcher, start_vms, "启动", selected_vms)
+        if event == "-SHUTDOWN_VM-" and selected_vms:
+            run_bulk_vm_action(window, dispatcher, vm_watcher, shutdown_vms, "关机", selected_vms)
+        if event == "-STOP_VM-" and selected_vms:
+            run_bulk_vm_action(window, dispatcher, vm_watcher, stop_vms, "强制停止", selected_vms)
+        if event == "-DELETE_VM-" and selected_vms:
+            vm_list = "\n".join(f"{host}/{vm_name}" for host, vm_name in selected_vms)
+            if sg.popup_yes_no(f"确定要删除以下 {len(selected_vms)} 台虚拟机吗？\n" + vm_list, title="确认删除") == "Yes":
+                run_bulk_vm_action(window, dispatcher, vm_watcher, delete_vms, "删除", selected_vms)
+        if event == "-REFRESH_VSWITCHES-":
+            for query in ("vswitches", "nat_networks", "vswitch_ips", "nat_rules"):
+                invalidate_cache(query)
+            refresh_vswitch_table(window, dispatcher)
+        if event == "-CREATE_VSWITCH-":
+            if create_vswitch_window():
+                refresh_vswitch_table(window, dispatcher)
+        if event == "-APPLY_NETWORK_SPEC-":
+            spec_path = sg.popup_get_file("选择网络配置文件", file_types=_NETWORK_SPEC_FILE_TYPES)
+            if spec_path:
+                apply_network_spec(window, dispatcher, spec_path)
+        if event == "-EXPORT_NETWORK_SPEC-":
+            spec_path = sg.popup_get_file("导出到", save_as=True, default_extension=".yaml", file_types=_NETWORK_SPEC_FILE_TYPES)
+            if spec_path:
+                export_network_spec(dispatcher, spec_path)
+        if event == "-ADD_NAT_RULE-" and selected_vswitch_name:
+            if create_add_nat_rule_window(selected_vswitch_name, window.metadata.get("nat_index")):
+                load_nat_panel(window, dispatcher, selected_vswitch_name)
+        if event == "-DELETE_NAT_RULE-" and selected_vswitch_name:
+            nat_rule_keys = get_selected_keys(window["-NAT_RULES_TABLE-"], key_column=NAT_RULE_TABLE_KEY)
+            if nat_rule_keys and sg.popup_yes_no(f"确定要删除所选的 {len(nat_rule_keys)} 条端口转发规则吗？", title="确认删除") == "Yes":
+                delete_nat_rules(window, dispatcher, selected_vswitch_name, nat_rule_keys)
+        if event == "-NAT_FILTER_IP-":
+            filter_nat_rules(window, values["-NAT_FILTER_IP-"])
+        if event == "-IMPORT_NAT_RULES-" and selected_vswitch_name:
+            rules_path = sg.popup_get_file("选择端口转发规则文件 (CSV 或 JSON)", file_types=_NAT_RULE_FILE_TYPES)
+            if rules_path:
+                import_nat_rule_file(window, dispatcher, selected_vswitch_name, rules_path)
+        if event == "-EXPORT_NAT_RULES-" and selected_vswitch_name:
+            rules_path = sg.popup_get_file("导出到", save_as=True, default_extension=".csv", file_types=_NAT_RULE_FILE_TYPES)
+            if rules_path:
+                export_nat_rule_file(dispatcher, selected_vswitch_name, rules_path)
 
         if event == "-VSWITCH_TABLE-":
             if values["-VSWITCH_TABLE-"]:
@@ -376,23 +1061,44 @@ def main():
                 window["-DELETE_VSWITCH-"].update(disabled=False)
                 if switch_type == 'Internal':
                     is_nat_enabled = "NAT: 已启用" in nat_status_text
-                    nat_rules_data = []
+                    # The panel shows up at once; the rules are filled in when they are loaded
+                    show_nat_panel(window, selected_vswitch_name, is_nat_enabled)
                     if is_nat_enabled:
-                        nat_rules = get_nat_rules(selected_vswitch_name)
-                        nat_rules_data = [[r.get('Protocol', 'N/A'), r.get('ExternalPort', 'N/A'), r.get('InternalIPAddress', 'N/A'), r.get('InternalPort', 'N/A')] for r in nat_rules]
-                    nat_panel_layout = [[sg.Frame("NAT 网络详情", [
-                        [sg.Text(f"交换机 '{selected_vswitch_name}' 的NAT状态: {'已启用' if is_nat_enabled else '未启用'}")],
-                        [sg.Button("创建NAT网络", key="-CREATE_NAT-", disabled=is_nat_enabled), sg.Button("添加端口转发", key="-ADD_NAT_RULE-", disabled=not is_nat_enabled)],
-                        [sg.Table(values=nat_rules_data, headings=["协议", "外部端口", "内部IP", "内部端口"], key="-NAT_RULES_TABLE-", auto_size_columns=False, justification='left', expand_x=True)],
-                        [sg.Button("删除所选规则", key="-DELETE_NAT_RULE-", disabled=not is_nat_enabled)]
-                    ], expand_x=True, vertical_alignment='top')]]
-                    window['-NAT_CONTAINER-'].update(sg.Column(nat_panel_layout))
+                        load_nat_panel(window, dispatcher, selected_vswitch_name)
                 else:
                     window['-NAT_CONTAINER-'].update(sg.Column([[]]))
             else:
                 selected_vswitch_name = None
                 window['-NAT_CONTAINER-'].update(sg.Column([[]]))
 
+        if event == "-SCAN_LOCAL-":
+            start_local_image_scan(window, image_scanner, values["-SCAN_PATH-"])
+        if event == LOCAL_IMAGES_EVENT:
+            show_local_images(window, image_scanner, values[event])
+        if event == "-LOCAL_IMG_TABLE-":
+            # Virtual disks can be used as templates for new VMs
+            selected_images = get_selected_keys(window["-LOCAL_IMG_TABLE-"], key_column=2)
+            window["-CREATE_FROM_LOCAL-"].update(disabled=not (selected_images and selected_images[0].lower().endswith((".vhd", ".vhdx"))))
+        if event == "-CREATE_FROM_LOCAL-":
+            selected_images = get_selected_keys(window["-LOCAL_IMG_TABLE-"], key_column=2)
+            if selected_images:
+                create_from_template_window(selected_images[0])
+
+        if event == "-CHECK_HYPERV-":
+            window["-STATUS_TEXT-"].update("正在检查 Hyper-V 状态...")
+            check_hyperv(window, dispatcher)
+        if event == "-INSTALL_HYPERV-":
+            window["-INSTALL_HYPERV-"].update(disabled=True)
+            run_hyperv_install(window, dispatcher)
+
+        tick += 1
+        update_task_status(window, dispatcher, tick)
+        show_install_progress(window)
+
+    vm_watcher.stop()
+    image_scanner.stop()
+    metrics_sampler.stop()
+    dispatcher.shutdown()
     window.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,156 @@
+def _as_list(value):
+    # PowerShell serializes a single-element array as the element itself and an empty one as null
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+class _Record:
+    """Base of the typed records parsed from PowerShell output.
+
+    Subclasses list their fields in _FIELDS as (attribute, JSON property, converter)
+    tuples, in constructor order; __slots__ keeps large inventories compact.
+    """
+    __slots__ = ()
+    _FIELDS = ()
+
+    def __init__(self, *args, **kwargs):
+        for (attribute, _, _), value in zip(self._FIELDS, args):
+            setattr(self, attribute, value)
+        for attribute, _, convert in self._FIELDS[len(args):]:
+            setattr(self, attribute, kwargs.pop(attribute, convert(None)))
+        if kwargs:
+            raise TypeError(f"{type(self).__name__} got unexpected fields: {', '.join(kwargs)}")
+
+    @classmethod
+    def from_json(cls, record):
+        """Builds a record from one decoded JSON object; missing properties get defaults."""
+        obj = cls.__new__(cls)
+        for attribute, prop, convert in cls._FIELDS:
+            setattr(obj, attribute, convert(record.get(prop)))
+        return obj
+
+    def astuple(self):
+        return tuple(getattr(self, attribute) for attribute, _, _ in self._FIELDS)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.astuple() == other.astuple()
+
+    def __repr__(self):
+        fields = ", ".join(f"{attribute}={getattr(self, attribute)!r}" for attribute, _, _ in self._FIELDS)
+        return f"{type(self).__name__}({fields})"
+
+
+def _text(value):
+    return "" if value is None else str(value)
+
+def _optional_text(value):
+    return None if value is None else str(value)
+
+def _integer(value):
+    return int(value or 0)
+
+def _optional_number(value):
+    return None if value is None else float(value)
+
+def _text_list(value):
+    return [str(item) for item in _as_list(value)]
+
+def _integer_or_unknown(value):
+    # ProgressRecord uses -1 for "not known"
+    return -1 if value is None else int(value)
+
+
+class Adapter(_Record):
+    """A VM network adapter (Get-VMNetworkAdapter)."""
+    __slots__ = ("vm_name", "vm_id", "name", "switch_name", "status", "ip_addresses")
+    _FIELDS = (
+        ("vm_name", "VMName", _text),
+        # Names are not unique in Hyper-V; the Id of the owning VM is
+        ("vm_id", "VMId", _optional_text),
+        ("name", "Name", _text),
+        ("switch_name", "SwitchName", _optional_text),
+        ("status", "Status", _optional_text),
+        ("ip_addresses", "IPAddresses", _text_list),
+    )
+
+
+class VM(_Record):
+    """A virtual machine (Get-VM); adapters and host are filled in by the inventory query."""
+    __slots__ = ("name", "id", "state", "uptime_seconds", "memory_assigned", "cpu_usage", "guest_os", "ip_addresses", "adapters", "host")
+    _FIELDS = (
+        ("name", "Name", _text),
+        ("id", "Id", _optional_text),
+        # The VMState enum value, e.g. 2 = running, 3 = off
+        ("state", "State", _integer),
+        ("uptime_seconds", "UptimeSeconds", _integer),
+        ("memory_assigned", "MemoryAssigned", _integer),
+        ("cpu_usage", "CPUUsage", _integer),
+        ("guest_os", "GuestOS", _optional_text),
+        ("ip_addresses", "IPAddresses", _text_list),
+        ("adapters", "Adapters", _as_list),
+        # The registered Hyper-V host the VM runs on, see config.get_hosts()
+        ("host", "Host", _optional_text),
+    )
+
+
+class Switch(_Record):
+    """A virtual switch (Get-VMSwitch)."""
+    __slots__ = ("name", "switch_type", "notes")
+    _FIELDS = (
+        ("name", "Name", _text),
+        ("switch_type", "SwitchType", _text),
+        ("notes", "Notes", _text),
+    )
+
+
+class NatNetwork(_Record):
+    """A NAT network (Get-NetNat)."""
+    __slots__ = ("name", "internal_prefix")
+    _FIELDS = (
+        ("name", "Name", _text),
+        ("internal_prefix", "InternalIPInterfaceAddressPrefix", _text),
+    )
+
+
+class NatRule(_Record):
+    """A NAT port mapping (Get-NetNatStaticMapping)."""
+    __slots__ = ("protocol", "external_port", "internal_ip", "internal_port")
+    _FIELDS = (
+        ("protocol", "Protocol", _text),
+        ("external_port", "ExternalPort", _integer),
+        ("internal_ip", "InternalIPAddress", _text),
+        ("internal_port", "InternalPort", _integer),
+    )
+
+
+class VMMetrics(_Record):
+    """One metrics sample of a VM; the Measure-VM totals are None while resource metering is off."""
+    __slots__ = ("name", "cpu_usage", "memory_assigned", "disk_read_mb", "disk_write_mb", "network_in_mb", "network_out_mb", "host")
+    _FIELDS = (
+        ("name", "Name", _text),
+        ("cpu_usage", "CPUUsage", _integer),
+        ("memory_assigned", "MemoryAssigned", _integer),
+        # Cumulative since metering was enabled, in MB
+        ("disk_read_mb", "DiskReadMB", _optional_number),
+        ("disk_write_mb", "DiskWriteMB", _optional_number),
+        ("network_in_mb", "NetworkInMB", _optional_number),
+        ("network_out_mb", "NetworkOutMB", _optional_number),
+        ("host", "Host", _optional_text),
+    )
+
+
+class Progress(_Record):
+    """A progress record (Write-Progress) of a running command."""
+    __slots__ = ("activity_id", "parent_id", "activity", "status", "current_operation", "percent", "seconds_remaining", "completed")
+    _FIELDS = (
+        ("activity_id", "ActivityId", _integer),
+        ("parent_id", "ParentActivityId", _integer_or_unknown),
+        ("activity", "Activity", _text),
+        ("status", "StatusDescription", _text),
+        ("current_operation", "CurrentOperation", _text),
+        # 0-100, or -1 when the command cannot tell
+        ("percent", "PercentComplete", _integer_or_unknown),
+        ("seconds_remaining", "SecondsRemaining", _integer_or_unknown),
+        ("completed", "Completed", bool),
+    )
@@ -0,0 +1,264 @@
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from image_metadata import read_image_metadata
+
+IMAGE_EXTENSIONS = (".iso", ".vhdx", ".vhd")
+# Kept next to the scripts, like online_images_repository.json
+DEFAULT_INDEX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "image_index.db")
+# Found images are reported in batches of this many, or at least this often (seconds)
+SCAN_BATCH_SIZE = 500
+SCAN_BATCH_INTERVAL = 0.2
+# Directories listed at the same time; on network shares each listing is mostly waiting
+SCAN_WORKERS = 8
+
+_1MB = 1024 * 1024
+_1GB = 1024 * 1024 * 1024
+
+# Bumped whenever the tables change; an index with another version is rebuilt
+_SCHEMA_VERSION = 2
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    label TEXT,
+    virtual_size INTEGER,
+    disk_type TEXT
+);
+CREATE INDEX IF NOT EXISTS images_dir ON images (dir);
+"""
+_IMAGE_COLUMNS = ("path", "name", "size", "mtime_ns", "label", "virtual_size", "disk_type")
+
+def format_size(size):
+    return f"{size / _1GB:.2f} GB" if size > _1GB else f"{size / _1MB:.2f} MB"
+
+def _is_image(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+def _subtree_bounds(path):
+    # Every path below `path` sorts between these two strings
+    return path + os.sep, path + chr(ord(os.sep) + 1)
+
+def _image_dict(row):
+    image = dict(zip(_IMAGE_COLUMNS, row))
+    image["mtime"] = image.pop("mtime_ns") / 1e9
+    return image
+
+def _read_dir(path, known_mtime_ns, known_images):
+    """Runs on a scan worker: lists path unless its mtime is still known_mtime_ns.
+
+    Returns (mtime_ns, None) for an unchanged directory, else (mtime_ns, (subdirs, images))
+    with images as rows in _IMAGE_COLUMNS order. The headers of new or changed images
+    are read here too, so that work is spread over the workers as well.
+    """
+    mtime_ns = os.stat(path).st_mtime_ns
+    if mtime_ns == known_mtime_ns:
+        return mtime_ns, None
+    subdirs = []
+    images = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif _is_image(entry.name) and entry.is_file():
+                    stat = entry.stat()
+                    known = known_images.get(entry.path)
+                    if known and known[2] == stat.st_size and known[3] == stat.st_mtime_ns:
+                        images.append(known)
+                    else:
+                        metadata = read_image_metadata(entry.path)
+                        images.append((entry.path, entry.name, stat.st_size, stat.st_mtime_ns,
+                                       metadata["label"], metadata["virtual_size"], metadata["disk_type"]))
+            except OSError as e:
+                print(f"Error reading file {entry.path}: {e}")
+    subdirs.sort()
+    images.sort()
+    return mtime_ns, (subdirs, images)
+
+
+class ImageIndex:
+    """A persistent SQLite index of the image files below the scanned folders.
+
+    Every directory is stored with its mtime and every image with its size, mtime
+    and header metadata (see read_image_metadata()). Adding, removing or renaming
+    a file changes the mtime of its directory, so a rescan lists only the
+    directories whose mtime changed and takes the images of all other directories
+    from the index.
+    """
+
+    def __init__(self, index_file=DEFAULT_INDEX_FILE, workers=SCAN_WORKERS):
+        self.index_file = index_file
+        self.workers = workers
+
+    def _connect(self):
+        db = sqlite3.connect(self.index_file)
+        if db.execute("PRAGMA user_version").fetchone()[0] != _SCHEMA_VERSION:
+            # The index is only a cache, so an old layout is simply rebuilt
+            db.executescript("DROP TABLE IF EXISTS dirs; DROP TABLE IF EXISTS images;")
+            db.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+        db.executescript(_SCHEMA)
+        return db
+
+    def scan(self, roots, full=False, stop_event=None):
+        """Scans roots for image files, yielding them in batches as they are found.
+
+        All roots and their subdirectories are listed in parallel on a pool of
+        SCAN_WORKERS threads, so batches arrive in no particular order. Each batch
+        is a list of {"name", "path", "size", "mtime", "label", "virtual_size",
+        "disk_type"} dicts, with sizes in bytes. full=True lists every directory
+        again, which also picks up images that were overwritten in place. Setting
+        stop_event ends the scan early; the directories finished so far stay indexed.
+        """
+        db = self._connect()
+        try:
+            batch = []
+            last_yield = time.monotonic()
+            for image in self._walk(db, roots, full, stop_event):
+                batch.append(image)
+                if len(batch) >= SCAN_BATCH_SIZE or time.monotonic() - last_yield >= SCAN_BATCH_INTERVAL:
+                    db.commit()
+                    yield batch
+                    batch = []
+                    last_yield = time.monotonic()
+            db.commit()
+            if batch:
+                yield batch
+        finally:
+            db.close()
+
+    def _walk(self, db, roots, full, stop_event):
+        # Only this thread touches the database; the workers only read the file system
+        pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image-scan")
+        running = {}
+        seen = set()
+
+        def submit(path, parent):
+            if path in seen:
+                return
+            seen.add(path)
+            row = db.execute("SELECT mtime_ns FROM dirs WHERE path = ?", (path,)).fetchone()
+            known_images = {r[0]: r for r in db.execute(
+                f"SELECT {', '.join(_IMAGE_COLUMNS)} FROM images WHERE dir = ?", (path,))}
+            known_mtime_ns = row[0] if row and not full else None
+            future = pool.submit(_read_dir, path, known_mtime_ns, known_images)
+            running[future] = (path, parent, known_images)
+
+        try:
+            for root in roots:
+                root = os.path.abspath(root)
+                if os.path.isdir(root):
+                    submit(root, None)
+                else:
+                    self._forget_subtree(db, root)
+            while running:
+                if stop_event is not None and stop_event.is_set():
+                    return
+                done, _ = wait(running, timeout=SCAN_BATCH_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, parent, known_images = running.pop(future)
+                    try:
+                        mtime_ns, listing = future.result()
+                    except FileNotFoundError:
+                        self._forget_subtree(db, path)
+                        continue
+                    except OSError as e:
+                        print(f"Error reading directory {path}: {e}")
+                        continue
+                    if listing is None:
+                        if parent is not None:
+                            # A directory first indexed as a scan root has no parent yet; without
+                            # one, the unchanged parent would not find it on the next rescan
+                            db.execute("UPDATE dirs SET parent = ? WHERE path = ? AND parent IS NOT ?", (parent, path, parent))
+                        subdirs = [r[0] for r in db.execute("SELECT path FROM dirs WHERE parent = ?", (path,))]
+                        images = known_images.values()
+                    else:
+                        subdirs, images = listing
+                        self._update_dir(db, path, parent, mtime_ns, subdirs, images)
+                    for image in images:
+                        yield _image_dict(image)
+                    for subdir in subdirs:
+                        submit(subdir, path)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _update_dir(self, db, path, parent, mtime_ns, subdirs, images):
+        """Brings the index entries of a changed directory up to date."""
+        known_subdirs = {r[0] for r in db.execute("SELECT path FROM dirs WHERE parent = ?", (path,))}
+        for removed in known_subdirs.difference(subdirs):
+            self._forget_subtree(db, removed)
+        db.execute("DELETE FROM images WHERE dir = ?", (path,))
+        db.executemany(f"INSERT INTO images (dir, {', '.join(_IMAGE_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       [(path,) + tuple(image) for image in images])
+        # A scan root keeps its parent, in case it is also indexed as part of a larger root
+        db.execute("INSERT INTO dirs (path, parent, mtime_ns) VALUES (?, ?, ?) "
+                   "ON CONFLICT (path) DO UPDATE SET parent = COALESCE(excluded.parent, parent), mtime_ns = excluded.mtime_ns",
+                   (path, parent, mtime_ns))
+
+    def _forget_subtree(self, db, path):
+        low, high = _subtree_bounds(path)
+        db.execute("DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)", (path, low, high))
+        db.execute("DELETE FROM images WHERE dir = ? OR (dir >= ? AND dir < ?)", (path, low, high))
+
+
+class ImageScanner:
+    """Runs ImageIndex.scan() on a background thread and streams the results to the GUI.
+
+    Each batch is posted with window.write_event_value(event_key, result), where
+    result is {"scan": scan_id, "images": batch, "done": False}. The last event of
+    a scan has "done": True, the total "count" and an "error" (None on success).
+    Starting a new scan stops the previous one; its scan_id tells stale events apart.
+    """
+
+    def __init__(self, window, event_key, index_file=DEFAULT_INDEX_FILE):
+        self.window = window
+        self.event_key = event_key
+        self.index = ImageIndex(index_file)
+        self.scan_id = 0
+        self._stop_event = threading.Event()
+
+    def start(self, roots, full=False):
+        """Starts scanning roots and returns the id of the new scan."""
+        self.stop()
+        self.scan_id += 1
+        # Fresh event per scan, so stopping the old scan cannot stop the new one
+        self._stop_event = threading.Event()
+        thread = threading.Thread(target=self._run, args=(self.scan_id, list(roots), full, self._stop_event), name="image-scanner")
+        thread.daemon = True
+        thread.start()
+        return self.scan_id
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _post(self, result):
+        try:
+            self.window.write_event_value(self.event_key, result)
+        except Exception:
+            # The window was closed while scanning
+            pass
+
+    def _run(self, scan_id, roots, full, stop_event):
+        count = 0
+        error = None
+        try:
+            for batch in self.index.scan(roots, full, stop_event):
+                if stop_event.is_set():
+                    return
+                count += len(batch)
+                self._post({"scan": scan_id, "images": batch, "done": False})
+        except Exception as e:
+            error = e
+        if not stop_event.is_set():
+            self._post({"scan": scan_id, "images": [], "done": True, "count": count, "error": error})
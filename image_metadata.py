@@ -0,0 +1,94 @@
+import mmap
+import os
+import struct
+import uuid
+
+# ISO 9660: the primary volume descriptor is sector 16, the volume label is at offset 40
+_ISO_PVD_OFFSET = 0x8000
+_ISO_LABEL_OFFSET = 40
+_ISO_LABEL_LENGTH = 32
+
+# VHDX: two copies of the region table follow the two headers
+_VHDX_SIGNATURE = b"vhdxfile"
+_VHDX_REGION_TABLE_OFFSETS = (0x30000, 0x40000)
+_VHDX_METADATA_REGION = uuid.UUID("8B7CA206-4790-4B9A-B8FE-575F050F886E").bytes_le
+_VHDX_FILE_PARAMETERS = uuid.UUID("CAA16737-FA36-4D43-B3B6-33F0AA44E76B").bytes_le
+_VHDX_VIRTUAL_DISK_SIZE = uuid.UUID("2FA54224-CD1B-4876-B211-5DBED83BF4B8").bytes_le
+
+# VHD: a 512-byte footer at the end of the file
+_VHD_COOKIE = b"conectix"
+_VHD_DISK_TYPES = {2: "fixed", 3: "dynamic", 4: "differencing"}
+
+
+def read_image_metadata(path):
+    """Reads the volume label of an ISO, or the virtual size and disk type of a VHD/VHDX.
+
+    Only the few header pages that hold the values are touched, through a
+    read-only memory map, so this is cheap even for multi-gigabyte images.
+    Returns {"label", "virtual_size", "disk_type"}; values that do not apply or
+    cannot be read are None. disk_type is "fixed", "dynamic" or "differencing".
+    """
+    metadata = {"label": None, "virtual_size": None, "disk_type": None}
+    try:
+        with open(path, "rb") as f:
+            # Too small for any of the headers (and empty files cannot be mapped)
+            if os.fstat(f.fileno()).st_size < 512:
+                return metadata
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                if view[:8] == _VHDX_SIGNATURE:
+                    metadata.update(_read_vhdx(view))
+                elif view[-512:-504] == _VHD_COOKIE:
+                    metadata.update(_read_vhd(view))
+                else:
+                    metadata["label"] = _read_iso_label(view)
+    except (OSError, ValueError, struct.error) as e:
+        # Truncated or damaged headers
+        print(f"Error reading image metadata {path}: {e}")
+    return metadata
+
+
+def _read_iso_label(view):
+    descriptor = view[_ISO_PVD_OFFSET:_ISO_PVD_OFFSET + _ISO_LABEL_OFFSET + _ISO_LABEL_LENGTH]
+    if len(descriptor) < _ISO_LABEL_OFFSET + _ISO_LABEL_LENGTH or descriptor[0] != 1 or descriptor[1:6] != b"CD001":
+        return None
+    label = descriptor[_ISO_LABEL_OFFSET:].decode("ascii", "replace").strip(" \x00")
+    return label or None
+
+
+def _read_vhdx(view):
+    for table_offset in _VHDX_REGION_TABLE_OFFSETS:
+        if view[table_offset:table_offset + 4] != b"regi":
+            continue
+        entry_count, = struct.unpack_from("<I", view, table_offset + 8)
+        for i in range(entry_count):
+            entry = table_offset + 16 + i * 32
+            if view[entry:entry + 16] == _VHDX_METADATA_REGION:
+                region_offset, = struct.unpack_from("<Q", view, entry + 16)
+                return _read_vhdx_metadata(view, region_offset)
+    return {}
+
+
+def _read_vhdx_metadata(view, region_offset):
+    if view[region_offset:region_offset + 8] != b"metadata":
+        return {}
+    entry_count, = struct.unpack_from("<H", view, region_offset + 10)
+    metadata = {}
+    for i in range(entry_count):
+        entry = region_offset + 32 + i * 32
+        item_id = view[entry:entry + 16]
+        # Item offsets are relative to the start of the metadata region
+        item_offset = region_offset + struct.unpack_from("<I", view, entry + 16)[0]
+        if item_id == _VHDX_VIRTUAL_DISK_SIZE:
+            metadata["virtual_size"], = struct.unpack_from("<Q", view, item_offset)
+        elif item_id == _VHDX_FILE_PARAMETERS:
+            flags, = struct.unpack_from("<I", view, item_offset + 4)
+            # Bit 0: blocks stay allocated (fixed disk), bit 1: the disk has a parent
+            metadata["disk_type"] = "differencing" if flags & 2 else "fixed" if flags & 1 else "dynamic"
+    return metadata
+
+
+def _read_vhd(view):
+    footer = len(view) - 512
+    virtual_size, = struct.unpack_from(">Q", view, footer + 48)
+    disk_type, = struct.unpack_from(">I", view, footer + 60)
+    return {"virtual_size": virtual_size, "disk_type": _VHD_DISK_TYPES.get(disk_type)}
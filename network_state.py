@@ -0,0 +1,479 @@
+import csv
+import ipaddress
+import json
+from hyperv_models import NatRule
+from powershell_utils import get_network_state, apply_network_changes
+
+SWITCH_TYPES = ("External", "Internal", "Private")
+PROTOCOLS = ("TCP", "UDP")
+# Managed by Windows; never removed by prune
+_PROTECTED_SWITCHES = ("Default Switch",)
+
+# Removals first, so a port or address that moves is free again before it is added
+_ACTION_ORDER = ("remove_mapping", "remove_nat", "remove_ip", "remove_switch",
+                 "create_switch", "set_switch", "add_ip", "create_nat", "add_mapping")
+
+
+def _import_yaml():
+    # PyYAML is optional: JSON specs work without it
+    try:
+        import yaml
+    except ImportError:
+        raise ImportError("YAML network specs require the PyYAML package (pip install pyyaml).")
+    return yaml
+
+
+def _is_yaml(path):
+    return path.lower().endswith((".yaml", ".yml"))
+
+
+def load_network_spec(path):
+    """Reads a desired network state from a YAML (.yaml/.yml) or JSON file; see parse_network_spec().
+
+    Raises ValueError for a file that cannot be parsed or is not a valid spec.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        if not _is_yaml(path):
+            return parse_network_spec(json.load(f))
+        yaml = _import_yaml()
+        try:
+            data = yaml.safe_load(f)
+        except yaml.YAMLError as e:
+            raise ValueError(f"Invalid YAML in {path}: {e}")
+    return parse_network_spec(data)
+
+
+def save_network_spec(data, path):
+    """Writes a spec (e.g. from network_spec_from_state()) as YAML or JSON, by the file extension."""
+    with open(path, "w", encoding="utf-8") as f:
+        if _is_yaml(path):
+            _import_yaml().safe_dump(data, f, allow_unicode=True, sort_keys=False)
+        else:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+
+
+def _port(value, what):
+    try:
+        port = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{what} must be a port number, got {value!r}")
+    if not 1 <= port <= 65535:
+        raise ValueError(f"{what} must be between 1 and 65535, got {port}")
+    return port
+
+
+def _parse_mapping(item, where):
+    # where names the mapping in error messages, e.g. "NAT 'NATSwitch'" or "row 3"
+    if not isinstance(item, dict):
+        raise ValueError(f"Port mappings of {where} must be objects")
+    protocol = str(item.get("protocol", "TCP")).upper()
+    if protocol not in PROTOCOLS:
+        raise ValueError(f"Unknown protocol {protocol!r} in {where}")
+    external_port = _port(item.get("external_port"), f"external_port in {where}")
+    try:
+        internal_ip = str(ipaddress.IPv4Address(str(item.get("internal_ip"))))
+    except ValueError:
+        raise ValueError(f"internal_ip {item.get('internal_ip')!r} in {where} is not an IPv4 address")
+    internal_port = _port(item.get("internal_port", external_port), f"internal_port in {where}")
+    return NatRule(protocol, external_port, internal_ip, internal_port)
+
+
+def _parse_nat(value, switch_name, ip):
+    if value is None:
+        return None
+    if value is False:
+        return False
+    value = {} if value is True else value
+    if not isinstance(value, dict):
+        raise ValueError(f"nat of switch '{switch_name}' must be true, false or an object")
+    prefix = value.get("prefix")
+    if prefix is None:
+        if ip is None:
+            raise ValueError(f"NAT of switch '{switch_name}' needs a prefix or a switch ip")
+        prefix = f"{ip[0]}/{ip[1]}"
+    try:
+        prefix = str(ipaddress.IPv4Network(str(prefix), strict=False))
+    except ValueError:
+        raise ValueError(f"NAT prefix {prefix!r} of switch '{switch_name}' is not an IPv4 network")
+    mappings = {}
+    for item in value.get("mappings") or []:
+        rule = _parse_mapping(item, f"NAT '{switch_name}'")
+        key = (rule.protocol, rule.external_port)
+        if key in mappings:
+            raise ValueError(f"NAT '{switch_name}' maps {rule.protocol} port {rule.external_port} twice")
+        mappings[key] = rule
+    return {"prefix": prefix, "mappings": mappings}
+
+
+def parse_network_spec(data):
+    """Validates a desired network state and returns it normalized.
+
+    The spec lists virtual switches; an Internal switch can have a gateway
+    address for its host adapter and a NAT named after it, as the manager
+    creates them:
+
+        prune: false            # true also removes switches and NATs not listed
+        switches:
+          - name: NATSwitch
+            type: Internal      # External needs "adapter", the physical adapter name
+            ip: 172.16.0.1/24   # the only IPv4 address of vEthernet (NATSwitch)
+            nat:                # true for a NAT over the network of ip; false removes it
+              prefix: 172.16.0.0/24
+              mappings:
+                - {protocol: TCP, external_port: 8080, internal_ip: 172.16.0.11, internal_port: 80}
+
+    Keys that are left out are left alone. The mappings of a listed NAT are
+    exact: mappings that are not listed are removed. Raises ValueError.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("A network spec must be an object with a 'switches' list")
+    switches = {}
+    for item in data.get("switches") or []:
+        if not isinstance(item, dict) or not item.get("name"):
+            raise ValueError("Every switch needs a name")
+        name = str(item["name"])
+        if name in switches:
+            raise ValueError(f"Switch '{name}' is listed twice")
+        switch_type = str(item.get("type", "Internal")).capitalize()
+        if switch_type not in SWITCH_TYPES:
+            raise ValueError(f"Unknown type {item.get('type')!r} of switch '{name}'")
+        ip = None
+        if item.get("ip") is not None:
+            if switch_type == "Private":
+                raise ValueError(f"Private switch '{name}' has no host adapter for ip")
+            try:
+                interface = ipaddress.IPv4Interface(str(item["ip"]))
+            except ValueError:
+                raise ValueError(f"ip {item['ip']!r} of switch '{name}' is not an IPv4 address with a prefix length")
+            ip = (str(interface.ip), interface.network.prefixlen)
+        switches[name] = {
+            "type": switch_type,
+            "adapter": item.get("adapter"),
+            "ip": ip,
+            "nat": _parse_nat(item.get("nat"), name, ip),
+        }
+    return {"prune": bool(data.get("prune", False)), "switches": switches}
+
+
+def _normalize_prefix(prefix):
+    try:
+        return str(ipaddress.IPv4Network(prefix, strict=False))
+    except ValueError:
+        return prefix
+
+
+def _mapping_params(nat_name, rule):
+    return {"nat": nat_name, "protocol": rule.protocol.upper(), "external_port": rule.external_port,
+            "internal_ip": rule.internal_ip, "internal_port": rule.internal_port}
+
+
+def _mapping_item(rule):
+    return {"protocol": rule.protocol, "external_port": rule.external_port,
+            "internal_ip": rule.internal_ip, "internal_port": rule.internal_port}
+
+
+def plan_network_changes(spec, state):
+    """Computes the changes that turn state (see get_network_state()) into spec.
+
+    Returns the minimal list of (action, params) changes, removals first, for
+    apply_network_changes(). Raises ValueError for a change that cannot be made,
+    e.g. an External switch without an adapter.
+    """
+    changes = []
+    removed_nats = set()
+    for name, switch in spec["switches"].items():
+        current = state["switches"].get(name)
+        switch_params = {"switch": name, "type": switch["type"], "adapter": switch["adapter"]}
+        if switch["type"] == "External" and not switch["adapter"] and (
+                current is None or current.switch_type != "External"):
+            raise ValueError(f"External switch '{name}' needs an adapter")
+        if current is None:
+            changes.append(("create_switch", switch_params))
+        elif current.switch_type != switch["type"] or (
+                switch["type"] == "External" and switch["adapter"] and state["adapters"].get(name) != switch["adapter"]):
+            changes.append(("set_switch", switch_params))
+
+        if switch["ip"] is not None:
+            addresses = state["ips"].get(name, []) if current else []
+            for ip, prefix_length in addresses:
+                if (ip, prefix_length) != switch["ip"]:
+                    changes.append(("remove_ip", {"switch": name, "ip": ip, "prefix_length": prefix_length}))
+            if switch["ip"] not in addresses:
+                changes.append(("add_ip", {"switch": name, "ip": switch["ip"][0], "prefix_length": switch["ip"][1]}))
+
+        nat = switch["nat"]
+        current_nat = state["nats"].get(name)
+        if nat is False or (nat is None and spec["prune"]):
+            if current_nat is not None:
+                changes.append(("remove_nat", {"nat": name}))
+                removed_nats.add(name)
+            continue
+        if nat is None:
+            continue
+        current_mappings = state["mappings"].get(name, {}) if current_nat else {}
+        if current_nat is not None and _normalize_prefix(current_nat.internal_prefix) != nat["prefix"]:
+            # The prefix of a NAT cannot be changed; removing it also removes its mappings
+            changes.append(("remove_nat", {"nat": name}))
+            removed_nats.add(name)
+            current_nat = None
+            current_mappings = {}
+        if current_nat is None:
+            changes.append(("create_nat", {"nat": name, "prefix": nat["prefix"]}))
+        for key, rule in current_mappings.items():
+            if nat["mappings"].get(key) != rule:
+                changes.append(("remove_mapping", _mapping_params(name, rule)))
+        for key, rule in nat["mappings"].items():
+            if current_mappings.get(key) != rule:
+                changes.append(("add_mapping", _mapping_params(name, rule)))
+
+    if spec["prune"]:
+        for name in state["switches"]:
+            if name not in spec["switches"] and name not in _PROTECTED_SWITCHES:
+                changes.append(("remove_switch", {"switch": name}))
+        for name in state["nats"]:
+            if name not in spec["switches"] and name not in removed_nats:
+                changes.append(("remove_nat", {"nat": name}))
+    # Stable sort: changes of one kind keep the order of the spec
+    changes.sort(key=lambda change: _ACTION_ORDER.index(change[0]))
+    return changes
+
+
+def format_change(change):
+    """A one-line description of a planned change."""
+    action, params = change
+    if action in ("add_mapping", "remove_mapping"):
+        verb = "Add" if action == "add_mapping" else "Remove"
+        return (f"{verb} port mapping {params['protocol']} {params['external_port']} -> "
+                f"{params['internal_ip']}:{params['internal_port']} on NAT '{params['nat']}'")
+    if action == "create_switch":
+        adapter = f" on adapter '{params['adapter']}'" if params["type"] == "External" else ""
+        return f"Create {params['type']} switch '{params['switch']}'{adapter}"
+    if action == "set_switch":
+        adapter = f" on adapter '{params['adapter']}'" if params["type"] == "External" else ""
+        return f"Change switch '{params['switch']}' to {params['type']}{adapter}"
+    if action == "remove_switch":
+        return f"Remove switch '{params['switch']}'"
+    if action == "add_ip":
+        return f"Set gateway {params['ip']}/{params['prefix_length']} on switch '{params['switch']}'"
+    if action == "remove_ip":
+        return f"Remove address {params['ip']}/{params['prefix_length']} from switch '{params['switch']}'"
+    if action == "create_nat":
+        return f"Create NAT '{params['nat']}' for {params['prefix']}"
+    if action == "remove_nat":
+        return f"Remove NAT '{params['nat']}'"
+    return f"{action} {params}"
+
+
+def plan_network(spec):
+    """Reads the current state and plans the changes towards spec; returns (success, changes or error)."""
+    success, state = get_network_state()
+    if not success:
+        return False, state
+    try:
+        return True, plan_network_changes(spec, state)
+    except ValueError as e:
+        return False, str(e)
+
+
+def reconcile_network(spec):
+    """Brings the host's network to spec: one query, a minimal plan and one script.
+
+    Returns (success, [(change, success, message)]), or (False, error message)
+    when the plan cannot be made. success is False if any change failed.
+    """
+    success, changes = plan_network(spec)
+    if not success:
+        return False, changes
+    results = [(change,) + result for change, result in zip(changes, apply_network_changes(changes))]
+    return all(ok for _, ok, _ in results), results
+
+
+def network_spec_from_state(state):
+    """Describes the current state (see get_network_state()) as spec data, e.g. to start a spec file from.
+
+    Only NATs named after a switch can be described; the Default Switch is left out.
+    """
+    switches = []
+    for name, switch in state["switches"].items():
+        if name in _PROTECTED_SWITCHES:
+            continue
+        item = {"name": name, "type": switch.switch_type}
+        if name in state["adapters"]:
+            item["adapter"] = state["adapters"][name]
+        addresses = state["ips"].get(name, [])
+        if len(addresses) == 1:
+            item["ip"] = f"{addresses[0][0]}/{addresses[0][1]}"
+        nat = state["nats"].get(name)
+        if nat is not None:
+            item["nat"] = {
+                "prefix": nat.internal_prefix,
+                "mappings": [_mapping_item(rule) for rule in state["mappings"].get(name, {}).values()],
+            }
+        switches.append(item)
+    return {"prune": False, "switches": switches}
+
+
+class NatRuleIndex:
+    """The port mappings of one NAT, indexed for constant-time lookups.
+
+    Rules are keyed by (protocol, external port), which NAT itself keeps unique,
+    and grouped by internal IP, e.g. to find every mapping of one VM. Protocols
+    are matched in upper case.
+    """
+
+    def __init__(self, rules=()):
+        self._by_port = {}
+        # internal ip -> {(protocol, external port): NatRule}
+        self._by_ip = {}
+        for rule in rules:
+            self.add(rule)
+
+    def __len__(self):
+        return len(self._by_port)
+
+    def __iter__(self):
+        return iter(list(self._by_port.values()))
+
+    @staticmethod
+    def key(protocol, external_port):
+        return (str(protocol).upper(), int(external_port))
+
+    def get(self, protocol, external_port):
+        return self._by_port.get(self.key(protocol, external_port))
+
+    def for_internal_ip(self, internal_ip):
+        """Returns the rules that forward to internal_ip."""
+        return list(self._by_ip.get(internal_ip, {}).values())
+
+    def conflict(self, rule):
+        """Returns the rule that already uses the protocol and external port of rule
+        but forwards elsewhere, or None."""
+        existing = self.get(rule.protocol, rule.external_port)
+        if existing is None or self._same(existing, rule):
+            return None
+        return existing
+
+    def add(self, rule):
+        """Adds a rule; raises ValueError if its protocol and external port forward elsewhere."""
+        existing = self.conflict(rule)
+        if existing is not None:
+            raise ValueError(f"{existing.protocol} port {existing.external_port} is already mapped to "
+                             f"{existing.internal_ip}:{existing.internal_port}")
+        key = self.key(rule.protocol, rule.external_port)
+        self._by_port[key] = rule
+        self._by_ip.setdefault(rule.internal_ip, {})[key] = rule
+
+    def remove(self, protocol, external_port):
+        """Drops the rule of a protocol and external port; returns it, or None if there is none."""
+        key = self.key(protocol, external_port)
+        rule = self._by_port.pop(key, None)
+        if rule is not None:
+            by_port = self._by_ip[rule.internal_ip]
+            del by_port[key]
+            if not by_port:
+                del self._by_ip[rule.internal_ip]
+        return rule
+
+    @staticmethod
+    def _same(a, b):
+        return (a.protocol.upper(), a.external_port, a.internal_ip, a.internal_port) == (
+            b.protocol.upper(), b.external_port, b.internal_ip, b.internal_port)
+
+
+_NAT_RULE_COLUMNS = ("protocol", "external_port", "internal_ip", "internal_port")
+
+
+def _is_csv(path):
+    return path.lower().endswith(".csv")
+
+
+def read_nat_rules(path):
+    """Reads port mappings from a CSV (.csv) or JSON file.
+
+    A CSV file has a header row with the columns protocol, external_port,
+    internal_ip and internal_port; a JSON file holds a list of objects with
+    those keys. protocol defaults to TCP and internal_port to external_port.
+    Returns NatRule records; raises ValueError for an invalid row or a
+    protocol and external port that are listed twice.
+    """
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if _is_csv(path):
+            reader = csv.DictReader(f)
+            missing = [column for column in ("external_port", "internal_ip") if column not in (reader.fieldnames or [])]
+            if missing:
+                raise ValueError(f"{path} has no {', '.join(missing)} column")
+            # Empty cells take the defaults, like keys left out of a JSON object
+            items = [{key: value for key, value in row.items() if key and value not in (None, "")} for row in reader]
+            first_row = 2
+        else:
+            try:
+                items = json.load(f)
+            except ValueError as e:
+                raise ValueError(f"Invalid JSON in {path}: {e}")
+            if not isinstance(items, list):
+                raise ValueError(f"{path} must hold a list of port mappings")
+            first_row = 1
+    index = NatRuleIndex()
+    rules = []
+    for row, item in enumerate(items, first_row):
+        rule = _parse_mapping(item, f"{path} row {row}")
+        if index.get(rule.protocol, rule.external_port) is not None:
+            raise ValueError(f"{path} row {row} maps {rule.protocol} port {rule.external_port} again")
+        index.add(rule)
+        rules.append(rule)
+    return rules
+
+
+def write_nat_rules(rules, path):
+    """Writes port mappings as CSV or JSON, by the file extension; see read_nat_rules()."""
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        if _is_csv(path):
+            writer = csv.DictWriter(f, fieldnames=_NAT_RULE_COLUMNS)
+            writer.writeheader()
+            writer.writerows(_mapping_item(rule) for rule in rules)
+        else:
+            json.dump([_mapping_item(rule) for rule in rules], f, indent=4)
+
+
+def load_nat_index(nat_name):
+    """Reads the current port mappings of a NAT, uncached; returns (success, NatRuleIndex or error)."""
+    success, state = get_network_state()
+    if not success:
+        return False, state
+    if nat_name not in state["nats"]:
+        return False, f"NAT '{nat_name}' does not exist"
+    return True, NatRuleIndex(state["mappings"].get(nat_name, {}).values())
+
+
+def plan_nat_import(nat_name, index, rules, replace=False):
+    """Computes the changes that add rules to the NAT whose mappings are index.
+
+    Rules that are already there are skipped. A rule whose protocol and external
+    port forward elsewhere is a conflict: with replace the existing mapping is
+    removed first, otherwise the rule is left out. Returns (changes, conflicts)
+    with changes for apply_network_changes() and conflicts as
+    [(rule, existing rule)].
+    """
+    changes = []
+    conflicts = []
+    for rule in rules:
+        existing = index.get(rule.protocol, rule.external_port)
+        if existing is not None:
+            if index.conflict(rule) is None:
+                continue
+            conflicts.append((rule, existing))
+            if not replace:
+                continue
+            changes.append(("remove_mapping", _mapping_params(nat_name, existing)))
+        changes.append(("add_mapping", _mapping_params(nat_name, rule)))
+    changes.sort(key=lambda change: _ACTION_ORDER.index(change[0]))
+    return changes, conflicts
+
+
+def plan_nat_removal(nat_name, index, keys):
+    """Computes the changes that remove the mappings of (protocol, external port) keys.
+
+    Keys that index does not know are ignored. Returns changes for apply_network_changes().
+    """
+    rules = (index.get(protocol, external_port) for protocol, external_port in keys)
+    return [("remove_mapping", _mapping_params(nat_name, rule)) for rule in rules if rule is not None]
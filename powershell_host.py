@@ -0,0 +1,449 @@
+import atexit
+import base64
+import itertools
+import json
+import queue
+import subprocess
+import threading
+import time
+
+# Every frame written by the host script starts with this marker, so stray
+# console output (e.g. Write-Host from a command) is simply ignored.
+_FRAME_MARKER = "@@PSHOST"
+
+# The host reads one request per line ("<id> <base64 utf-8 script>") from stdin,
+# runs it in a worker runspace and answers with a single frame line:
+#   @@PSHOST <id> END <OK|ERR> <base64 stdout> <base64 stderr>
+# As with powershell -Command, a command fails on a terminating error, when its last
+# statement fails ($? is false) or when it exits with a non-zero code; other errors
+# are only returned in stderr.
+# A request with a third field "S" streams its output instead: each record is sent
+# as soon as it is written, before the END frame (which carries no stdout):
+#   @@PSHOST <id> OUT <base64 text>              an output object
+#   @@PSHOST <id> ERR <base64 text>              an error or warning
+#   @@PSHOST <id> PROGRESS <base64 json>         a progress record (Write-Progress)
+# Base64 keeps the protocol independent of the console code page.
+_HOST_SCRIPT = r"""
+$ErrorActionPreference = 'Continue'
+$ProgressPreference = 'SilentlyContinue'
+Import-Module Hyper-V -ErrorAction SilentlyContinue
+$utf8 = New-Object System.Text.UTF8Encoding $false
+$statusMarker = '@@PSHOST_STATUS '
+function Send-Frame([string]$text) {
+    [Console]::Out.WriteLine("@@PSHOST $text")
+    [Console]::Out.Flush()
+}
+function ConvertTo-Base64([string]$text) {
+    if (-not $text) { return '' }
+    return [Convert]::ToBase64String($utf8.GetBytes($text))
+}
+function Get-CommandRunspace {
+    # Commands run in a runspace of their own: state a command stores in $global: survives
+    # until the next one, and an `exit` in a command only ends that command, not the host
+    if ($null -eq $global:CommandRunspace -or $global:CommandRunspace.RunspaceStateInfo.State -ne 'Opened') {
+        $global:CommandRunspace = [RunspaceFactory]::CreateRunspace()
+        $global:CommandRunspace.Open()
+    }
+    return $global:CommandRunspace
+}
+function Invoke-HostCommand([string]$id, [string]$script, [bool]$stream) {
+    # The command's last output is the $? of its last statement, like the exit code of powershell -Command
+    $script = $script + "`n'$statusMarker' + `$?"
+    $ps = [PowerShell]::Create()
+    $ps.Runspace = Get-CommandRunspace
+    $ps.Runspace.SessionStateProxy.SetVariable('LASTEXITCODE', 0)
+    @@INVOKE@@
+    $inputData = New-Object 'System.Management.Automation.PSDataCollection[PSObject]'
+    $inputData.Complete()
+    $output = New-Object 'System.Management.Automation.PSDataCollection[PSObject]'
+    $result = @{ Status = $null; Output = New-Object System.Collections.ArrayList; Errors = New-Object System.Collections.ArrayList }
+    try {
+        $handle = $ps.BeginInvoke($inputData, $output)
+        do {
+            $finished = $handle.AsyncWaitHandle.WaitOne(100)
+            foreach ($item in $output.ReadAll()) {
+                if ($item.BaseObject -is [string] -and $item.BaseObject.StartsWith($statusMarker)) {
+                    $result.Status = $item.BaseObject.Substring($statusMarker.Length)
+                } elseif ($stream) {
+                    Send-Frame ("$id OUT " + (ConvertTo-Base64 ($item | Out-String -Width 4096).TrimEnd()))
+                } else {
+                    [void]$result.Output.Add($item)
+                }
+            }
+            foreach ($record in $ps.Streams.Error.ReadAll()) {
+                [void]$result.Errors.Add($record)
+                if ($stream) { Send-Frame ("$id ERR " + (ConvertTo-Base64 ($record | Out-String -Width 4096).TrimEnd())) }
+            }
+            foreach ($record in $ps.Streams.Warning.ReadAll()) {
+                if ($stream) { Send-Frame ("$id ERR " + (ConvertTo-Base64 "WARNING: $($record.Message)")) }
+            }
+            foreach ($record in $ps.Streams.Progress.ReadAll()) {
+                if (-not $stream) { continue }
+                $progress = @{
+                    ActivityId = $record.ActivityId; ParentActivityId = $record.ParentActivityId
+                    Activity = $record.Activity; StatusDescription = $record.StatusDescription
+                    CurrentOperation = $record.CurrentOperation; PercentComplete = $record.PercentComplete
+                    SecondsRemaining = $record.SecondsRemaining; Completed = ($record.RecordType -eq 'Completed')
+                }
+                Send-Frame ("$id PROGRESS " + (ConvertTo-Base64 (ConvertTo-Json -Compress -InputObject $progress)))
+            }
+        } until ($finished)
+        # Throws the command's terminating error, if any
+        [void]$ps.EndInvoke($handle)
+        if ($null -eq $result.Status) {
+            # The command ended early through `exit`, or a remote command through a terminating error
+            $exitCode = $ps.Runspace.SessionStateProxy.GetVariable('LASTEXITCODE')
+            $result.Status = [string]($result.Errors.Count -eq 0 -and -not $exitCode)
+        }
+    } catch {
+        $terminating = $_
+        if ($_.Exception.InnerException -is [System.Management.Automation.IContainsErrorRecord]) {
+            $terminating = $_.Exception.InnerException.ErrorRecord
+        }
+        [void]$result.Errors.Add($terminating)
+        if ($stream) { Send-Frame ("$id ERR " + (ConvertTo-Base64 ($terminating | Out-String -Width 4096).TrimEnd())) }
+        $result.Status = 'False'
+    } finally {
+        $ps.Dispose()
+    }
+    return $result
+}
+Send-Frame '0 READY'
+while ($true) {
+    $line = [Console]::In.ReadLine()
+    if ($null -eq $line) { break }
+    $fields = $line.Split(' ')
+    if ($fields.Length -lt 2) { continue }
+    $id = $fields[0]
+    $ok = $true
+    $out = ''
+    $err = ''
+    try {
+        $script = $utf8.GetString([Convert]::FromBase64String($fields[1]))
+        $result = Invoke-HostCommand $id $script ($fields.Length -gt 2 -and $fields[2] -eq 'S')
+        # Non-terminating errors do not fail a command, but are still returned
+        $ok = $result.Status -eq 'True'
+        $out = $result.Output | Out-String -Width 4096
+        $err = $result.Errors | Out-String -Width 4096
+    } catch {
+        $ok = $false
+        $err = $_ | Out-String -Width 4096
+    }
+    $status = if ($ok) { 'OK' } else { 'ERR' }
+    Send-Frame ("$id END $status " + (ConvertTo-Base64 $out) + ' ' + (ConvertTo-Base64 $err))
+}
+"""
+
+# A host for a remote Hyper-V server keeps one PSSession to it open and runs every
+# command in it, so the WinRM connection is set up once instead of once per call.
+# A broken session (e.g. after a network outage) is replaced on the next command.
+_REMOTE_PRELUDE = r"""
+$global:RemoteSession = $null
+function Get-RemoteSession {
+    if ($null -eq $global:RemoteSession -or $global:RemoteSession.State -ne 'Opened') {
+        if ($global:RemoteSession) { Remove-PSSession $global:RemoteSession -ErrorAction SilentlyContinue }
+        $global:RemoteSession = New-PSSession -ComputerName @@COMPUTER@@ -ErrorAction Stop
+    }
+    return $global:RemoteSession
+}
+"""
+# Adds the command to the runspace's $ps, in a child scope of its own
+_LOCAL_INVOKE = "[void]$ps.AddScript($script, $true)"
+_REMOTE_INVOKE = ("[void]$ps.AddScript('param($session, $script) Invoke-Command -Session $session "
+                  "-ScriptBlock ([ScriptBlock]::Create($script))').AddArgument((Get-RemoteSession)).AddArgument($script)")
+
+
+def _build_host_script(computer_name=None):
+    """Returns the host script, running commands locally or on computer_name."""
+    if computer_name is None:
+        return _HOST_SCRIPT.replace("@@INVOKE@@", _LOCAL_INVOKE)
+    quoted = "'" + computer_name.replace("'", "''") + "'"
+    script = _HOST_SCRIPT.replace("@@INVOKE@@", _REMOTE_INVOKE)
+    return _REMOTE_PRELUDE.replace("@@COMPUTER@@", quoted) + script
+
+
+# Seconds between the cancellation checks of a caller waiting for a free host
+_ACQUIRE_POLL_INTERVAL = 0.1
+
+
+class PowerShellHostError(Exception):
+    """Raised when the PowerShell host process fails, crashes or times out."""
+
+
+class CancelToken:
+    """Cancels the PowerShell commands currently running on behalf of a caller.
+
+    A token may be shared by several commands running in parallel. Cancelling kills
+    the host processes that run them; the pool restarts them on the next call.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._hosts = set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            hosts = list(self._hosts)
+        for host in hosts:
+            host.cancel()
+
+    def _bind(self, host):
+        with self._lock:
+            if self._cancelled:
+                raise PowerShellHostError("PowerShell command was cancelled.")
+            self._hosts.add(host)
+
+    def _unbind(self, host):
+        with self._lock:
+            self._hosts.discard(host)
+
+
+def _decode_field(value):
+    return base64.b64decode(value).decode("utf-8", errors="replace") if value else ""
+
+
+class PowerShellHost:
+    """A long-lived PowerShell process that executes commands sent over stdin.
+
+    The process is started lazily and restarted transparently if it exits.
+    Commands are serialized: one host runs one command at a time. With a
+    computer_name, commands run on that server through a persistent PSSession
+    opened with the credentials of the current user.
+    """
+
+    def __init__(self, executable="powershell", startup_timeout=60, computer_name=None):
+        self.executable = executable
+        self.startup_timeout = startup_timeout
+        self.computer_name = computer_name
+        self._proc = None
+        self._responses = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._cancel_requested = False
+
+    def _is_alive(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def _start(self):
+        encoded = base64.b64encode(_build_host_script(self.computer_name).encode("utf-16-le")).decode("ascii")
+        self._proc = subprocess.Popen(
+            [self.executable, "-NoLogo", "-NoProfile", "-NonInteractive",
+             "-ExecutionPolicy", "Bypass", "-EncodedCommand", encoded],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0),
+        )
+        self._responses = queue.Queue()
+        reader = threading.Thread(target=self._read_frames, args=(self._proc, self._responses))
+        reader.daemon = True
+        reader.start()
+        frame = self._next_frame(self.startup_timeout)
+        if frame is None or frame[1] != "READY":
+            self._check_cancelled()
+            self._stop()
+            raise PowerShellHostError("PowerShell host failed to start.")
+
+    def _stop(self):
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+
+    @staticmethod
+    def _read_frames(proc, responses):
+        for raw in proc.stdout:
+            line = raw.decode("ascii", errors="replace").rstrip("\r\n")
+            if line.startswith(_FRAME_MARKER + " "):
+                responses.put(line[len(_FRAME_MARKER) + 1:].split(" "))
+        responses.put(None)  # EOF: the process has exited
+
+    def _next_frame(self, timeout):
+        try:
+            return self._responses.get(timeout=timeout)
+        except queue.Empty:
+            self._stop()
+            raise PowerShellHostError(f"PowerShell command timed out after {timeout} seconds.")
+
+    def _check_cancelled(self):
+        if self._cancel_requested:
+            self._stop()
+            raise PowerShellHostError("PowerShell command was cancelled.")
+
+    def cancel(self):
+        """Aborts the running command by killing the host process."""
+        proc = self._proc
+        if proc is not None and proc.poll() is None:
+            self._cancel_requested = True
+            proc.kill()
+
+    def run(self, command, timeout=None, cancel_token=None, on_output=None, on_error=None, on_progress=None):
+        """Runs a command and returns (success, stdout, stderr).
+
+        With any of the callbacks the command is streamed: every object it writes
+        is formatted and passed to on_output(text) as soon as it is written,
+        instead of being collected into stdout; errors and warnings go to
+        on_error(text) (errors are still returned in stderr), and progress records
+        to on_progress(record) as dicts with the ProgressRecord properties.
+        timeout is then the longest wait for the next record.
+        """
+        callbacks = (on_output, on_error, on_progress)
+        with self._lock:
+            self._cancel_requested = False
+            if cancel_token is not None:
+                cancel_token._bind(self)
+            try:
+                return self._run_locked(command, timeout, callbacks)
+            finally:
+                if cancel_token is not None:
+                    cancel_token._unbind(self)
+
+    def _run_locked(self, command, timeout, callbacks=(None, None, None)):
+        on_output, on_error, on_progress = callbacks
+        request_id = str(next(self._ids))
+        mode = " S" if any(callback is not None for callback in callbacks) else ""
+        payload = f"{request_id} {base64.b64encode(command.encode('utf-8')).decode('ascii')}{mode}\n"
+        # A write can only fail before the command was delivered, so one retry on a fresh process is safe.
+        for attempt in range(2):
+            self._check_cancelled()
+            if not self._is_alive():
+                self._start()
+            try:
+                self._proc.stdin.write(payload.encode("ascii"))
+                self._proc.stdin.flush()
+                break
+            except OSError:
+                self._stop()
+                if attempt == 1:
+                    raise PowerShellHostError("PowerShell host exited unexpectedly.")
+        while True:
+            frame = self._next_frame(timeout)
+            if frame is None:
+                self._check_cancelled()
+                self._stop()
+                raise PowerShellHostError("PowerShell host exited while running the command.")
+            if frame[0] != request_id or len(frame) < 2:
+                continue
+            value = _decode_field(frame[2]) if len(frame) > 2 and frame[1] != "END" else ""
+            if frame[1] == "OUT" and on_output is not None:
+                on_output(value)
+            elif frame[1] == "ERR" and on_error is not None:
+                on_error(value)
+            elif frame[1] == "PROGRESS" and on_progress is not None:
+                try:
+                    on_progress(json.loads(value))
+                except ValueError:
+                    pass
+            elif frame[1] == "END" and len(frame) >= 3:
+                fields = frame[3:] + ["", ""]
+                return frame[2] == "OK", _decode_field(fields[0]), _decode_field(fields[1])
+
+    def close(self):
+        with self._lock:
+            self._stop()
+
+
+class PowerShellHostPool:
+    """A small pool of PowerShellHost workers, created on demand."""
+
+    def __init__(self, size=3, executable="powershell", computer_name=None):
+        self.size = size
+        self.executable = executable
+        self.computer_name = computer_name
+        self._idle = queue.LifoQueue()  # LIFO keeps the warmest host in use
+        self._hosts = []
+        self._lock = threading.Lock()
+
+    def _acquire(self, deadline=None, cancel_token=None):
+        """Returns an idle host, waiting for one until deadline (time.monotonic()) or cancellation."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._hosts) < self.size:
+                host = PowerShellHost(self.executable, computer_name=self.computer_name)
+                self._hosts.append(host)
+                return host
+        while True:
+            if cancel_token is not None and cancel_token.cancelled:
+                raise PowerShellHostError("PowerShell command was cancelled.")
+            wait = _ACQUIRE_POLL_INTERVAL
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PowerShellHostError("PowerShell command timed out waiting for a free host.")
+                wait = min(wait, remaining)
+            try:
+                return self._idle.get(timeout=wait)
+            except queue.Empty:
+                pass
+
+    def run(self, command, timeout=None, cancel_token=None, on_output=None, on_error=None, on_progress=None):
+        """Runs a command on an idle host and returns (success, stdout, stderr); see PowerShellHost.run().
+
+        Waiting for an idle host counts against timeout and ends when cancel_token is cancelled.
+        """
+        if cancel_token is not None and cancel_token.cancelled:
+            raise PowerShellHostError("PowerShell command was cancelled.")
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        host = self._acquire(deadline, cancel_token)
+        try:
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0.001)
+            return host.run(command, timeout=timeout, cancel_token=cancel_token,
+                            on_output=on_output, on_error=on_error, on_progress=on_progress)
+        finally:
+            self._idle.put(host)
+
+    def close(self):
+        with self._lock:
+            for host in self._hosts:
+                host.close()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool(size=3):
+    """Returns the process-wide host pool, creating it on first use."""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = PowerShellHostPool(size=size)
+            atexit.register(_default_pool.close)
+        return _default_pool
+
+
+_remote_pools = {}
+
+
+def get_remote_pool(computer_name, size=2):
+    """Returns the host pool whose sessions run on computer_name, creating it on first use."""
+    with _default_pool_lock:
+        pool = _remote_pools.get(computer_name)
+        if pool is None:
+            pool = _remote_pools[computer_name] = PowerShellHostPool(size=size, computer_name=computer_name)
+            atexit.register(pool.close)
+        return pool
+
+
+def close_remote_pool(computer_name):
+    """Closes the sessions to computer_name; the next call opens new ones."""
+    with _default_pool_lock:
+        pool = _remote_pools.pop(computer_name, None)
+    if pool is not None:
+        pool.close()
@@ -1,6 +1,20 @@
 import subprocess
+import copy
 import json
 import os
+import queue
+import threading
+import time
+import functools
+import inspect
+import stat
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from powershell_host import CancelToken, PowerShellHostError, get_default_pool, get_remote_pool, close_remote_pool
+from image_index import ImageIndex, format_size
+from guest_sessions import get_guest_pool, close_guest_pool
+from hyperv_models import VM, Adapter, Switch, NatNetwork, NatRule, VMMetrics, Progress
+from image_metadata import read_image_metadata
+from config import record_vhd_parent, prune_vhd_parents, get_hosts, get_host, LOCAL_HOST
 
 # 定义常量
 _1MB = 1024 * 1024
@@ -10,8 +24,55 @@ _1GB = 1024 * 1024 * 1024
 _SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 _REPO_FILE = os.path.join(_SCRIPT_DIR, "online_images_repository.json")
 
-def _run_powershell_command(command):
-    """Universal PowerShell command execution function"""
+# 与Windows控制台一致的编码；其他平台（例如使用模拟 powershell 测试时）使用 UTF-8
+_PS_ENCODING = "oem" if os.name == "nt" else "utf-8"
+
+# Commands run on a pool of long-lived PowerShell hosts instead of one process per call.
+# Set to False to fall back to spawning a fresh PowerShell process for every command.
+USE_PERSISTENT_HOST = True
+PS_HOST_POOL_SIZE = 3
+# Persistent sessions kept open to each remote host
+REMOTE_POOL_SIZE = 2
+# Hosts served at the same time by the fan-out helpers (iter_host_results() and friends)
+FLEET_WORKERS = 32
+
+# Threads copying one template disk for a full clone, and the block size each one reads
+VHD_COPY_WORKERS = 4
+_VHD_COPY_BLOCK = 16 * _1MB
+
+# Timeout, cancel token and target host of the query running on the current worker thread, see submit_query()
+_call_context = threading.local()
+_query_executor = ThreadPoolExecutor(max_workers=PS_HOST_POOL_SIZE, thread_name_prefix="powershell-query")
+# One worker per host, so a slow host never holds up the queries of the others
+_fleet_executor = ThreadPoolExecutor(max_workers=FLEET_WORKERS, thread_name_prefix="powershell-fleet")
+# Host name -> computer name remoting connects to, read from the host registry on first use
+_computer_names = {}
+
+# Seconds each read-only query result stays fresh; mutating helpers invalidate the entries they affect
+CACHE_TTL = {
+    "vm_inventory": 10,
+    "vm_network_adapters": 60,
+    "vswitches": 300,
+    "vswitch_ips": 300,
+    "network_adapters": 300,
+    "nat_networks": 300,
+    "nat_rules": 300,
+}
+
+def _translate_powershell_error(stderr):
+    """Maps well-known PowerShell failures to a friendlier message."""
+    # 修复：在调用.lower()之前，先检查stderr是否为None
+    stderr_lower = stderr.lower() if stderr else ""
+    if "requires elevation" in stderr_lower or "access is denied" in stderr_lower:
+        return "Insufficient permissions, please run this program as an administrator."
+    return stderr
+
+def _ps_quote(value):
+    """Quotes a value as a literal PowerShell string."""
+    return "'" + str(value).replace("'", "''") + "'"
+
+def _run_powershell_oneshot(command):
+    """Runs a command in a fresh PowerShell process"""
     full_command = ["powershell", "-Command", command]
     try:
         # 使用 'oem' 编码来正确解码系统区域语言（如中文GBK）
@@ -19,17 +80,13 @@ def _run_powershell_command(command):
             full_command, 
             capture_output=True, 
             text=True, 
-            encoding='oem', 
+            encoding=_PS_ENCODING, 
             check=True
         )
         return True, result.stdout
     except subprocess.CalledProcessError as e:
         print(f"PowerShell Error: {e.stderr}")
-        # 修复：在调用.lower()之前，先检查e.stderr是否为None
-        stderr_lower = e.stderr.lower() if e.stderr else ""
-        if "requires elevation" in stderr_lower or "access is denied" in stderr_lower:
-            return False, "Insufficient permissions, please run this program as an administrator."
-        return False, e.stderr
+        return False, _translate_powershell_error(e.stderr)
     except FileNotFoundError:
         error_msg = "PowerShell not found, please check the system environment."
         print(error_msg)
@@ -39,39 +96,493 @@ def _run_powershell_command(command):
         print(error_msg)
         return False, error_msg
 
-def get_vms_data():
-    """Get data for all Hyper-V virtual machines"""
-    # Select the State object directly, it will be serialized as a string (e.g., "Running", "Off")
-    ps_command = """
-    Get-VM | Select-Object Name, State, Uptime, MemoryAssigned, CPUUsage, @{Name='GuestOS';Expression={$_.Guest.OS}}, @{Name='IPAddresses';Expression={$_.NetworkAdapters.IPAddresses}} | ConvertTo-Json -Compress
+def _stream_powershell_oneshot(command, on_event):
+    """Runs a command in a fresh PowerShell process, passing its lines on as they are written"""
+    try:
+        # Text mode decodes incrementally, so a line is passed on as soon as it is complete
+        proc = subprocess.Popen(["powershell", "-Command", command], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                text=True, encoding=_PS_ENCODING, errors="replace")
+    except FileNotFoundError:
+        error_msg = "PowerShell not found, please check the system environment."
+        print(error_msg)
+        return False, error_msg
+    errors = []
+
+    def read_errors():
+        for line in proc.stderr:
+            errors.append(line.rstrip("\r\n"))
+            on_event("err", errors[-1])
+
+    reader = threading.Thread(target=read_errors, name="powershell-stderr")
+    reader.daemon = True
+    reader.start()
+    for line in proc.stdout:
+        on_event("out", line.rstrip("\r\n"))
+    reader.join()
+    if proc.wait() != 0:
+        stderr = "\n".join(errors)
+        print(f"PowerShell Error: {stderr}")
+        return False, _translate_powershell_error(stderr)
+    return True, ""
+
+def _run_powershell_command(command, timeout=None, on_event=None):
+    """Universal PowerShell command execution function
+
+    With on_event, the command is streamed: what it writes is passed to
+    on_event(kind, value) as it arrives, kind "out" or "err" with one line of
+    text, or "progress" with a Progress record (only the persistent hosts see
+    progress). The output is then not collected and is "" on success.
     """
-    success, output = _run_powershell_command(ps_command)
-    if success and output:
+    success, output = _execute_powershell_command(command, timeout, on_event)
+    if not success:
+        # Lets _cached() know that the result must not be stored
+        _call_context.failed = True
+    return success, output
+
+def _current_host():
+    """The host the current thread's commands go to, see run_query()."""
+    return getattr(_call_context, "host", None) or LOCAL_HOST
+
+def _computer_name(host):
+    computer_name = _computer_names.get(host)
+    if computer_name is None:
+        # Names that are not registered are used as computer names as they are
+        entry = get_host(host)
+        computer_name = _computer_names[host] = entry["computer_name"] if entry else host
+    return computer_name
+
+def _host_pool(host):
+    if host == LOCAL_HOST:
+        return get_default_pool(PS_HOST_POOL_SIZE)
+    return get_remote_pool(_computer_name(host), REMOTE_POOL_SIZE)
+
+def disconnect_host(host):
+    """Closes the sessions to a host and drops its cached results, e.g. after it was re-registered."""
+    if host in _computer_names:
+        computer_name = _computer_names.pop(host)
+        close_remote_pool(computer_name)
+        close_guest_pool(computer_name)
+    _host_caches.pop(host, None)
+
+def _execute_powershell_command(command, timeout=None, on_event=None):
+    host = _current_host()
+    if not USE_PERSISTENT_HOST:
+        if host != LOCAL_HOST:
+            command = f"Invoke-Command -ComputerName {_ps_quote(_computer_name(host))} -ScriptBlock ([ScriptBlock]::Create({_ps_quote(command)}))"
+        if on_event is not None:
+            return _stream_powershell_oneshot(command, on_event)
+        return _run_powershell_oneshot(command)
+    if timeout is None:
+        timeout = getattr(_call_context, "timeout", None)
+    cancel_token = getattr(_call_context, "cancel_token", None)
+    callbacks = {}
+    if on_event is not None:
+        callbacks = {
+            "on_output": lambda text: [on_event("out", line) for line in text.splitlines()],
+            "on_error": lambda text: [on_event("err", line) for line in text.splitlines()],
+            "on_progress": lambda record: on_event("progress", Progress.from_json(record)),
+        }
+    try:
+        success, stdout, stderr = _host_pool(host).run(command, timeout=timeout, cancel_token=cancel_token, **callbacks)
+    except FileNotFoundError:
+        error_msg = "PowerShell not found, please check the system environment."
+        print(error_msg)
+        return False, error_msg
+    except PowerShellHostError as e:
+        error_msg = str(e)
+        print(f"PowerShell Error: {error_msg}")
+        return False, error_msg
+    except Exception as e:
+        error_msg = f"An unknown error occurred: {e}"
+        print(error_msg)
+        return False, error_msg
+    if success:
+        return True, stdout
+    print(f"PowerShell Error: {stderr}")
+    return False, _translate_powershell_error(stderr)
+
+class _QueryCache:
+    """Thread-safe TTL cache for read-only queries, keyed by (query name, arg...).
+
+    Values are stored and handed out as deep copies, so callers may modify what
+    they get. Every invalidation bumps a generation counter; put refuses a value
+    read before an invalidation of its key, so a query that raced a change cannot
+    bring the old state back.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._stats = {}
+        self._generation = 0
+        self._cleared = 0
+        self._name_cleared = {}
+        self._key_cleared = {}
+
+    def _count(self, name, field):
+        stats = self._stats.setdefault(name, {"hits": 0, "misses": 0})
+        stats[field] += 1
+
+    def generation(self):
+        """Current generation; read it before running the query whose result goes to put."""
+        with self._lock:
+            return self._generation
+
+    def get(self, key):
+        """Returns (found, value) for a key that has not expired yet."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._count(key[0], "hits")
+                value = entry[1]
+            else:
+                self._count(key[0], "misses")
+                return False, None
+        return True, copy.deepcopy(value)
+
+    def put(self, key, value, ttl, generation=None):
+        """Stores a value unless its key was invalidated after generation; returns whether it did."""
+        value = copy.deepcopy(value)
+        with self._lock:
+            if generation is not None and generation < max(
+                    self._cleared, self._name_cleared.get(key[0], 0), self._key_cleared.get(key, 0)):
+                return False
+            self._entries[key] = (time.monotonic() + ttl, value)
+            return True
+
+    def invalidate(self, name=None, *args):
+        """Drops one entry, every entry of a query, or everything when name is None."""
+        with self._lock:
+            self._generation += 1
+            if name is None:
+                self._entries.clear()
+                self._cleared = self._generation
+                self._name_cleared.clear()
+                self._key_cleared.clear()
+            elif args:
+                self._entries.pop((name,) + args, None)
+                self._key_cleared[(name,) + args] = self._generation
+            else:
+                for key in [k for k in self._entries if k[0] == name]:
+                    del self._entries[key]
+                self._name_cleared[name] = self._generation
+                for key in [k for k in self._key_cleared if k[0] == name]:
+                    del self._key_cleared[key]
+
+    def stats(self):
+        with self._lock:
+            queries = {name: dict(stats) for name, stats in self._stats.items()}
+            return {
+                "hits": sum(s["hits"] for s in queries.values()),
+                "misses": sum(s["misses"] for s in queries.values()),
+                "entries": len(self._entries),
+                "queries": queries,
+            }
+
+# Each host has its own cache; _cache is the one of the local host
+_cache = _QueryCache()
+_host_caches = {LOCAL_HOST: _cache}
+
+def _host_cache():
+    """The cache of the host the current thread's queries go to."""
+    host = _current_host()
+    cache = _host_caches.get(host)
+    if cache is None:
+        cache = _host_caches.setdefault(host, _QueryCache())
+    return cache
+
+def invalidate_cache(name=None, *args, host=None):
+    """Forces the next call of a cached query (or of all of them) to hit PowerShell.
+
+    host limits this to the entries of one host; by default every host is affected.
+    """
+    caches = [_host_caches[host]] if host in _host_caches else [] if host else list(_host_caches.values())
+    for cache in caches:
+        cache.invalidate(name, *args)
+
+def get_cache_stats(host=LOCAL_HOST):
+    """Returns cache hit/miss counters of one host, overall and per query."""
+    cache = _host_caches.get(host)
+    return cache.stats() if cache else _QueryCache().stats()
+
+def _cached(name):
+    """Decorator: caches a read-only query for CACHE_TTL[name] seconds.
+
+    Results of calls that hit a PowerShell error are not cached.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = (name,) + tuple(bound.arguments.values())
+            cache = _host_cache()
+            found, value = cache.get(key)
+            if found:
+                return value
+            generation = cache.generation()
+            outer_failed = getattr(_call_context, "failed", False)
+            _call_context.failed = False
+            try:
+                value = func(*args, **kwargs)
+                if not _call_context.failed:
+                    cache.put(key, value, CACHE_TTL[name], generation)
+                return value
+            finally:
+                _call_context.failed = outer_failed
+        return wrapper
+    return decorator
+
+def _invalidates(*queries):
+    """Decorator for mutating helpers: drops the affected cache entries once the call returns.
+
+    Each query is a cached query name, optionally together with the names of the
+    arguments that select its entry, e.g. ("nat_rules", "nat_name").
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                arguments = signature.bind(*args, **kwargs).arguments
+                cache = _host_cache()
+                for query in queries:
+                    name, *arg_names = (query,) if isinstance(query, str) else query
+                    cache.invalidate(name, *(arguments[a] for a in arg_names))
+        return wrapper
+    return decorator
+
+class QueryTask:
+    """Handle for a query started with submit_query()."""
+
+    def __init__(self, future, cancel_token):
+        self.future = future
+        self.cancel_token = cancel_token
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout=timeout)
+
+    def cancel(self):
+        """Cancels the query, aborting its PowerShell command if it is already running."""
+        self.future.cancel()
+        self.cancel_token.cancel()
+
+def run_query(func, *args, cancel_token=None, timeout=None, host=None, **kwargs):
+    """Runs a helper of this module on the current thread with a cancel token and timeout.
+
+    timeout applies to every PowerShell command issued by the helper; a command that
+    times out or is cancelled fails the same way as any other PowerShell error.
+    host is the name of a registered Hyper-V host (see config.get_hosts()) the
+    helper works on; by default it works on the local host.
+    """
+    _call_context.cancel_token = cancel_token
+    _call_context.timeout = timeout
+    _call_context.host = host
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _call_context.cancel_token = None
+        _call_context.timeout = None
+        _call_context.host = None
+
+def submit_query(func, *args, timeout=None, cancel_token=None, host=None, **kwargs):
+    """Runs any helper of this module in the background and returns a QueryTask.
+
+    See run_query() for the meaning of timeout and host. Queries that share a
+    cancel_token are cancelled together.
+    """
+    cancel_token = cancel_token or CancelToken()
+    future = _query_executor.submit(_run_pooled_query, func, *args, cancel_token=cancel_token, timeout=timeout, host=host, **kwargs)
+    return QueryTask(future, cancel_token)
+
+def _run_pooled_query(func, *args, **kwargs):
+    # Marks the worker, so that run_parallel() inside the query does not wait on its own pool
+    _call_context.pooled = True
+    try:
+        return run_query(func, *args, **kwargs)
+    finally:
+        _call_context.pooled = False
+
+def run_parallel(queries, timeout=None):
+    """Runs independent queries at the same time and waits for all of them.
+
+    queries maps a key to a helper or to a (helper, arg, ...) tuple; the result
+    dict maps the same keys to each helper's return value.
+    """
+    # Inside a cancellable query, the parallel queries are cancelled together with it
+    cancel_token = getattr(_call_context, "cancel_token", None)
+    if timeout is None:
+        timeout = getattr(_call_context, "timeout", None)
+    host = getattr(_call_context, "host", None)
+    calls = {}
+    for key, query in queries.items():
+        func, *args = query if isinstance(query, tuple) else (query,)
+        calls[key] = (func, *args)
+    if getattr(_call_context, "pooled", False):
+        # Already on a query worker: children queued on the same pool could wait for
+        # workers that all wait for their children, so they get an executor of their own
+        with ThreadPoolExecutor(max_workers=max(1, len(calls)), thread_name_prefix="powershell-nested") as executor:
+            futures = {key: executor.submit(run_query, *call, cancel_token=cancel_token, timeout=timeout, host=host)
+                       for key, call in calls.items()}
+            return {key: future.result() for key, future in futures.items()}
+    tasks = {key: submit_query(*call, timeout=timeout, cancel_token=cancel_token, host=host) for key, call in calls.items()}
+    return {key: task.result() for key, task in tasks.items()}
+
+def get_host_names():
+    """Names of all registered Hyper-V hosts, in registry order."""
+    return [host["name"] for host in get_hosts()]
+
+def iter_host_results(queries, timeout=None, cancel_token=None):
+    """Runs one query per host at the same time and yields (host, result) as each host finishes.
+
+    queries maps a host name to a helper or to a (helper, arg, ...) tuple, like
+    run_parallel(). Each host is served through its own persistent sessions, so a
+    slow or unreachable host only delays its own result; timeout limits each of
+    its PowerShell commands.
+    """
+    cancel_token = cancel_token or getattr(_call_context, "cancel_token", None)
+    if timeout is None:
+        timeout = getattr(_call_context, "timeout", None)
+    futures = {}
+    for host, query in queries.items():
+        func, *args = query if isinstance(query, tuple) else (query,)
+        futures[_fleet_executor.submit(run_query, func, *args, cancel_token=cancel_token, timeout=timeout, host=host)] = host
+    for future in as_completed(futures):
+        yield futures[future], future.result()
+
+def run_on_hosts(func, *args, hosts=None, timeout=None, **kwargs):
+    """Runs one helper on several hosts in parallel; returns {host: result} in host order.
+
+    hosts defaults to every registered host.
+    """
+    hosts = list(dict.fromkeys(hosts or get_host_names()))
+    query = functools.partial(func, *args, **kwargs)
+    results = dict(iter_host_results({host: query for host in hosts}, timeout=timeout))
+    return {host: results[host] for host in hosts}
+
+def run_bulk_on_hosts(func, vm_keys, timeout=None, **kwargs):
+    """Runs a bulk VM helper (e.g. start_vms) for VMs spread over several hosts.
+
+    vm_keys are (host, vm_name) pairs. Every host gets one call with its own VMs,
+    all hosts at the same time. Returns {(host, vm_name): (success, message)}.
+    """
+    names_by_host = {}
+    for host, vm_name in vm_keys:
+        names_by_host.setdefault(host, []).append(vm_name)
+    query = functools.partial(func, **kwargs)
+    results = {}
+    for host, host_results in iter_host_results({host: (query, names) for host, names in names_by_host.items()}, timeout=timeout):
+        results.update(((host, vm_name), result) for vm_name, result in host_results.items())
+    return {tuple(key): results[tuple(key)] for key in vm_keys}
+
+def iter_powershell_output(command, timeout=None):
+    """Runs a command in the background and yields what it writes as it arrives.
+
+    Yields ("out", line), ("err", line) and ("progress", Progress) tuples, then
+    ("exit", (success, error message)) once the command ends. The command goes to
+    the calling thread's host and is cancelled with its cancel token, see run_query().
+    """
+    events = queue.Queue()
+    cancel_token = getattr(_call_context, "cancel_token", None)
+    host = getattr(_call_context, "host", None)
+    if timeout is None:
+        timeout = getattr(_call_context, "timeout", None)
+
+    def run():
+        result = (False, "PowerShell command failed.")
+        try:
+            result = run_query(_run_powershell_command, command, cancel_token=cancel_token, timeout=timeout, host=host,
+                               on_event=lambda kind, value: events.put((kind, value)))
+        finally:
+            events.put(("exit", result))
+
+    worker = threading.Thread(target=run, name="powershell-stream")
+    worker.daemon = True
+    worker.start()
+    while True:
+        kind, value = events.get()
+        yield kind, value
+        if kind == "exit":
+            return
+
+# Appended to a pipeline: every object becomes one compact JSON line, so the output is
+# parsed record by record instead of as one document that may be a dict or a list
+_NDJSON_PIPE = " | ForEach-Object { ConvertTo-Json -InputObject $_ -Compress -Depth 2 }"
+
+# VM properties as flat values: the VMState enum as its number, the Uptime TimeSpan in seconds
+_VM_PROPERTIES = ("Name, @{Name='Id';Expression={$_.Id.ToString()}}, @{Name='State';Expression={[int]$_.State}}, "
+                  "@{Name='UptimeSeconds';Expression={[long]$_.Uptime.TotalSeconds}}, MemoryAssigned, CPUUsage, "
+                  "@{Name='GuestOS';Expression={$_.Guest.OS}}, @{Name='IPAddresses';Expression={$_.NetworkAdapters.IPAddresses}}")
+
+def _iter_json_lines(output):
+    """Decodes line-delimited JSON output one record at a time, skipping other lines."""
+    start = 0
+    # Slices one line at a time instead of splitting (or copying) the whole output up front
+    while start < len(output):
+        end = output.find("\n", start)
+        if end == -1:
+            end = len(output)
+        line = output[start:end].strip()
+        start = end + 1
+        if not line.startswith("{"):
+            continue
         try:
-            # Handle single VM case where JSON is not an array
-            parsed_json = json.loads(output)
-            if isinstance(parsed_json, dict):
-                return [parsed_json]
-            return parsed_json
+            yield json.loads(line)
         except json.JSONDecodeError:
-            return []
-    return []
+            print(f"Skipping malformed PowerShell record: {line[:200]}")
+
+def _query_json_lines(pipeline):
+    """Runs a pipeline that outputs objects; returns (success, [dict]) with one dict per object."""
+    success, output = _run_powershell_command(pipeline + _NDJSON_PIPE)
+    if not success:
+        return False, []
+    return True, list(_iter_json_lines(output))
 
+def _query_records(pipeline, record_type):
+    """Like _query_json_lines(), but returns the objects as record_type instances."""
+    success, output = _run_powershell_command(pipeline + _NDJSON_PIPE)
+    if not success:
+        return False, []
+    return True, [record_type.from_json(record) for record in _iter_json_lines(output)]
+
+def _set_host(records):
+    """Tags records with the host they were queried from."""
+    host = _current_host()
+    for record in records:
+        record.host = host
+    return records
+
+def get_vms_data():
+    """Get data for all Hyper-V virtual machines as VM records (without adapters)"""
+    return _set_host(_query_records(f"Get-VM | Select-Object {_VM_PROPERTIES}", VM)[1])
+
+@_invalidates("vm_inventory")
 def start_vm(vm_name):
     """Start the specified virtual machine"""
     ps_command = f"Start-VM -Name \"{vm_name}\"";
     return _run_powershell_command(ps_command)
 
+@_invalidates("vm_inventory")
 def shutdown_vm(vm_name):
     """Safely shut down the specified virtual machine"""
     ps_command = f"Shutdown-VM -Name \"{vm_name}\" -Force";
     return _run_powershell_command(ps_command)
 
+@_invalidates("vm_inventory")
 def stop_vm(vm_name):
     """Forcibly stop the specified virtual machine"""
     ps_command = f"Stop-VM -Name \"{vm_name}\"";
     return _run_powershell_command(ps_command)
 
+@_invalidates("vm_inventory", ("vm_network_adapters", "vm_name"))
 def delete_vm(vm_name):
     """Deletes the specified virtual machine, stopping it first if necessary."""
     # First, ensure the VM is stopped. We run this and ignore the output, as it might already be stopped.
@@ -82,11 +593,101 @@ def delete_vm(vm_name):
     
     # Then, remove the VM.
     remove_command = f"Remove-VM -Name \"{vm_name}\" -Force"
-    return _run_powershell_command(remove_command)
+    result = _run_powershell_command(remove_command)
+    _forget_deleted_disks()
+    return result
+
+def _forget_deleted_disks():
+    # Remove-VM keeps the disk files; drop the parent records of those already deleted
+    if _current_host() == LOCAL_HOST:
+        prune_vhd_parents()
+
+# Per-VM statements used by the bulk lifecycle helpers; $name holds the VM name
+_BULK_VM_ACTIONS = {
+    "start": "Start-VM -Name $name",
+    "shutdown": "Stop-VM -Name $name -Force",
+    "stop": "Stop-VM -Name $name -TurnOff -Force",
+    # Stop first so that running VMs can be removed as well
+    "delete": "Stop-VM -Name $name -TurnOff -Force -Confirm:$false; Remove-VM -Name $name -Force",
+}
+
+def _run_vm_action_batch(action, vm_names):
+    """Runs one lifecycle action for a batch of VMs in a single script."""
+    names = ", ".join(_ps_quote(name) for name in vm_names)
+    ps_command = f"""
+    $ErrorActionPreference = 'Stop'
+    $results = foreach ($name in @({names})) {{
+        try {{
+            {_BULK_VM_ACTIONS[action]} | Out-Null
+            @{{ Name = $name; success = $true }}
+        }} catch {{
+            @{{ Name = $name; success = $false; error = $_.Exception.Message }}
+        }}
+    }}
+    ConvertTo-Json -InputObject @($results) -Compress
+    """
+    success, output = _run_powershell_command(ps_command)
+    if not success:
+        return {name: (False, output) for name in vm_names}
+    try:
+        parsed_json = json.loads(output)
+    except json.JSONDecodeError:
+        return {name: (False, f"Unexpected output: {output}") for name in vm_names}
+    results = {item.get('Name'): (bool(item.get('success')), item.get('error') or "OK") for item in parsed_json}
+    return {name: results.get(name, (False, "No result returned")) for name in vm_names}
+
+def _run_bulk_vm_action(action, vm_names, max_concurrency=None):
+    """Splits the VMs into at most max_concurrency batches and runs them in parallel.
+
+    Returns {vm_name: (success, message)} in the order of vm_names.
+    """
+    vm_names = list(dict.fromkeys(vm_names))
+    if not vm_names:
+        return {}
+    max_concurrency = max(1, min(max_concurrency or PS_HOST_POOL_SIZE, len(vm_names)))
+    batches = [vm_names[i::max_concurrency] for i in range(max_concurrency)]
+    results = {}
+    cancel_token = getattr(_call_context, "cancel_token", None)
+    timeout = getattr(_call_context, "timeout", None)
+    host = getattr(_call_context, "host", None)
+
+    def run_batch(batch):
+        return run_query(_run_vm_action_batch, action, batch, cancel_token=cancel_token, timeout=timeout, host=host)
+
+    # A dedicated executor, so bulk calls can themselves run as a submit_query() task
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="powershell-bulk") as executor:
+        for batch_results in executor.map(run_batch, batches):
+            results.update(batch_results)
+    return {name: results[name] for name in vm_names}
+
+@_invalidates("vm_inventory")
+def start_vms(vm_names, max_concurrency=None):
+    """Starts several virtual machines; returns {vm_name: (success, message)}"""
+    return _run_bulk_vm_action("start", vm_names, max_concurrency)
+
+@_invalidates("vm_inventory")
+def shutdown_vms(vm_names, max_concurrency=None):
+    """Gracefully shuts down several virtual machines; returns {vm_name: (success, message)}"""
+    return _run_bulk_vm_action("shutdown", vm_names, max_concurrency)
+
+@_invalidates("vm_inventory")
+def stop_vms(vm_names, max_concurrency=None):
+    """Turns off several virtual machines; returns {vm_name: (success, message)}"""
+    return _run_bulk_vm_action("stop", vm_names, max_concurrency)
+
+@_invalidates("vm_inventory", "vm_network_adapters")
+def delete_vms(vm_names, max_concurrency=None):
+    """Stops and deletes several virtual machines; returns {vm_name: (success, message)}"""
+    results = _run_bulk_vm_action("delete", vm_names, max_concurrency)
+    _forget_deleted_disks()
+    return results
 
 def connect_vm(vm_name):
     """Launches the Virtual Machine Connection tool for the specified VM."""
-    command = f"vmconnect.exe $env:COMPUTERNAME \"{vm_name}\""
+    host = _current_host()
+    # vmconnect runs here and connects to the server that hosts the VM
+    server = "$env:COMPUTERNAME" if host == LOCAL_HOST else _ps_quote(_computer_name(host))
+    command = f"vmconnect.exe {server} \"{vm_name}\""
     try:
         # Using Popen to run in a new process without blocking and with no console window.
         subprocess.Popen(["powershell", "-Command", command], creationflags=subprocess.CREATE_NO_WINDOW)
@@ -102,60 +703,35 @@ def check_hyperv_status():
         return output.strip()
     return f"Check failed: {output}"
 
-def install_hyperv():
-    """Enable the Hyper-V feature"""
+def install_hyperv(on_event=None):
+    """Enable the Hyper-V feature; with on_event its output and progress are streamed, see _run_powershell_command()"""
     ps_command = "Enable-WindowsOptionalFeature -Online -FeatureName Microsoft-Hyper-V -All"
-    success, output = _run_powershell_command(ps_command)
+    success, output = _run_powershell_command(ps_command, on_event=on_event)
     return success, output
 
+@_cached("vswitches")
 def get_vswitches():
-    """Get all Hyper-V virtual switches"""
-    ps_command = "Get-VMSwitch | Select-Object Name, @{Name='SwitchType';Expression={$_.SwitchType.ToString()}}, Notes | ConvertTo-Json -Compress"
-    success, output = _run_powershell_command(ps_command)
-    if success and output:
-        try:
-            parsed_json = json.loads(output)
-            if isinstance(parsed_json, dict):
-                return [parsed_json]
-            return parsed_json
-        except json.JSONDecodeError:
-            return []
-    return []
+    """Get all Hyper-V virtual switches as Switch records"""
+    return _query_records("Get-VMSwitch | Select-Object Name, @{Name='SwitchType';Expression={$_.SwitchType.ToString()}}, Notes", Switch)[1]
 
+@_cached("vswitch_ips")
 def get_vswitch_ip_addresses():
-    """Gets the IP addresses of all vEthernet adapters."""
-    ps_command = "Get-NetAdapter -Name 'vEthernet (*' | ForEach-Object { $adapter = $_; $ip = Get-NetIPAddress -InterfaceIndex $adapter.ifIndex -AddressFamily IPv4 -ErrorAction SilentlyContinue; if ($ip) { [PSCustomObject]@{ SwitchName = $adapter.Name.Replace('vEthernet (','').Replace(')',''); IPAddress = $ip.IPAddress } } } | ConvertTo-Json -Compress"
-    success, output = _run_powershell_command(ps_command)
-    if success and output:
-        try:
-            parsed_json = json.loads(output)
-            if isinstance(parsed_json, dict): # Handle single item case
-                parsed_json = [parsed_json]
-            # Convert list of objects to a dictionary for easy lookup
-            return {item['SwitchName']: item['IPAddress'] for item in parsed_json}
-        except (json.JSONDecodeError, KeyError):
-            return {}
-    return {}
+    """Gets the IP addresses of all vEthernet adapters as {switch name: IP address}."""
+    pipeline = "Get-NetAdapter -Name 'vEthernet (*' | ForEach-Object { $adapter = $_; $ip = Get-NetIPAddress -InterfaceIndex $adapter.ifIndex -AddressFamily IPv4 -ErrorAction SilentlyContinue; if ($ip) { [PSCustomObject]@{ SwitchName = $adapter.Name.Replace('vEthernet (','').Replace(')',''); IPAddress = $ip.IPAddress } } }"
+    return {item['SwitchName']: item['IPAddress'] for item in _query_json_lines(pipeline)[1] if 'SwitchName' in item}
 
+@_invalidates("vswitches", "vswitch_ips", "network_adapters", "vm_network_adapters", "vm_inventory")
 def remove_vswitch(switch_name):
     """Delete the specified virtual switch"""
     ps_command = f"Remove-VMSwitch -Name \"{switch_name}\" -Force"
     return _run_powershell_command(ps_command)
 
+@_cached("network_adapters")
 def get_network_adapters():
     """Get all physical network adapter names"""
-    ps_command = "Get-NetAdapter | Where-Object {$_.Status -eq 'Up'} | Select-Object Name | ConvertTo-Json -Compress"
-    success, output = _run_powershell_command(ps_command)
-    if success and output:
-        try:
-            parsed_json = json.loads(output)
-            if isinstance(parsed_json, dict):
-                return [parsed_json['Name']] if 'Name' in parsed_json else []
-            return [item['Name'] for item in parsed_json if 'Name' in item]
-        except json.JSONDecodeError:
-            return []
-    return []
+    return [item['Name'] for item in _query_json_lines("Get-NetAdapter | Where-Object {$_.Status -eq 'Up'} | Select-Object Name")[1] if 'Name' in item]
 
+@_invalidates("vswitches", "vswitch_ips", "network_adapters")
 def create_vswitch(name, switch_type, net_adapter_name=None):
     """Create a new virtual switch"""
     ps_command = f"New-VMSwitch -Name \"{name}\" -SwitchType {switch_type}"
@@ -163,56 +739,139 @@ def create_vswitch(name, switch_type, net_adapter_name=None):
         ps_command += f" -NetAdapterName \"{net_adapter_name}\"";
     return _run_powershell_command(ps_command)
 
+@_invalidates("vswitch_ips")
 def set_vswitch_ip(switch_name, ip_address, prefix_length):
     """Set the IP address for a virtual switch's host-side network adapter."""
     adapter_name = f"vEthernet ({switch_name})"
     ps_command = f"Get-NetAdapter -Name '{adapter_name}' | New-NetIPAddress -IPAddress {ip_address} -PrefixLength {prefix_length}"
     return _run_powershell_command(ps_command)
 
+@_invalidates("nat_networks")
 def create_nat_network(name, internal_ip_interface_address_prefix):
     """Create a new NAT network"""
     ps_command = f"New-NetNat -Name \"{name}\" -InternalIPInterfaceAddressPrefix {internal_ip_interface_address_prefix}"
     return _run_powershell_command(ps_command)
 
+@_cached("nat_networks")
 def get_nat_networks():
-    """Get all NAT network information"""
-    ps_command = "Get-NetNat | Select-Object Name, InternalIPInterfaceAddressPrefix | ConvertTo-Json -Compress"
-    success, output = _run_powershell_command(ps_command)
-    if success and output:
-        try:
-            parsed_json = json.loads(output)
-            if isinstance(parsed_json, dict):
-                return [parsed_json]
-            return parsed_json
-        except json.JSONDecodeError:
-            return []
-    return []
+    """Get all NAT networks as NatNetwork records"""
+    return _query_records("Get-NetNat | Select-Object Name, InternalIPInterfaceAddressPrefix", NatNetwork)[1]
 
+@_cached("nat_rules")
 def get_nat_rules(nat_name):
-    """Get all port mapping rules for the specified NAT network"""
-    ps_command = f"Get-NetNatStaticMapping -NatName \"{nat_name}\" | Select-Object Protocol, ExternalPort, InternalIPAddress, InternalPort | ConvertTo-Json -Compress"
-    success, output = _run_powershell_command(ps_command)
-    if success and output:
-        try:
-            parsed_json = json.loads(output)
-            if isinstance(parsed_json, dict):
-                return [parsed_json]
-            return parsed_json
-        except json.JSONDecodeError:
-            return []
-    return []
+    """Get all port mapping rules for the specified NAT network as NatRule records"""
+    pipeline = f"Get-NetNatStaticMapping -NatName \"{nat_name}\" | Select-Object @{{Name='Protocol';Expression={{$_.Protocol.ToString()}}}}, ExternalPort, InternalIPAddress, InternalPort"
+    return _query_records(pipeline, NatRule)[1]
 
+@_invalidates(("nat_rules", "nat_name"))
 def add_nat_rule(nat_name, external_port, internal_ip, internal_port, protocol):
     """Add a NAT port mapping rule"""
     ps_command = f"Add-NetNatStaticMapping -NatName \"{nat_name}\" -Protocol {protocol} -ExternalIPAddress 0.0.0.0 -ExternalPort {external_port} -InternalIPAddress \"{internal_ip}\" -InternalPort {internal_port}"
     return _run_powershell_command(ps_command)
 
+def remove_nat_rules(nat_name, rules):
+    """Delete several NAT port mapping rules in one round-trip; returns [(success, message)], one per rule"""
+    return apply_network_changes([("remove_mapping", {"nat": nat_name, "protocol": rule.protocol.upper(), "external_port": rule.external_port})
+                                  for rule in rules])
+
 def remove_nat_rule(nat_name, rule):
     """Delete a NAT port mapping rule"""
-    # PowerShell needs the specific rule object to remove it. A simple approach is to recreate the command.
-    # A more robust way would be to pipe Get-NetNatStaticMapping to Remove-NetNatStaticMapping, but this is harder to form.
-    ps_command = f"Remove-NetNatStaticMapping -NatName \"{nat_name}\" -StaticMapping (Get-NetNatStaticMapping -NatName \"{nat_name}\" | Where-Object {{ $_.Protocol -eq '{rule['Protocol']}' -and $_.ExternalPort -eq {rule['ExternalPort']} }}) -Confirm:$false"
-    return _run_powershell_command(ps_command)
+    return remove_nat_rules(nat_name, [rule])[0]
+
+def get_network_state():
+    """Reads switches, their host-side IPv4 addresses, NATs and port mappings in one round-trip.
+
+    Returns (success, state) with state {"switches": {name: Switch},
+    "adapters": {switch name: physical adapter name} (External switches),
+    "ips": {switch name: [(ip, prefix length)]}, "nats": {name: NatNetwork},
+    "mappings": {NAT name: {(protocol, external port): NatRule}}}, or
+    (False, error message). Nothing is cached: this is the baseline of a change plan.
+    """
+    ps_command = f"""
+    Get-VMSwitch | Select-Object @{{Name='Kind';Expression={{'Switch'}}}}, Name, @{{Name='SwitchType';Expression={{$_.SwitchType.ToString()}}}}, Notes, @{{Name='NetAdapterName';Expression={{ if ($_.NetAdapterInterfaceDescription) {{ (Get-NetAdapter -InterfaceDescription $_.NetAdapterInterfaceDescription -ErrorAction SilentlyContinue).Name }} }}}}{_NDJSON_PIPE}
+    Get-NetIPAddress -InterfaceAlias 'vEthernet (*' -AddressFamily IPv4 -ErrorAction SilentlyContinue | Where-Object {{ $_.PrefixOrigin -ne 'WellKnown' }} | Select-Object @{{Name='Kind';Expression={{'IP'}}}}, @{{Name='SwitchName';Expression={{$_.InterfaceAlias.Substring(11, $_.InterfaceAlias.Length - 12)}}}}, IPAddress, PrefixLength{_NDJSON_PIPE}
+    Get-NetNat -ErrorAction SilentlyContinue | Select-Object @{{Name='Kind';Expression={{'Nat'}}}}, Name, InternalIPInterfaceAddressPrefix{_NDJSON_PIPE}
+    Get-NetNatStaticMapping -ErrorAction SilentlyContinue | Select-Object @{{Name='Kind';Expression={{'Mapping'}}}}, NatName, @{{Name='Protocol';Expression={{$_.Protocol.ToString()}}}}, ExternalPort, InternalIPAddress, InternalPort{_NDJSON_PIPE}
+    """
+    success, output = _run_powershell_command(ps_command)
+    if not success:
+        return False, output
+    state = {"switches": {}, "adapters": {}, "ips": {}, "nats": {}, "mappings": {}}
+    for record in _iter_json_lines(output):
+        kind = record.get('Kind')
+        if kind == 'Switch':
+            switch = Switch.from_json(record)
+            state["switches"][switch.name] = switch
+            if record.get('NetAdapterName'):
+                state["adapters"][switch.name] = record['NetAdapterName']
+        elif kind == 'IP':
+            state["ips"].setdefault(record.get('SwitchName'), []).append((record.get('IPAddress'), int(record.get('PrefixLength') or 0)))
+        elif kind == 'Nat':
+            nat = NatNetwork.from_json(record)
+            state["nats"][nat.name] = nat
+        elif kind == 'Mapping':
+            rule = NatRule.from_json(record)
+            state["mappings"].setdefault(record.get('NatName'), {})[(rule.protocol.upper(), rule.external_port)] = rule
+    return True, state
+
+def _network_change_statement(action, params):
+    """The PowerShell statement of one planned network change, see apply_network_changes()."""
+    switch = _ps_quote(params.get("switch", ""))
+    adapter = _ps_quote(f"vEthernet ({params.get('switch', '')})")
+    nat = _ps_quote(params.get("nat", ""))
+    if action == "remove_mapping":
+        # $mappings is filled once at the top of the script, instead of one lookup per removal
+        key = _ps_quote(f"{params['nat']}|{params['protocol']}|{params['external_port']}")
+        return f"$mapping = $mappings[{key}]; if (-not $mapping) {{ throw 'Port mapping not found' }}; $mapping | Remove-NetNatStaticMapping -Confirm:$false"
+    if action == "remove_nat":
+        return f"Remove-NetNat -Name {nat} -Confirm:$false"
+    if action == "remove_ip":
+        return f"Remove-NetIPAddress -InterfaceAlias {adapter} -IPAddress {_ps_quote(params['ip'])} -Confirm:$false"
+    if action == "remove_switch":
+        return f"Remove-VMSwitch -Name {switch} -Force"
+    if action == "create_switch":
+        if params["type"] == "External":
+            return f"New-VMSwitch -Name {switch} -NetAdapterName {_ps_quote(params['adapter'])}"
+        return f"New-VMSwitch -Name {switch} -SwitchType {params['type']}"
+    if action == "set_switch":
+        if params["type"] == "External":
+            return f"Set-VMSwitch -Name {switch} -NetAdapterName {_ps_quote(params['adapter'])}"
+        return f"Set-VMSwitch -Name {switch} -SwitchType {params['type']}"
+    if action == "add_ip":
+        return f"New-NetIPAddress -InterfaceAlias {adapter} -IPAddress {_ps_quote(params['ip'])} -PrefixLength {int(params['prefix_length'])}"
+    if action == "create_nat":
+        return f"New-NetNat -Name {nat} -InternalIPInterfaceAddressPrefix {_ps_quote(params['prefix'])}"
+    if action == "add_mapping":
+        return (f"Add-NetNatStaticMapping -NatName {nat} -Protocol {params['protocol']} -ExternalIPAddress 0.0.0.0 "
+                f"-ExternalPort {int(params['external_port'])} -InternalIPAddress {_ps_quote(params['internal_ip'])} -InternalPort {int(params['internal_port'])}")
+    raise ValueError(f"Unknown network change: {action}")
+
+@_invalidates("vswitches", "vswitch_ips", "network_adapters", "nat_networks", "nat_rules", "vm_network_adapters", "vm_inventory")
+def apply_network_changes(changes):
+    """Applies planned (action, params) network changes in a single script, in order.
+
+    See network_state.plan_network_changes() for the actions. A failed change
+    does not stop the ones after it. Returns [(success, message)], one per change.
+    """
+    changes = list(changes)
+    if not changes:
+        return []
+    lines = ["$ErrorActionPreference = 'Stop'", "$results = New-Object System.Collections.ArrayList", "$mappings = @{}"]
+    if any(action == "remove_mapping" for action, _ in changes):
+        lines.append("Get-NetNatStaticMapping -ErrorAction SilentlyContinue | ForEach-Object { $mappings[\"$($_.NatName)|$($_.Protocol)|$($_.ExternalPort)\"] = $_ }")
+    for index, (action, params) in enumerate(changes):
+        lines.append(f"try {{ {_network_change_statement(action, params)} | Out-Null; [void]$results.Add(@{{ index = {index}; success = $true }}) }} "
+                     f"catch {{ [void]$results.Add(@{{ index = {index}; success = $false; error = $_.Exception.Message }}) }}")
+    lines.append("ConvertTo-Json -InputObject @($results) -Compress")
+    success, output = _run_powershell_command("\n".join(lines))
+    if not success:
+        return [(False, output)] * len(changes)
+    try:
+        parsed_json = json.loads(output)
+    except json.JSONDecodeError:
+        return [(False, f"Unexpected output: {output}")] * len(changes)
+    results = {item.get('index'): (bool(item.get('success')), item.get('error') or "OK") for item in parsed_json}
+    return [results.get(index, (False, "No result returned")) for index in range(len(changes))]
 
 def get_online_images():
     """
@@ -232,160 +891,447 @@ def get_online_images():
         return []
 
 def get_local_images(paths):
-    """Scans for ISO image files in the specified paths"""
-    local_images = []
-    for path in paths:
-        if os.path.isdir(path):
-            for root, _, files in os.walk(path):
-                for file in files:
-                    if file.lower().endswith((".iso", ".vhdx", ".vhd")):
-                        filepath = os.path.join(root, file)
-                        try:
-                            size = os.path.getsize(filepath)
-                            local_images.append({
-                                "name": file,
-                                "path": filepath,
-                                "size": f"{size / _1GB:.2f} GB" if size > _1GB else f"{size / _1MB:.2f} MB"
-                            })
-                        except Exception as e:
-                            print(f"Error reading file {filepath}: {e}")
-    return local_images
-
-def create_new_vm(name, memory_mb, cpu_cores, vhd_path, vhd_size_gb, vswitch_name, iso_path=None, existing_vhd_path=None, enable_secure_boot=True):
-    """Create a new virtual machine"""
-    # 1. Create virtual machine
-    ps_command = f"New-VM -Name \"{name}\" -MemoryStartupBytes {memory_mb * _1MB} -Generation 2" # Default Gen2
-    success, output = _run_powershell_command(ps_command)
-    if not success:
-        return False, f"Failed to create virtual machine: {output}"
+    """Scans for ISO image files in the specified paths, using the on-disk image index.
 
-    # 2. Set CPU cores
-    ps_command = f"Set-VMProcessor -VMName \"{name}\" -Count {cpu_cores}"
-    success, output = _run_powershell_command(ps_command)
-    if not success:
-        return False, f"Failed to set CPU: {output}"
+    Besides name, path and the formatted size, each image has the ISO volume label
+    or the VHD/VHDX virtual size and disk type read from its header.
+    """
+    images = []
+    for batch in ImageIndex().scan(paths):
+        for image in batch:
+            images.append(dict(image, size=format_size(image["size"])))
+    return images
 
-    # 2.5 Set Secure Boot
-    secure_boot_ps_bool = "$true" if enable_secure_boot else "$false"
-    ps_command = f"Set-VMFirmware -VMName \"{name}\" -EnableSecureBoot {secure_boot_ps_bool}"
-    success, output = _run_powershell_command(ps_command)
-    if not success:
-        # This is not a critical error, so we can just print a warning
-        print(f"Warning: Failed to set Secure Boot status: {output}")
+# Error message prefix for each provisioning step, as reported by create_new_vm
+_PROVISIONING_STEP_ERRORS = {
+    "create_vm": "Failed to create virtual machine",
+    "set_cpu": "Failed to set CPU",
+    "set_secure_boot": "Failed to set Secure Boot status",
+    "add_existing_disk": "Failed to add existing hard drive",
+    "create_vhd": "Failed to create new VHD",
+    "add_new_disk": "Failed to add new hard drive to virtual machine",
+    "connect_network": "Failed to connect network adapter",
+    "add_iso": "Failed to add ISO",
+    "set_boot_device": "Failed to set boot device",
+}
+
+def _build_provisioning_script(steps):
+    """Compiles (step, statement, undo, critical) tuples into a single PowerShell script.
 
-    # 3. Add hard drive
+    Steps run in order until a critical one fails; the undo statements of the steps
+    that already succeeded then run in reverse order. The script prints a JSON
+    summary with one entry per executed step.
+    """
+    lines = ["$ErrorActionPreference = 'Stop'", "$ok = $true", "$steps = @()", "$undo = @()"]
+    for step, statement, undo, critical in steps:
+        lines.append("if ($ok) {")
+        lines.append("    try {")
+        # Dot-sourced, so variables a step assigns (e.g. $newVM) are seen by the later steps and undos
+        lines.append(f"        . {{ {statement} }} | Out-Null")
+        lines.append(f"        $steps += @{{ step = '{step}'; success = $true }}")
+        if undo:
+            lines.append(f"        $undo = @({{ {undo} }}) + $undo")
+        lines.append("    } catch {")
+        lines.append(f"        $steps += @{{ step = '{step}'; success = $false; error = $_.Exception.Message }}")
+        if critical:
+            lines.append("        $ok = $false")
+        lines.append("    }")
+        lines.append("}")
+    lines.extend([
+        "$rolledBack = $false",
+        "if (-not $ok) {",
+        "    foreach ($action in $undo) { try { & $action | Out-Null } catch { } }",
+        "    $rolledBack = $true",
+        "}",
+        "@{ success = $ok; rolled_back = $rolledBack; steps = @($steps) } | ConvertTo-Json -Depth 4 -Compress",
+    ])
+    return "\n".join(lines)
+
+def _run_powershell_collecting(command, on_event):
+    """Streams a command's errors and progress to on_event but collects its output, for scripts that end with a summary"""
+    if on_event is None:
+        return _run_powershell_command(command)
+    lines = []
+
+    def collect(kind, value):
+        if kind == "out":
+            lines.append(value)
+        else:
+            on_event(kind, value)
+
+    success, output = _run_powershell_command(command, on_event=collect)
+    return success, "\n".join(lines) if success else output
+
+def provision_vm(name, memory_mb, cpu_cores, vhd_path, vhd_size_gb, vswitch_name, iso_path=None, existing_vhd_path=None, enable_secure_boot=True, parent_vhd_path=None, on_event=None):
+    """Creates and configures a virtual machine in a single PowerShell round-trip.
+
+    With parent_vhd_path, vhd_path is created as a differencing disk of that
+    parent instead of a blank dynamic disk.
+    Returns a dict with 'success', 'rolled_back' and a per-step 'steps' list
+    ({'step', 'success', 'error'}). If a required step fails, the VM and any newly
+    created VHD are removed again. on_event receives errors and progress (e.g. of
+    New-VHD) as they happen, see _run_powershell_command().
+    """
+    # Hyper-V allows several VMs with the same name: every step works on the VM object
+    # New-VM returned, so neither the steps nor the rollback can touch an older namesake
+    steps = [
+        # Default Gen2
+        ("create_vm", f"$newVM = New-VM -Name {_ps_quote(name)} -MemoryStartupBytes {memory_mb * _1MB} -Generation 2",
+         "$newVM | Remove-VM -Force", True),
+        ("set_cpu", f"Set-VMProcessor -VM $newVM -Count {cpu_cores}", None, True),
+        # Not a critical error, the VM is still usable
+        ("set_secure_boot", f"Set-VMFirmware -VM $newVM -EnableSecureBoot {'On' if enable_secure_boot else 'Off'}", None, False),
+    ]
     if existing_vhd_path:
-        ps_command = f"Add-VMHardDiskDrive -VMName \"{name}\" -Path \"{existing_vhd_path}\"";
-        success, output = _run_powershell_command(ps_command)
-        if not success:
-            return False, f"Failed to add existing hard drive: {output}"
-    elif vhd_path and vhd_size_gb:
-        # Ensure the directory for the VHD path exists
+        steps.append(("add_existing_disk", f"Add-VMHardDiskDrive -VM $newVM -Path {_ps_quote(existing_vhd_path)}", None, True))
+    elif vhd_path and (vhd_size_gb or parent_vhd_path):
+        vhd = _ps_quote(vhd_path)
         vhd_dir = os.path.dirname(vhd_path)
-        if vhd_dir and not os.path.exists(vhd_dir):
-            os.makedirs(vhd_dir, exist_ok=True)
-
-        # Create a new VHDX
-        ps_command = f"New-VHD -Path \"{vhd_path}\" -SizeBytes {vhd_size_gb * _1GB} -Dynamic -Confirm:$false"
-        success, output = _run_powershell_command(ps_command)
-        if not success:
-            return False, f"Failed to create new VHD: {output}"
-        
-        # Add the new VHDX to the virtual machine
-        ps_command = f"Add-VMHardDiskDrive -VMName \"{name}\" -Path \"{vhd_path}\"";
-        success, output = _run_powershell_command(ps_command)
-        if not success:
-            return False, f"Failed to add new hard drive to virtual machine: {output}"
+        # Ensure the directory for the VHD path exists before creating a new dynamic VHDX
+        if parent_vhd_path:
+            # Only the blocks the VM changes are written to the child; reads fall through to the parent
+            create_vhd = f"New-VHD -Path {vhd} -ParentPath {_ps_quote(parent_vhd_path)} -Differencing -Confirm:$false"
+        else:
+            create_vhd = f"New-VHD -Path {vhd} -SizeBytes {vhd_size_gb * _1GB} -Dynamic -Confirm:$false"
+        if vhd_dir:
+            create_vhd = f"New-Item -ItemType Directory -Path {_ps_quote(vhd_dir)} -Force | Out-Null; {create_vhd}"
+        steps.append(("create_vhd", create_vhd, f"Remove-Item -LiteralPath {vhd} -Force", True))
+        steps.append(("add_new_disk", f"Add-VMHardDiskDrive -VM $newVM -Path {vhd}", None, True))
     else:
-        return False, "No hard drive configuration specified"
+        return {"success": False, "rolled_back": False, "error": "No hard drive configuration specified", "steps": []}
+    steps.append(("connect_network", f"Get-VMNetworkAdapter -VM $newVM | Connect-VMNetworkAdapter -SwitchName {_ps_quote(vswitch_name)}", None, True))
+    if iso_path:
+        steps.append(("add_iso", f"Add-VMDvdDrive -VM $newVM -Path {_ps_quote(iso_path)}", None, True))
+        # Set the DVD drive as the first boot device
+        steps.append(("set_boot_device", "Set-VMFirmware -VM $newVM -FirstBootDevice (Get-VMDvdDrive -VM $newVM)", None, True))
 
-    # 4. Connect to virtual switch
-    ps_command = f"Connect-VMNetworkAdapter -VMName \"{name}\" -SwitchName \"{vswitch_name}\"";
-    success, output = _run_powershell_command(ps_command)
+    success, output = _run_powershell_collecting(_build_provisioning_script(steps), on_event)
     if not success:
-        return False, f"Failed to connect network adapter: {output}"
+        return {"success": False, "rolled_back": False, "error": output, "steps": []}
+    try:
+        result = json.loads(output)
+    except json.JSONDecodeError:
+        return {"success": False, "rolled_back": False, "error": f"Unexpected provisioning output: {output}", "steps": []}
+    result["steps"] = result.get("steps") or []
+    failed = [s for s in result["steps"] if not s.get("success")]
+    result["error"] = failed[-1].get("error") if failed and not result.get("success") else None
+    return result
 
-    # 5. Add ISO file (if specified)
-    if iso_path:
-        ps_command = f"Add-VMDvdDrive -VMName \"{name}\" -Path \"{iso_path}\"";
-        success, output = _run_powershell_command(ps_command)
-        if not success:
-            return False, f"Failed to add ISO: {output}"
-        
-        # Set the DVD drive as the first boot device
-        ps_command = f"Set-VMFirmware -VMName \"{name}\" -FirstBootDevice (Get-VMDvdDrive -VMName \"{name}\")"
-        success, output = _run_powershell_command(ps_command)
+@_invalidates("vm_inventory", ("vm_network_adapters", "name"))
+def create_new_vm(name, memory_mb, cpu_cores, vhd_path, vhd_size_gb, vswitch_name, iso_path=None, existing_vhd_path=None, enable_secure_boot=True, parent_vhd_path=None, on_event=None):
+    """Create a new virtual machine"""
+    result = provision_vm(name, memory_mb, cpu_cores, vhd_path, vhd_size_gb, vswitch_name,
+                          iso_path=iso_path, existing_vhd_path=existing_vhd_path, enable_secure_boot=enable_secure_boot,
+                          parent_vhd_path=parent_vhd_path, on_event=on_event)
+    for step in result["steps"]:
+        if step["step"] == "set_secure_boot" and not step.get("success"):
+            print(f"Warning: Failed to set Secure Boot status: {step.get('error')}")
+    if result["success"]:
+        return True, "Virtual machine created successfully"
+    failed_step = next((s["step"] for s in result["steps"] if not s.get("success") and s["step"] != "set_secure_boot"), None)
+    if failed_step:
+        return False, f"{_PROVISIONING_STEP_ERRORS[failed_step]}: {result['error']}"
+    return False, result["error"]
+
+def clone_vhd(source_path, destination_path, workers=VHD_COPY_WORKERS, on_event=None):
+    """Copies a virtual disk file as a full, independent clone.
+
+    The file is split into one contiguous range per worker and the ranges are
+    copied at the same time, each with its own file handles; on SSDs and network
+    shares this is several times faster than a single sequential copy.
+    on_event("progress", Progress) is called whenever another percent is copied.
+    Inside run_query(), the copy stops when the cancel token fires or when no
+    block was copied for the timeout, like a PowerShell command that hangs; the
+    partial destination is then removed.
+    """
+    cancel_token = getattr(_call_context, "cancel_token", None)
+    timeout = getattr(_call_context, "timeout", None)
+    last_progress = [time.monotonic()]
+    try:
+        size = os.path.getsize(source_path)
+        os.makedirs(os.path.dirname(os.path.abspath(destination_path)), exist_ok=True)
+        with open(destination_path, 'xb') as f:
+            f.truncate(size)
+    except OSError as e:
+        return False, f"Failed to create {destination_path}: {e}"
+
+    copied = [0, -1]  # bytes copied, last percent reported
+    progress_lock = threading.Lock()
+
+    def report(length):
+        if on_event is None:
+            return
+        with progress_lock:
+            copied[0] += length
+            percent = copied[0] * 100 // size if size else 100
+            if percent == copied[1]:
+                return
+            copied[1] = percent
+        on_event("progress", Progress(activity=f"Copying {os.path.basename(source_path)}",
+                                      status=f"{format_size(copied[0])} / {format_size(size)}", percent=percent))
+
+    def copy_range(start, end):
+        with open(source_path, 'rb') as src, open(destination_path, 'r+b') as dst:
+            src.seek(start)
+            dst.seek(start)
+            while start < end:
+                if cancel_token is not None and cancel_token.cancelled:
+                    raise OSError("the copy was cancelled")
+                block = src.read(min(_VHD_COPY_BLOCK, end - start))
+                if not block:
+                    raise OSError(f"{source_path} changed while it was copied")
+                dst.write(block)
+                start += len(block)
+                now = time.monotonic()
+                if timeout is not None and now - last_progress[0] > timeout:
+                    raise OSError(f"no progress for {timeout} seconds")
+                last_progress[0] = now
+                report(len(block))
+
+    # Range boundaries on whole blocks, so every worker reads aligned blocks
+    step = -(-size // max(1, workers) // _VHD_COPY_BLOCK) * _VHD_COPY_BLOCK or _VHD_COPY_BLOCK
+    ranges = [(start, min(start + step, size)) for start in range(0, size, step)]
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, len(ranges)), thread_name_prefix="vhd-copy") as executor:
+            list(executor.map(lambda r: copy_range(*r), ranges))
+    except OSError as e:
+        os.remove(destination_path)
+        return False, f"Failed to copy {source_path}: {e}"
+    return True, f"Copied {size} bytes"
+
+def _vms_using_disk(vhd_path):
+    """Returns (success, [name]) of the VMs that have vhd_path attached."""
+    pipeline = (f"Get-VM | Get-VMHardDiskDrive | Where-Object {{ $_.Path -eq {_ps_quote(os.path.abspath(vhd_path))} }}"
+                " | Select-Object VMName")
+    success, items = _query_json_lines(pipeline)
+    return success, sorted({item['VMName'] for item in items if item.get('VMName')})
+
+def _protect_template(template_path):
+    # Writing to a parent disk corrupts every differencing disk built on it
+    try:
+        os.chmod(template_path, stat.S_IREAD)
+    except OSError as e:
+        print(f"Warning: could not make template {template_path} read-only: {e}")
+
+@_invalidates("vm_inventory")
+def create_vm_from_template(name, template_path, memory_mb, cpu_cores, vm_path, vswitch_name, full_clone=False, enable_secure_boot=True, on_event=None):
+    """Creates a virtual machine whose disk is built from a template VHD/VHDX.
+
+    By default the disk is a differencing disk of the template, which takes
+    seconds regardless of the template size; once the VM exists, the template is
+    made read-only and the parent is recorded in the config. A template that is
+    still attached to a VM is refused, as that VM would keep writing to it. full_clone=True
+    copies the template instead (see clone_vhd()), for VMs that must not depend on it.
+    The disk is placed at <vm_path>/<name>/Virtual Hard Disks/<name>.<ext>.
+    on_event receives the copy and provisioning progress, see _run_powershell_command().
+    Only works on the local host: the template checks, the copy and the
+    read-only flag use the local file system.
+    """
+    host = _current_host()
+    if host != LOCAL_HOST:
+        return False, f"Creating VMs from a template is only supported on the local host, not on {host}"
+    extension = os.path.splitext(template_path)[1].lower()
+    vhd_path = os.path.join(vm_path, name, "Virtual Hard Disks", f"{name}{extension}")
+    if not os.path.isfile(template_path):
+        return False, f"Template not found: {template_path}"
+    if os.path.exists(vhd_path):
+        return False, f"Virtual hard disk already exists: {vhd_path}"
+
+    if not full_clone:
+        # A VM that still uses the template would write to it and break every child
+        success, users = _vms_using_disk(template_path)
         if not success:
-            return False, f"Failed to set boot device: {output}"
+            return False, f"Could not check which VMs use {template_path}"
+        if users:
+            return False, f"Template {template_path} is attached to {', '.join(users)}; detach it or use a full clone"
+        success, output = create_new_vm(name, memory_mb, cpu_cores, vhd_path, None, vswitch_name,
+                                        enable_secure_boot=enable_secure_boot, parent_vhd_path=template_path, on_event=on_event)
+        if success:
+            # Only now that a child depends on it; a failed creation leaves the template as it was
+            _protect_template(template_path)
+            record_vhd_parent(vhd_path, template_path)
+        return success, output
 
-    return True, "Virtual machine created successfully"
+    if read_image_metadata(template_path)["disk_type"] == "differencing":
+        # A plain copy would still depend on the template's own parent
+        return False, f"Cannot fully clone a differencing disk: {template_path}"
+    success, output = clone_vhd(template_path, vhd_path, on_event=on_event)
+    if not success:
+        return False, output
+    success, output = create_new_vm(name, memory_mb, cpu_cores, None, None, vswitch_name,
+                                    existing_vhd_path=vhd_path, enable_secure_boot=enable_secure_boot, on_event=on_event)
+    if not success:
+        # The rollback removes the VM, but the copied disk was never part of the script
+        os.remove(vhd_path)
+    return success, output
+
+def create_vms_from_template(names, template_path, memory_mb, cpu_cores, vm_path, vswitch_name, full_clone=False, enable_secure_boot=True, max_concurrency=None, on_event=None):
+    """Creates several VMs from one template at the same time; returns {name: (success, message)}
+
+    on_event receives the progress of a single VM as it is created; for several
+    VMs, one progress record per finished VM and their errors prefixed with the VM name.
+    """
+    names = list(dict.fromkeys(names))
+    if not names:
+        return {}
+    max_concurrency = max(1, min(max_concurrency or PS_HOST_POOL_SIZE, len(names)))
+    cancel_token = getattr(_call_context, "cancel_token", None)
+    timeout = getattr(_call_context, "timeout", None)
+    host = getattr(_call_context, "host", None)
+    finished = []
+    finished_lock = threading.Lock()
 
+    def create(name):
+        if on_event is None or len(names) == 1:
+            vm_events = on_event
+        else:
+            # Progress of VMs created side by side cannot share one bar
+            def vm_events(kind, value):
+                if kind != "progress":
+                    on_event(kind, f"{name}: {value}")
+        result = run_query(create_vm_from_template, name, template_path, memory_mb, cpu_cores, vm_path, vswitch_name,
+                           full_clone=full_clone, enable_secure_boot=enable_secure_boot, on_event=vm_events,
+                           cancel_token=cancel_token, timeout=timeout, host=host)
+        if on_event is not None and len(names) > 1:
+            with finished_lock:
+                finished.append(name)
+                count = len(finished)
+            on_event("progress", Progress(activity=f"Creating {len(names)} VMs", status=f"{count}/{len(names)}",
+                                          percent=count * 100 // len(names)))
+        return result
+
+    # A dedicated executor, so this can itself run as a submit_query() task
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="powershell-clone") as executor:
+        return dict(zip(names, executor.map(create, names)))
+
+@_cached("vm_network_adapters")
 def get_vm_network_adapters(vm_name):
-    """Gets network adapters for a specific VM."""
-    ps_command = f"Get-VMNetworkAdapter -VMName \"{vm_name}\" | Select-Object Name, SwitchName, IPAddresses | ConvertTo-Json -Compress"
-    success, output = _run_powershell_command(ps_command)
-    if success and output:
-        try:
-            parsed_json = json.loads(output)
-            if isinstance(parsed_json, dict):
-                return [parsed_json]
-            return parsed_json
-        except json.JSONDecodeError:
-            return []
-    return []
+    """Gets network adapters for a specific VM as Adapter records."""
+    return _query_records(f"Get-VMNetworkAdapter -VMName \"{vm_name}\" | Select-Object VMName, Name, SwitchName, IPAddresses", Adapter)[1]
 
+@_invalidates("vm_inventory", ("vm_network_adapters", "vm_name"))
 def connect_vm_to_switch(vm_name, network_adapter_name, switch_name):
     """Connects a VM's network adapter to a vSwitch."""
     ps_command = f"Connect-VMNetworkAdapter -VMName \"{vm_name}\" -Name \"{network_adapter_name}\" -SwitchName \"{switch_name}\"";
     return _run_powershell_command(ps_command)
 
+@_invalidates("vm_inventory", ("vm_network_adapters", "vm_name"))
 def disconnect_vm_from_switch(vm_name, network_adapter_name):
     """Disconnects a VM's network adapter."""
     ps_command = f"Disconnect-VMNetworkAdapter -VMName \"{vm_name}\" -Name \"{network_adapter_name}\"";
     return _run_powershell_command(ps_command)
 
 def get_vm_network_adapter_status(vm_name):
-    """Gets the operational status of network adapters for a specific VM."""
-    ps_command = f"Get-VMNetworkAdapter -VMName \"{vm_name}\" | Select-Object Name, SwitchName, @{{Name='Status';Expression={{$_.Status.ToString()}}}} | ConvertTo-Json -Compress"
+    """Gets the operational status of network adapters for a specific VM as Adapter records."""
+    pipeline = f"Get-VMNetworkAdapter -VMName \"{vm_name}\" | Select-Object VMName, Name, SwitchName, @{{Name='Status';Expression={{$_.Status.ToString()}}}}"
+    return _query_records(pipeline, Adapter)[1]
+
+def _fetch_vm_inventory():
+    """Runs the inventory query; returns (success, vms)."""
+    # Adapters come first, so every VM record can be completed as soon as it is parsed
+    ps_command = f"""
+    $vms = @(Get-VM)
+    $vms | Get-VMNetworkAdapter | Select-Object @{{Name='Kind';Expression={{'Adapter'}}}}, VMName, @{{Name='VMId';Expression={{$_.VMId.ToString()}}}}, Name, SwitchName, @{{Name='Status';Expression={{$_.Status -join ', '}}}}, IPAddresses{_NDJSON_PIPE}
+    $vms | Select-Object @{{Name='Kind';Expression={{'VM'}}}}, {_VM_PROPERTIES}{_NDJSON_PIPE}
+    """
     success, output = _run_powershell_command(ps_command)
-    if success and output:
-        try:
-            parsed_json = json.loads(output)
-            if isinstance(parsed_json, dict):
-                return [parsed_json]
-            return parsed_json
-        except json.JSONDecodeError:
-            return []
-    return []
+    if not success:
+        return False, []
+    adapters_by_vm = {}
+    vms = []
+    host = _current_host()
+    for record in _iter_json_lines(output):
+        if record.get('Kind') == 'Adapter':
+            adapter = Adapter.from_json(record)
+            adapters_by_vm.setdefault(adapter.vm_id, []).append(adapter)
+        else:
+            vm = VM.from_json(record)
+            vm.adapters = adapters_by_vm.pop(vm.id, [])
+            vm.host = host
+            vms.append(vm)
+    return True, vms
+
+@_cached("vm_inventory")
+def get_vm_inventory():
+    """Gets all VMs together with their network adapters in a single round-trip.
+
+    Returns VM records whose adapters list holds their Adapter records.
+    """
+    return _fetch_vm_inventory()[1]
+
+def poll_vm_inventory(use_cache=False):
+    """Fetches the VM inventory bypassing the cache and stores the fresh result in it.
+
+    Returns (success, vms), so that a failed query can be told apart from a host without VMs.
+    use_cache=True returns a cached inventory that is still fresh instead of querying.
+    """
+    cache = _host_cache()
+    if use_cache:
+        found, vms = cache.get(("vm_inventory",))
+        if found:
+            return True, vms
+    success, vms = _fetch_vm_inventory()
+    if success:
+        cache.put(("vm_inventory",), vms, CACHE_TTL["vm_inventory"])
+    return success, vms
 
-def invoke_command_in_vm(vm_name, username, password, command):
-    """Executes a PowerShell command inside a VM using PowerShell Direct."""
-    # Escape quotes and other special characters for PowerShell
-    escaped_command = command.replace("'", "''").replace('"', '"' )
-    escaped_password = password.replace("'", "''")
+def get_vm_metrics():
+    """Samples CPU, memory and the resource metering totals of all VMs in one query.
 
-    # Using a more robust script block execution with error handling
+    Returns (success, [VMMetrics]). Disk and network totals are None for VMs
+    without resource metering, see enable_resource_metering().
+    """
     ps_command = f"""
-        $vm_name = \"{vm_name}\"
-        $username = \"{username}\"
-        $password = '{escaped_password}' | ConvertTo-SecureString -AsPlainText -Force
-        $cred = New-Object System.Management.Automation.PSCredential($username, $password)
-        
-        $ErrorActionPreference = "Stop"
-        try {{
-            $result = Invoke-Command -VMName $vm_name -Credential $cred -ScriptBlock {{ {escaped_command} }}
-            $output_str = $result | Out-String
-            $response = @{{ success = $true; output = $output_str }}
-        }} catch {{
-            $response = @{{ success = $false; error = $_.Exception.Message }}
+    Get-VM | ForEach-Object {{
+        $vm = $_
+        $usage = if ($vm.ResourceMeteringEnabled) {{ Measure-VM -VM $vm -ErrorAction SilentlyContinue }}
+        $traffic = @($usage.NetworkMeteredTrafficReport)
+        [PSCustomObject]@{{
+            Name = $vm.Name; CPUUsage = $vm.CPUUsage; MemoryAssigned = $vm.MemoryAssigned
+            DiskReadMB = $usage.AggregatedDiskDataRead; DiskWriteMB = $usage.AggregatedDiskDataWritten
+            NetworkInMB = if ($usage) {{ ($traffic | Where-Object {{ $_.Direction -eq 'Inbound' }} | Measure-Object TotalTraffic -Sum).Sum }}
+            NetworkOutMB = if ($usage) {{ ($traffic | Where-Object {{ $_.Direction -eq 'Outbound' }} | Measure-Object TotalTraffic -Sum).Sum }}
         }}
-        $response | ConvertTo-Json -Depth 3 -Compress
+    }}"""
+    # _query_records() appends the NDJSON pipe, which has to stay on the same line
+    success, samples = _query_records(ps_command, VMMetrics)
+    return success, _set_host(samples)
+
+def enable_resource_metering():
+    """Turns on Hyper-V resource metering for every VM that does not have it yet."""
+    return _run_powershell_command("Get-VM | Where-Object { -not $_.ResourceMeteringEnabled } | Enable-VMResourceMetering")
+
+def _guest_pool():
+    host = _current_host()
+    return get_guest_pool(None if host == LOCAL_HOST else _computer_name(host))
+
+def invoke_command_in_vms(vm_names, username, password, command, on_output=None):
+    """Executes a PowerShell command inside several VMs at once using PowerShell Direct.
+
+    The sessions into the VMs are kept open per (VM, user) and reused by later
+    commands until they stay idle for guest_sessions.IDLE_TIMEOUT seconds.
+    Output lines are passed to on_output(vm_name, line) as they arrive; without
+    on_output they are collected. Returns {vm_name: (success, output or error)}.
     """
-    success, output = _run_powershell_command(ps_command)
-    if success and output:
-        try:
-            # The entire output is a single JSON string, so we parse it.
-            return True, json.loads(output)
-        except json.JSONDecodeError as e:
-            return False, {"success": False, "error": f"JSON parsing error: {e}\nRaw output: {output}"}
-    return success, {"success": False, "error": output}
+    vm_names = list(dict.fromkeys(vm_names))
+    try:
+        return _guest_pool().run(vm_names, username, password, command, on_output=on_output,
+                                 timeout=getattr(_call_context, "timeout", None),
+                                 cancel_token=getattr(_call_context, "cancel_token", None))
+    except PowerShellHostError as e:
+        print(f"PowerShell Error: {e}")
+        return {vm_name: (False, str(e)) for vm_name in vm_names}
+    except FileNotFoundError:
+        return {vm_name: (False, "PowerShell not found, please check the system environment.") for vm_name in vm_names}
+
+def invoke_command_in_vm(vm_name, username, password, command, on_output=None):
+    """Executes a PowerShell command inside a VM using PowerShell Direct.
+
+    Runs through the reusable sessions of invoke_command_in_vms(); on_output(line)
+    receives the output lines as they arrive, which are then not collected.
+    """
+    stream = (lambda _, line: on_output(line)) if on_output else None
+    success, output = invoke_command_in_vms([vm_name], username, password, command, on_output=stream)[vm_name]
+    if success:
+        return True, {"success": True, "output": output}
+    return True, {"success": False, "error": output}
@@ -0,0 +1,72 @@
+def _row_key(row, key_column):
+    # A tuple of columns makes a composite key, e.g. (host, VM name)
+    if isinstance(key_column, tuple):
+        return tuple(row[i] for i in key_column)
+    return row[key_column]
+
+
+def get_selected_keys(table, key_column=0):
+    """Returns the keys of the selected rows of a sg.Table.
+
+    key_column is a column index, or a tuple of indexes for tables whose rows are
+    only unique by several columns; the keys are then tuples of those values.
+    """
+    rows = table.Values or []
+    return [_row_key(rows[i], key_column) for i in table.SelectedRows if i < len(rows)]
+
+
+def sync_table(table, rows, key_column=0):
+    """Shows rows in a sg.Table, touching only the rows that changed.
+
+    When the keys are the same and in the same order as before, changed rows are
+    rewritten in place on the underlying Treeview, which keeps the selection, the
+    scroll position and every unchanged row untouched. Otherwise the table is
+    rebuilt and the previously selected keys are selected again.
+    Returns the number of rows that were written.
+    """
+    old_rows = table.Values or []
+    if [_row_key(row, key_column) for row in old_rows] == [_row_key(row, key_column) for row in rows]:
+        changed = [i for i, row in enumerate(rows) if list(old_rows[i]) != list(row)]
+        for i in changed:
+            # sg.Table inserts row i with the Treeview iid i + 1
+            table.Widget.item(i + 1, values=rows[i])
+            old_rows[i] = rows[i]
+        return len(changed)
+
+    selected_keys = set(get_selected_keys(table, key_column))
+    select_rows = [i for i, row in enumerate(rows) if _row_key(row, key_column) in selected_keys]
+    table.update(values=list(rows), select_rows=select_rows)
+    return len(rows)
+
+
+def patch_table(table, changed_rows, removed_keys=(), key_column=0):
+    """Replaces or appends changed_rows and drops the rows of removed_keys.
+
+    Returns the number of rows that were written.
+    """
+    removed_keys = set(removed_keys)
+    changed_by_key = {_row_key(row, key_column): row for row in changed_rows}
+    rows = []
+    for row in table.Values or []:
+        key = _row_key(row, key_column)
+        if key not in removed_keys:
+            rows.append(changed_by_key.pop(key, row))
+    rows.extend(changed_by_key.values())
+    return sync_table(table, rows, key_column)
+
+
+def append_table_rows(table, rows):
+    """Appends rows to a sg.Table without redrawing the rows it already shows.
+
+    Meant for tables that fill up while a background job streams results in.
+    Returns the number of rows that were written.
+    """
+    if table.Values is None:
+        table.Values = []
+    for row in rows:
+        # Same iids and tags as sg.Table.update() uses, so selection keeps working
+        i = len(table.Values)
+        table.Widget.insert('', 'end', iid=i + 1, text=row, values=row, tag=i)
+        table.tree_ids.append(i + 1)
+        table.Values.append(row)
+    return len(rows)
@@ -0,0 +1,110 @@
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from powershell_host import CancelToken
+from powershell_utils import run_query
+
+# Event posted to the window whenever a task finishes; its value is the Task
+TASK_DONE_EVENT = "-TASK_DONE-"
+# Output lines kept per streaming task
+TASK_LOG_LINES = 500
+
+
+class Task:
+    """A blocking call running on a TaskDispatcher worker thread."""
+
+    def __init__(self, task_id, description, on_done):
+        self.id = task_id
+        self.description = description
+        self.on_done = on_done
+        self.cancel_token = CancelToken()
+        self.result = None
+        self.error = None
+        # Filled while a streaming task runs, see report()
+        self.progress = None
+        self.log = deque(maxlen=TASK_LOG_LINES)
+
+    @property
+    def cancelled(self):
+        return self.cancel_token.cancelled
+
+    def cancel(self):
+        """Aborts the PowerShell command the task is running, if any."""
+        self.cancel_token.cancel()
+
+    def report(self, kind, value):
+        """The on_event callback of a streaming task: keeps the latest progress and the output lines."""
+        if kind == "progress":
+            self.progress = None if value.completed else value
+        else:
+            self.log.append(value)
+
+
+class TaskDispatcher:
+    """Runs blocking PowerShell helpers off the PySimpleGUI event loop.
+
+    Each finished task is posted back with window.write_event_value(event_key, task);
+    the event loop passes it to dispatch(), which calls the task's on_done callback
+    on the GUI thread.
+    """
+
+    def __init__(self, window, event_key=TASK_DONE_EVENT, max_workers=4, timeout=None):
+        self.window = window
+        self.event_key = event_key
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gui-task")
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._running = {}
+
+    @property
+    def busy(self):
+        return bool(self._running)
+
+    def running_tasks(self):
+        with self._lock:
+            return list(self._running.values())
+
+    def submit(self, description, func, *args, on_done=None, timeout=None, host=None, stream=False, **kwargs):
+        """Starts func(*args, **kwargs) on a worker thread and returns its Task.
+
+        timeout limits every PowerShell command of the task and defaults to the
+        dispatcher's timeout. host is the Hyper-V host the task works on (see
+        run_query()); by default the local one. With stream, func is called with
+        on_event=task.report, so task.progress and task.log follow it as it runs.
+        """
+        task = Task(next(self._ids), description, on_done)
+        if stream:
+            kwargs["on_event"] = task.report
+        with self._lock:
+            self._running[task.id] = task
+        self._executor.submit(self._run, task, func, args, kwargs, timeout or self.timeout, host)
+        return task
+
+    def _run(self, task, func, args, kwargs, timeout, host):
+        try:
+            task.result = run_query(func, *args, cancel_token=task.cancel_token, timeout=timeout, host=host, **kwargs)
+        except Exception as e:
+            task.error = e
+        try:
+            self.window.write_event_value(self.event_key, task)
+        except Exception:
+            # The window was closed while the task was running
+            pass
+
+    def dispatch(self, task):
+        """Handles a finished task posted to the event loop."""
+        with self._lock:
+            self._running.pop(task.id, None)
+        if task.on_done:
+            task.on_done(task)
+
+    def cancel_all(self):
+        for task in self.running_tasks():
+            task.cancel()
+
+    def shutdown(self):
+        """Cancels running tasks and releases the worker threads."""
+        self.cancel_all()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Compares single-connection and segmented DownloadManager downloads offline.
+
+Starts tools/http_test_server.py in-process with a per-connection bandwidth
+limit and downloads the same file once per segment count:
+
+    python3 tools/benchmark_downloads.py --size 64M --rate 4M --latency 0.1 --segments 1 4 8
+
+With --rate 0 the server is not throttled, which measures the overhead of the
+download loop itself; --downloads runs several downloads at the same time:
+
+    python3 tools/benchmark_downloads.py --size 256M --rate 0 --latency 0 --downloads 4 --segments 1 4
+
+--engine async uses AsyncDownloadManager (needs aiohttp) instead of the
+thread-based DownloadManager.
+"""
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from download_manager import DownloadManager
+from http_test_server import content, parse_size, serve
+
+
+def expected_sha256(size):
+    digest = hashlib.sha256()
+    for offset in range(0, size, 1024 * 1024):
+        digest.update(content(offset, min(1024 * 1024, size - offset)))
+    return digest.hexdigest()
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def run(engine, base_url, segments, downloads, workdir):
+    """Runs the downloads concurrently; returns ([(status, path)], elapsed, peak thread count)."""
+    manager = engine(config_dir=workdir, downloads_dir=os.path.join(workdir, "downloads"), max_concurrent=downloads)
+    urls = [f"{base_url}/image-{segments}-{i}.iso" for i in range(downloads)]
+    started = time.monotonic()
+    for i, url in enumerate(urls):
+        manager.start_download(url, f"image-{segments}-{i}.iso", segments=segments)
+    # Poll like the GUI would while the downloads run
+    peak_threads = 0
+    while any(manager.get_download_status(url)["status"] in ("pending", "downloading") for url in urls):
+        peak_threads = max(peak_threads, threading.active_count())
+        time.sleep(0.05)
+    elapsed = time.monotonic() - started
+    statuses = [manager.get_download_status(url) for url in urls]
+    manager.close()
+    return [(status, os.path.join(manager.downloads_dir, status["filename"])) for status in statuses], elapsed, peak_threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=parse_size, default=parse_size("32M"))
+    parser.add_argument("--rate", type=parse_size, default=parse_size("4M"), help="bytes per second per connection")
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--segments", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--downloads", type=int, default=1, help="downloads running at the same time")
+    parser.add_argument("--engine", choices=["threads", "async"], default="threads")
+    args = parser.parse_args()
+
+    if args.engine == "async":
+        from async_download_manager import AsyncDownloadManager as engine
+    else:
+        engine = DownloadManager
+    server, base_url = serve(args.size, args.rate, args.latency)
+    expected = expected_sha256(args.size)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for segments in args.segments:
+                results, elapsed, peak_threads = run(engine, base_url, segments, args.downloads, workdir)
+                failures = [str(status.get("error_message") or status["status"]) for status, path in results
+                            if status["status"] != "completed" or file_sha256(path) != expected]
+                speed = args.size * args.downloads / elapsed / 1024 / 1024
+                print(f"segments={segments:<3} downloads={args.downloads:<3} {elapsed:7.2f} s {speed:8.2f} MB/s  "
+                      f"threads={peak_threads:<4} "
+                      f"{'ok' if not failures else 'FAILED: ' + '; '.join(failures)}")
+                for status, path in results:
+                    os.remove(path)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
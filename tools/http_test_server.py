@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""A local HTTP server that imitates a slow image mirror, for offline download benchmarks.
+
+Every path serves the same deterministic file of --size bytes. Each connection
+is throttled to --rate bytes per second and every response waits --latency
+seconds first, like a distant mirror that limits per-connection bandwidth:
+
+    python3 tools/http_test_server.py --size 256M --rate 4M --latency 0.1
+
+Single byte ranges (``Range: bytes=a-b``, ``a-`` and ``-n``) are answered with
+206 and ``Accept-Ranges: bytes``; --no-ranges turns that off, so the server
+always sends the whole file with 200.
+
+The server can also be started from Python with serve(), see
+tools/benchmark_downloads.py.
+"""
+import argparse
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_PATTERN = random.Random(0).randbytes(1024 * 1024)
+_WRITE_SIZE = 64 * 1024
+
+
+def content(offset, length):
+    """Returns the bytes the server sends for [offset, offset + length)."""
+    start = offset % len(_PATTERN)
+    data = bytearray()
+    while len(data) < length:
+        data += _PATTERN[start:start + length - len(data)]
+        start = 0
+    return bytes(data)
+
+
+def parse_size(text):
+    """Parses sizes like "512", "64K", "256M" or "2G"."""
+    match = re.fullmatch(r"(\d+)([KMG]?)", text.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid size: {text}")
+    return int(match.group(1)) * 1024 ** " KMG".index(match.group(2) or " ")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _byte_range(self):
+        size = self.server.file_size
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if not self.server.ranges or not match or match.groups() == ("", ""):
+            return None
+        first, last = match.groups()
+        if first == "":
+            return max(size - int(last), 0), size - 1
+        return int(first), min(int(last), size - 1) if last else size - 1
+
+    def _send_headers(self):
+        time.sleep(self.server.latency)
+        size = self.server.file_size
+        byte_range = self._byte_range()
+        if byte_range and byte_range[0] >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        if byte_range:
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {byte_range[0]}-{byte_range[1]}/{size}")
+        else:
+            self.send_response(200)
+            byte_range = (0, size - 1)
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(byte_range[1] - byte_range[0] + 1))
+        self.end_headers()
+        return byte_range
+
+    def do_HEAD(self):
+        self._send_headers()
+
+    def do_GET(self):
+        byte_range = self._send_headers()
+        if byte_range is None:
+            return
+        offset, end = byte_range[0], byte_range[1] + 1
+        started = time.monotonic()
+        sent = 0
+        try:
+            while offset < end:
+                length = min(_WRITE_SIZE, end - offset)
+                self.wfile.write(content(offset, length))
+                offset += length
+                sent += length
+                if self.server.rate:
+                    # Sleep until the connection is back under its bandwidth limit
+                    delay = sent / self.server.rate - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def serve(size, rate=0, latency=0.0, ranges=True, host="127.0.0.1", port=0):
+    """Starts the server on a background thread and returns (server, base_url).
+
+    Call server.shutdown() to stop it.
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.file_size = size
+    server.rate = rate
+    server.latency = latency
+    server.ranges = ranges
+    thread = threading.Thread(target=server.serve_forever, name="http-test-server")
+    thread.daemon = True
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=parse_size, default=parse_size("64M"), help="file size, e.g. 256M")
+    parser.add_argument("--rate", type=parse_size, default=0, help="bytes per second per connection, 0 = unlimited")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before each response")
+    parser.add_argument("--no-ranges", dest="ranges", action="store_false", help="ignore Range requests")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    server, url = serve(args.size, args.rate, args.latency, args.ranges, port=args.port)
+    print(f"Serving {args.size} bytes at {url}/image.iso (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
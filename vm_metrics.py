@@ -0,0 +1,186 @@
+import threading
+import time
+from array import array
+from config import LOCAL_HOST
+from powershell_utils import get_vm_metrics, enable_resource_metering, run_query
+
+# Seconds between two samples, and samples kept per VM (10 minutes at the default interval)
+DEFAULT_INTERVAL = 5.0
+DEFAULT_CAPACITY = 120
+
+# Sampled per VM; disk and network are MB/s computed from the Measure-VM totals
+METRICS = ("cpu", "memory_mb", "disk_read", "disk_write", "network_in", "network_out")
+
+_SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+
+def sparkline(values, width=None, maximum=None):
+    """Renders values as a row of block characters, scaled to maximum (default: the largest value)."""
+    values = list(values)[-width:] if width else list(values)
+    if not values:
+        return ""
+    top = maximum if maximum else max(values)
+    if top <= 0:
+        return _SPARK_CHARS[0] * len(values)
+    last = len(_SPARK_CHARS) - 1
+    return "".join(_SPARK_CHARS[min(last, max(0, int(value / top * last + 0.5)))] for value in values)
+
+
+class RingBuffer:
+    """A fixed-size series of floats kept in one preallocated array."""
+    __slots__ = ("_data", "_start", "_count")
+
+    def __init__(self, capacity, typecode="d"):
+        self._data = array(typecode, bytes(array(typecode).itemsize * capacity))
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def capacity(self):
+        return len(self._data)
+
+    def append(self, value):
+        capacity = len(self._data)
+        if self._count < capacity:
+            self._data[(self._start + self._count) % capacity] = value
+            self._count += 1
+        else:
+            # Full: overwrite the oldest value
+            self._data[self._start] = value
+            self._start = (self._start + 1) % capacity
+
+    def values(self):
+        """Returns the values from oldest to newest."""
+        end = self._start + self._count
+        if end <= len(self._data):
+            return self._data[self._start:end].tolist()
+        return (self._data[self._start:] + self._data[:end - len(self._data)]).tolist()
+
+    def last(self, default=None):
+        if not self._count:
+            return default
+        return self._data[(self._start + self._count - 1) % len(self._data)]
+
+
+class _VMSeries:
+    """The sampled history of one VM, with fixed memory."""
+    __slots__ = ("times", "series", "totals")
+
+    def __init__(self, capacity):
+        self.times = RingBuffer(capacity)
+        self.series = {metric: RingBuffer(capacity, "f") for metric in METRICS}
+        # Previous cumulative Measure-VM totals, to turn them into rates
+        self.totals = None
+
+
+class MetricsSampler:
+    """Samples CPU, memory, disk and network counters of all VMs in the background.
+
+    Each sample of a host is one batched query (get_vm_metrics()); every host
+    is sampled by its own thread, so a slow host only delays its own samples.
+    Values are kept in per-VM ring buffers of `capacity` samples, keyed by
+    (host, vm_name). After every sample, if a window is given,
+    {(host, vm_name): latest values} of the sampled host is posted with
+    window.write_event_value(event_key, latest).
+    """
+
+    def __init__(self, window=None, event_key=None, interval=DEFAULT_INTERVAL, capacity=DEFAULT_CAPACITY, enable_metering=True, hosts=None):
+        self.window = window
+        self.event_key = event_key
+        self.interval = interval
+        self.capacity = capacity
+        self.enable_metering = enable_metering
+        self.hosts = list(hosts or [LOCAL_HOST])
+        self._lock = threading.Lock()
+        self._vms = {}
+        self._stop_event = threading.Event()
+        self._threads = []
+
+    def start(self):
+        if any(thread.is_alive() for thread in self._threads) and not self._stop_event.is_set():
+            return
+        self._stop_event = threading.Event()
+        self._threads = []
+        for host in self.hosts:
+            thread = threading.Thread(target=self._run, args=(host, self._stop_event), name=f"vm-metrics-{host}")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def vm_keys(self):
+        """Returns the (host, vm_name) of every sampled VM."""
+        with self._lock:
+            return list(self._vms)
+
+    def get_series(self, vm_name, metric, host=LOCAL_HOST):
+        """Returns [(timestamp, value)] of one metric, oldest first."""
+        with self._lock:
+            vm = self._vms.get((host, vm_name))
+            if vm is None:
+                return []
+            return list(zip(vm.times.values(), vm.series[metric].values()))
+
+    def latest(self, vm_name, host=LOCAL_HOST):
+        """Returns {metric: value} of the newest sample, or {} for an unknown VM."""
+        with self._lock:
+            vm = self._vms.get((host, vm_name))
+            if vm is None or not len(vm.times):
+                return {}
+            return {metric: vm.series[metric].last() for metric in METRICS}
+
+    def sparkline(self, vm_name, metric="cpu", width=20, maximum=None, host=LOCAL_HOST):
+        with self._lock:
+            vm = self._vms.get((host, vm_name))
+            return sparkline(vm.series[metric].values(), width, maximum) if vm else ""
+
+    def record(self, samples, timestamp=None, host=LOCAL_HOST):
+        """Adds one sample per VM of a host (VMMetrics records).
+
+        VMs of that host missing from samples are dropped; other hosts are not touched.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            vms = {key: vm for key, vm in self._vms.items() if key[0] != host}
+            sampled = []
+            for sample in samples:
+                key = (host, sample.name)
+                vm = self._vms.get(key) or _VMSeries(self.capacity)
+                vms[key] = vm
+                sampled.append(key)
+                totals = (sample.disk_read_mb, sample.disk_write_mb, sample.network_in_mb, sample.network_out_mb)
+                rates = (0.0, 0.0, 0.0, 0.0)
+                if vm.totals is not None and None not in totals and None not in vm.totals:
+                    elapsed = timestamp - vm.times.last()
+                    if elapsed > 0:
+                        # Counters start over when metering is reset; treat that as no traffic
+                        rates = tuple(max(0.0, (new - old) / elapsed) for new, old in zip(totals, vm.totals))
+                vm.totals = totals
+                vm.times.append(timestamp)
+                values = (sample.cpu_usage, sample.memory_assigned / (1024 * 1024)) + rates
+                for metric, value in zip(METRICS, values):
+                    vm.series[metric].append(value)
+            self._vms = vms
+            return {key: {metric: vms[key].series[metric].last() for metric in METRICS} for key in sampled}
+
+    def _run(self, host, stop_event):
+        if self.enable_metering:
+            # Disk and network totals are only reported once resource metering is on
+            run_query(enable_resource_metering, host=host)
+        while not stop_event.is_set():
+            started = time.monotonic()
+            success, samples = run_query(get_vm_metrics, host=host)
+            if success and not stop_event.is_set():
+                latest = self.record(samples, host=host)
+                if self.window is not None:
+                    try:
+                        self.window.write_event_value(self.event_key, latest)
+                    except Exception:
+                        # The window was closed while sampling
+                        return
+            stop_event.wait(max(0.0, self.interval - (time.monotonic() - started)))
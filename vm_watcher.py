@@ -0,0 +1,99 @@
+import threading
+from config import LOCAL_HOST
+from powershell_utils import poll_vm_inventory, run_query
+
+
+def _vm_signature(vm):
+    # Only what the VM table shows; uptime and CPU usage change on every poll and are ignored
+    return (vm.state, vm.guest_os, tuple(vm.ip_addresses), tuple(adapter.astuple() for adapter in vm.adapters))
+
+
+class VMStateWatcher:
+    """Polls the VM inventory in the background and reports only the VMs that changed.
+
+    Changes are posted to the PySimpleGUI window with write_event_value(event_key, changes),
+    where changes is {"host": host, "changed": {(host, vm_name): vm}, "removed": [(host, vm_name), ...]}.
+    Nothing is posted while the inventory stays the same, and the poll interval backs off
+    from interval to max_interval until something changes again. Every host is polled by
+    its own thread with its own back-off, so a slow or unreachable host never delays the others.
+    The last inventory of each host is kept, see snapshot().
+    """
+
+    def __init__(self, window, event_key, interval=2.0, max_interval=15.0, hosts=None):
+        self.window = window
+        self.event_key = event_key
+        self.interval = interval
+        self.max_interval = max_interval
+        self.hosts = list(hosts or [LOCAL_HOST])
+        # Guards _signatures and _snapshots, which the poll threads and the GUI both update
+        self._lock = threading.Lock()
+        self._signatures = {}
+        self._snapshots = {}
+        self._stop_event = threading.Event()
+        self._wake_events = {}
+        self._threads = []
+
+    def start(self):
+        if any(thread.is_alive() for thread in self._threads) and not self._stop_event.is_set():
+            return
+        # Fresh events per run, so a stopping thread that is still mid-poll cannot be revived
+        self._stop_event = threading.Event()
+        self._wake_events = {host: threading.Event() for host in self.hosts}
+        self._threads = []
+        for host in self.hosts:
+            thread = threading.Thread(target=self._run, args=(host, self._stop_event, self._wake_events[host]), name=f"vm-watcher-{host}")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop_event.set()
+        for wake_event in self._wake_events.values():
+            wake_event.set()
+
+    def reset(self, vms, host=LOCAL_HOST):
+        """Sets the baseline of a host to an inventory the GUI already shows, e.g. after a manual refresh."""
+        signatures = {vm.name: _vm_signature(vm) for vm in vms}
+        with self._lock:
+            self._signatures[host] = signatures
+            self._snapshots[host] = list(vms)
+
+    def snapshot(self, host=LOCAL_HOST):
+        """The last inventory of a host the watcher polled or was reset to, or None."""
+        with self._lock:
+            vms = self._snapshots.get(host)
+            return list(vms) if vms is not None else None
+
+    def poll_now(self):
+        """Wakes the watcher up for an immediate poll of every host, e.g. right after a VM action."""
+        for wake_event in self._wake_events.values():
+            wake_event.set()
+
+    def _diff(self, host, vms):
+        signatures = {vm.name: _vm_signature(vm) for vm in vms}
+        with self._lock:
+            previous = self._signatures.get(host) or {}
+            self._signatures[host] = signatures
+            self._snapshots[host] = list(vms)
+        changed = {(host, vm.name): vm for vm in vms if previous.get(vm.name) != signatures[vm.name]}
+        removed = [(host, name) for name in previous if name not in signatures]
+        return changed, removed
+
+    def _run(self, host, stop_event, wake_event):
+        delay = self.interval
+        # Right after start() (e.g. a view switch), an inventory that is still cached is good enough
+        use_cache = True
+        while not stop_event.is_set():
+            success, vms = run_query(poll_vm_inventory, use_cache=use_cache, host=host)
+            use_cache = False
+            if success and not stop_event.is_set():
+                changed, removed = self._diff(host, vms)
+                if changed or removed:
+                    self.window.write_event_value(self.event_key, {"host": host, "changed": changed, "removed": removed})
+                    delay = self.interval
+                else:
+                    delay = min(delay * 2, self.max_interval)
+            wake_event.wait(delay)
+            if wake_event.is_set():
+                wake_event.clear()
+                delay = self.interval